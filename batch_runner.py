@@ -0,0 +1,218 @@
+import warnings
+warnings.filterwarnings('ignore')
+from datetime import datetime
+
+import os
+import sys
+import glob
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from file_mgmt import banner_, unpack_params
+from transform import transform_data, save_transformation, read_accepted
+from edge_cases import EdgeCaseDetector
+from clean_markup import clean_dirty_data
+from spacy_nlp import entity_recognizer, save_extracts
+from metrics import start_run, end_run
+
+
+def find_inputs(inputs:str)->(list):
+    """Lists the CSV exports to process.
+
+    Args:
+    inputs (str): a directory of CSV files, a glob
+                  (e.g. `exports/2021_*.csv`) or a single file
+
+    Returns:
+    input_paths (list): sorted paths to CSV files
+    """
+    if os.path.isdir(inputs):
+        inputs = os.path.join(inputs, "*.csv")
+    return sorted(glob.glob(inputs))
+
+
+def file_session(batch_path:str, input_path:str)->(str):
+    """Creates the session directory of one input file
+    inside the batch directory, named after the file. Files with
+    the same name in different directories (`a/export.csv`,
+    `b/export.csv`) get a numbered suffix, `export_2`, so they do
+    not overwrite each other's outputs; the batch summary maps
+    each file to its session."""
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    session_path, n = os.path.join(batch_path, name), 1
+    while os.path.exists(session_path):
+        n += 1
+        session_path = os.path.join(batch_path, f"{name}_{n}")
+    os.makedirs(session_path)
+    return session_path
+
+
+def prepare_file(input_path:str, session_path:str, narr_col:str,
+                 id_col:str="ID", long_docs:bool=False,
+                 compact:bool=False, usecols:list=None)->(str, pd.DataFrame):
+    """   [JOB 1-2 for one file]
+    Runs in a worker process, so several files are prepared
+    at the same time while the main process extracts.
+    [1] `transform_data`, [2] `EdgeCaseDetector` and `clean_dirty_data`,
+    [3] `save_transformation`, which saves the accepted rows to
+    `accepted.csv` in the session's `transformed` directory.
+
+    Args:
+    input_path (str): path to a CSV export
+    session_path (str): session directory of the file
+    narr_col (str): column containing narrative text
+    id_col (str): column containing the narrative ID
+    long_docs (bool): accept Q5 for windowed extraction
+    compact (bool): use compact dtypes, see `compact_frame`
+    usecols (list): columns of the export to read, or None for all
+
+    Returns:
+    accepted_path (str): path to the narratives accepted for extraction
+    log (pd.DataFrame): session log of the file
+    """
+    start_run(session_path)
+    data, log = transform_data(input_path, narr_col, None, compact=compact,
+                               usecols=usecols)
+    if id_col != "ID":
+        data = data.rename(columns={id_col: "ID"})
+    data, log = EdgeCaseDetector(data, log)
+    data, log = clean_dirty_data(data, log, narr_col)
+    save_transformation(data, log, session_path, long_docs=long_docs)
+    end_run(runs_path=None)
+    return f"{session_path}/transformed/accepted.csv", log
+
+
+def extract_file(accepted_path:str, session_path:str, model:str,
+                 log:pd.DataFrame, index_path:str="./index/entities.sqlite",
+                 **extract_args)->(pd.DataFrame):
+    """   [JOB 3 for one file]
+    Extracts entities from the accepted narratives of a file with
+    the shared pipeline (see model_registry.py), and saves the
+    entity tables to the file's session directory.
+
+    Args:
+    accepted_path (str): path from `prepare_file`
+    session_path (str): session directory of the file
+    model (str): path to selected spaCy model
+    log (pd.DataFrame): session log of the file
+    index_path (str): path to the entity index, or None to skip it
+    extract_args: passed to `entity_recognizer`
+
+    Returns:
+    entities (pd.DataFrame): table of entity extracts
+    """
+    start_run(session_path)
+    data = read_accepted(accepted_path)
+    doc_bin_dir, extracts = entity_recognizer(data["narratives"], session_path,
+                                              model, log=log, ids=data["ID"],
+                                              **extract_args)
+    data["entities"] = extracts
+    entities = save_extracts(data, model, session_path, index_path=index_path)
+    end_run()
+    return entities
+
+
+def batch_pipeline(input_paths:list, model:str, output_dir:str,
+                   narr_col:str, id_col:str="ID", workers:int=2,
+                   long_docs:bool=False, compact:bool=False,
+                   usecols:list=None, index_path:str="./index/entities.sqlite",
+                   **extract_args)->(pd.DataFrame):
+    """Runs the extraction pipeline on many CSV exports without
+    prompts. Files are prepared (JOB 1-2) by `workers` processes;
+    the main process extracts (JOB 3) each file as soon as it is
+    prepared, with one pipeline kept warm for the whole batch.
+    A file that fails is recorded in the summary and skipped.
+    [1] Creates a batch directory with one session per file.
+    [2] Prepares files in parallel with `prepare_file`.
+    [3] Extracts each prepared file with `extract_file`.
+    [4] Saves each file's log, and a combined `summary.csv`.
+
+    Args:
+    input_paths (list): paths to CSV exports
+    model (str): path to selected spaCy model
+    output_dir (str): directory for the batch outputs
+    narr_col (str): column containing narrative text
+    id_col (str): column containing the narrative ID
+    workers (int): number of processes preparing files
+    long_docs (bool): accept Q5 for windowed extraction
+    compact (bool): use compact dtypes for JOBs 1-2
+    usecols (list): columns of each export to read, or None for all
+    index_path (str): path to the entity index, or None to skip it
+    extract_args: passed to `entity_recognizer`
+
+    Returns:
+    summary (pd.DataFrame): one row per input file
+    """
+    batch_time = datetime.now()
+    batch_path = os.path.join(output_dir, batch_time.strftime("batch_%Y%m%d_%H%M%S"))
+    os.makedirs(batch_path)
+    print(f"[*] {len(input_paths)} files; batch outputs in: {batch_path}")
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for input_path in input_paths:
+            session_path = file_session(batch_path, input_path)
+            future = pool.submit(prepare_file, input_path, session_path,
+                                 narr_col, id_col, long_docs, compact, usecols)
+            futures[future] = (input_path, session_path, time.perf_counter())
+        for future in as_completed(futures):
+            input_path, session_path, start = futures[future]
+            row = {"File": input_path, "SessionPath": session_path}
+            print("-"*72)
+            print(f"[*] Extracting: {input_path}")
+            try:
+                accepted_path, log = future.result()
+                prepared = time.perf_counter()
+                entities = extract_file(accepted_path, session_path, model,
+                                        log, index_path, **extract_args)
+                log.loc["Entities"] = len(entities)
+                log.to_json(f"{session_path}/log.json")
+                row.update({"Status": "ok",
+                            "Records": log.loc["Number of Records", "Description"],
+                            "EdgeCases": log.loc["TotalEdgeCases", "Description"],
+                            "Entities": len(entities),
+                            "ExtractionSeconds": round(time.perf_counter() - prepared, 2)})
+            except Exception as error:
+                traceback.print_exc()
+                row.update({"Status": "failed", "Error": repr(error)})
+            row["WallSeconds"] = round(time.perf_counter() - start, 2)
+            rows.append(row)
+
+    summary = pd.DataFrame(rows)
+    summary.to_csv(f"{batch_path}/summary.csv", index=False)
+    failed = (summary["Status"] != "ok").sum()
+    print(f"[!] {len(summary) - failed} files extracted, {failed} failed.")
+    print(f"[!] Batch summary saved to: {batch_path}/summary.csv")
+    print(f"[TOTAL RUNTIME: {str(datetime.now() - batch_time)[:19]}]")
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless batch extraction.")
+    parser.add_argument("config", help="JSON config file, see `unpack_params`")
+    parser.add_argument("--inputs", help="directory or glob of CSV exports; "
+                        "defaults to `input_dir`/`input_filename` in the config")
+    parser.add_argument("--workers", type=int, default=2)
+    args = parser.parse_args()
+
+    banner_("spaCy NLP - Batch Entity Extraction")
+    fileParams, spaCyParams, dataParams = unpack_params(args.config)
+    inputs = args.inputs or os.path.join(fileParams["input_dir"],
+                                         fileParams["input_filename"])
+    input_paths = find_inputs(inputs)
+    if not input_paths:
+        sys.exit(f"[!] No CSV files found: {inputs}")
+    extract_args = {key: spaCyParams[key] for key in
+                    ["mode", "cache_path", "cache_max_mb", "save_docs", "autotune",
+                     "max_chars", "checkpoint"]
+                    if key in spaCyParams}
+    batch_pipeline(input_paths, spaCyParams["model"], fileParams["output_dir"],
+                   dataParams["smryCol"], dataParams.get("idCol", "ID"),
+                   workers=args.workers, long_docs=spaCyParams.get("long_docs", False),
+                   compact=dataParams.get("compact", False),
+                   usecols=dataParams.get("usecols"),
+                   index_path=spaCyParams.get("index_path", "./index/entities.sqlite"),
+                   **extract_args)
@@ -0,0 +1,372 @@
+import warnings
+warnings.filterwarnings('ignore')
+from datetime import datetime
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import pandas as pd
+import numpy as np
+import spacy
+import pattern_data as lex
+from transform import transform_data, save_transformation
+from edge_cases import detect_short_narrs, detect_dirty_data, detect_repeat_sources
+from clean_markup import clean_dirty_data
+from spacy_nlp import rules_engine, doc_extracts, save_extracts
+from model_registry import get_model
+from metrics import cpu_seconds, RssSampler
+
+# Filler vocabulary of hotline narratives; entities come from `pattern_data`
+FILLER = ("i called the hotline because someone used my information to apply "
+          "for a loan in my name without my permission and now i received a "
+          "letter about the application that i never submitted please help "
+          "me stop this the caller said they were contacted by phone and "
+          "asked to pay a fee before the funds were released").split()
+
+# Salutations and signatures shared by narratives from a repeat source
+OPENERS = ["good morning, this is a referral from the call center regarding",
+           "complainant called to report identity theft involving",
+           "hello, i am writing on behalf of my client regarding",
+           "this report was forwarded by the inspector general hotline about"]
+CLOSERS = ["please contact me at your earliest convenience. thank you.",
+           "sent from my iphone", "regards, customer service team",
+           "this message is confidential and intended for the recipient only"]
+
+# Markup that `DIRTY_SIGNATURES` detects, and `clean_markup` removes
+MARKUP = ['<p>{}</p>', '<div class="msg">{}</div>', '<img alt="scan.png"> {}',
+          '{} <br/><b>Case Notes</b>', '*****************\nName: {}\n**********']
+
+
+def synthetic_entity(rng:np.random.Generator)->(str):
+    """Draws one entity from the lexicons in `pattern_data`,
+    or a number in the formats the ruler's patterns match."""
+    kind = rng.integers(10)
+    if kind == 0:
+        return f"{rng.integers(200, 999)}-{rng.integers(200, 999)}-{rng.integers(1000, 9999)}"
+    if kind == 1:
+        return f"{rng.integers(10, 99)}-{rng.integers(1000000, 9999999)}"
+    if kind == 2:
+        return f"${rng.integers(1, 150)},{rng.integers(100, 999)}"
+    if kind == 3:
+        street = rng.choice(list(lex.ADDR_1.keys()))
+        return f"{rng.integers(1, 9999)} {rng.choice(FILLER).title()} {street}"
+    lexicon = [lex.finBANK, lex.finAPP, lex.finCRYPTO, lex.finSVC,
+               lex.govtORGS_1A + lex.govtORGS_1B,
+               lex.govtPROGS_1A + lex.govtPROGS_1B][kind - 4]
+    return str(rng.choice(lexicon))
+
+
+def synthetic_corpus(n:int, seed:int=0, mean_words:int=80, sigma:float=0.9,
+                     dirty_rate:float=0.05, duplicate_rate:float=0.02,
+                     repeat_rate:float=0.1, entity_density:float=0.05,
+                     null_rate:float=0.005)->(pd.DataFrame):
+    """Generates a seeded corpus of synthetic hotline narratives,
+    shaped like an export (`ID`, `C_CASE_SUMMARY`).
+    [1] Narrative lengths (in words) are log-normal, so the
+        corpus has short Q1 and very long Q5 tails.
+    [2] Each word is an entity with probability `entity_density`.
+    [3] `repeat_rate` of narratives share a salutation and
+        signature with other narratives from the same source.
+    [4] `dirty_rate` of narratives are wrapped in HTML or form markup.
+    [5] `duplicate_rate` of rows repeat an earlier narrative;
+        half of those repeat the whole row (true duplicates).
+    [6] `null_rate` of narratives are missing.
+
+    Args:
+    n (int): number of rows
+    seed (int): random seed; the same seed gives the same corpus
+    mean_words (int): median narrative length in words
+    sigma (float): spread of the log-normal length distribution
+    dirty_rate (float): share of narratives with markup
+    duplicate_rate (float): share of duplicate rows
+    repeat_rate (float): share of narratives from repeat sources
+    entity_density (float): share of words that are entities
+    null_rate (float): share of missing narratives
+
+    Returns:
+    data (pd.DataFrame): synthetic export
+    """
+    rng = np.random.default_rng(seed)
+    lengths = np.maximum(rng.lognormal(np.log(mean_words), sigma, n).astype(int), 1)
+    sources = rng.integers(len(OPENERS), size=n), rng.integers(len(CLOSERS), size=n)
+    narratives = []
+    for i, length in enumerate(lengths):
+        words = rng.choice(FILLER, length)
+        ents = np.flatnonzero(rng.random(length) < entity_density)
+        words = words.astype(object)
+        for j in ents:
+            words[j] = synthetic_entity(rng)
+        text = " ".join(words)
+        if rng.random() < repeat_rate:
+            text = f"{OPENERS[sources[0][i]]} {text} {CLOSERS[sources[1][i]]}"
+        if rng.random() < dirty_rate:
+            text = MARKUP[rng.integers(len(MARKUP))].format(text)
+        narratives.append(text)
+
+    data = pd.DataFrame({"ID": [f"SYN-{seed}-{i:08d}" for i in range(n)],
+                         "C_CASE_SUMMARY": narratives})
+    # Duplicates copy an earlier row; half keep its ID as well
+    dups = np.flatnonzero(rng.random(n) < duplicate_rate)
+    dups = dups[dups > 0]
+    origins = (rng.random(len(dups)) * dups).astype(int)
+    data.loc[dups, "C_CASE_SUMMARY"] = data.loc[origins, "C_CASE_SUMMARY"].values
+    true_dups = dups[rng.random(len(dups)) < 0.5]
+    true_origins = origins[np.isin(dups, true_dups)]
+    data.loc[true_dups, "ID"] = data.loc[true_origins, "ID"].values
+    nulls = rng.random(n) < null_rate
+    data.loc[nulls, "C_CASE_SUMMARY"] = None
+    return data
+
+
+def timed(work, *args, repeats:int=1, quiet:bool=True, **kwargs)->(tuple):
+    """Runs `work` `repeats` times and times each run; the pipeline's
+    progress messages are silenced unless `quiet` is False. `work`
+    gets fresh `args` each time if they are DataFrames (detectors
+    add columns to their input).
+
+    Returns:
+    result: return value of the last run
+    timing (dict): best and median wall seconds, CPU seconds of
+                   the best run, and the peak RSS sampled during
+                   the runs and its rise over the RSS at the start
+                   of the run, in MB
+    """
+    walls, cpus, peaks, rises = [], [], [], []
+    for n in range(repeats):
+        fresh = [arg.copy() if isinstance(arg, pd.DataFrame) else arg for arg in args]
+        out = io.StringIO() if quiet else sys.stdout
+        with contextlib.redirect_stdout(out):
+            sampler = RssSampler(interval=0.01)
+            sampler.start()
+            cpu, wall = cpu_seconds(), time.perf_counter()
+            try:
+                result = work(*fresh, **kwargs)
+            finally:
+                walls.append(time.perf_counter() - wall)
+                cpus.append(cpu_seconds() - cpu)
+                sampler.stop()
+            peaks.append(sampler.peak)
+            rises.append(sampler.peak - sampler.start_rss)
+    best = int(np.argmin(walls))
+    return result, {"wall_seconds": round(walls[best], 5),
+                    "median_seconds": round(float(np.median(walls)), 5),
+                    "cpu_seconds": round(cpus[best], 5),
+                    "peak_rss_mb": round(max(peaks), 1),
+                    "rss_delta_mb": round(max(rises), 1)}
+
+
+def transformer_engine(model:str, pattern_path:str):
+    """Loads a full pipeline for comparison with the rules engine.
+    A package without an entity ruler (e.g. `en_core_web_trf`)
+    gets one with the patterns in `pattern_path`, uncompiled."""
+    nlp = spacy.load(model)
+    if "entity_ruler" not in nlp.pipe_names and os.path.isfile(pattern_path):
+        with open(pattern_path, "r") as f:
+            patterns = [json.loads(line) for line in f if line.strip()]
+        ruler = nlp.add_pipe("entity_ruler", config={"overwrite_ents": True})
+        ruler.add_patterns(patterns)
+    return nlp
+
+
+def bench_size(n:int, work_dir:str, model:str, seed:int=0, repeats:int=3,
+               extract_max:int=2000, batch_size:int=256,
+               transformer:str="en_core_web_trf", **corpus_args)->(list):
+    """Benchmarks JOB 1-3 on a synthetic corpus of `n` rows.
+    [1] `transform_data` on the corpus, saved as CSV.
+    [2] Each edge case detector, and `clean_dirty_data`.
+    [3] `save_transformation`.
+    [4] Ruler matching: the rules-only pipeline on at most
+        `extract_max` accepted narratives, on one process.
+    [5] `save_extracts` on those extracts.
+    [6] Transformer matching: the full `transformer` pipeline on
+        the same narratives, so the rules engine's speedup is
+        measured; skipped if the pipeline is not installed.
+
+    Args:
+    n (int): number of rows
+    work_dir (str): scratch directory for the corpus and outputs
+    model (str): pattern file (or model) of the rules engine
+    seed (int): corpus seed
+    repeats (int): runs per benchmark; the best run is reported
+    extract_max (int): cap on narratives for [4] and [5]
+    batch_size (int): `nlp.pipe` batch size for [4] and [6]
+    transformer (str): full pipeline (model directory or package)
+                       for [6], or None to skip it
+    corpus_args: passed to `synthetic_corpus`
+
+    Returns:
+    results (list): one record per benchmark
+    """
+    size_dir = os.path.join(work_dir, f"n{n}")
+    os.makedirs(size_dir, exist_ok=True)
+    input_path = os.path.join(size_dir, "export.csv")
+    synthetic_corpus(n, seed=seed, **corpus_args).to_csv(input_path, index=False)
+
+    results = []
+    def record(name, rows, timing):
+        rate = rows / timing["wall_seconds"] if timing["wall_seconds"] > 0 else None
+        results.append({"benchmark": name, "rows": n, "rows_in": rows,
+                        "rows_per_sec": round(rate, 1) if rate else None, **timing})
+        print(f"[*] n={n:<8} {name:<24} {timing['wall_seconds']:>9.4f}s")
+
+    (data, log), timing = timed(transform_data, input_path, "C_CASE_SUMMARY",
+                                None, repeats=repeats)
+    record("transform_data", n, timing)
+
+    for name, detector, args in [("detect_short_narrs", detect_short_narrs, [100]),
+                                 ("detect_dirty_data", detect_dirty_data, []),
+                                 ("detect_repeat_sources", detect_repeat_sources, [5])]:
+        (data, log), timing = timed(detector, data, *args, log, repeats=repeats)
+        record(name, len(data), timing)
+    data["EDGE_CASE"] = data[["SHORT", "DIRTY", "SAME_SRC"]].sum(axis=1)
+    (data, log), timing = timed(clean_dirty_data, data, log, repeats=repeats)
+    record("clean_dirty_data", len(data), timing)
+
+    _, timing = timed(save_transformation, data, log, size_dir, repeats=repeats)
+    record("save_transformation", len(data), timing)
+
+    # Ruler matching, on a warm pipeline so load time is not counted
+    accepted = data.loc[data["qCut"].isin(["Q2", "Q3", "Q4"])]
+    accepted = accepted.iloc[:extract_max].reset_index(drop=True)
+    nlp = get_model(model, loader=rules_engine)
+    texts = accepted["narratives"].tolist()
+    docs, timing = timed(lambda: list(nlp.pipe(texts, batch_size=batch_size)),
+                         repeats=repeats)
+    record("ruler_matching", len(texts), timing)
+
+    accepted = accepted[["ID"]].copy()
+    accepted["entities"] = [doc_extracts(doc) for doc in docs]
+    entities, timing = timed(save_extracts, accepted, model, size_dir,
+                              index_path=None, repeats=repeats)
+    record("save_extracts", len(accepted), timing)
+    results[-1]["entities"] = len(entities)
+
+    # Transformer matching on the same narratives, also warm
+    if transformer is not None:
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                trf = transformer_engine(transformer, model)
+        except OSError:
+            print(f"[!] {transformer} is not installed; transformer matching is skipped.")
+            return results
+        _, timing = timed(lambda: list(trf.pipe(texts, batch_size=batch_size)),
+                          repeats=repeats)
+        record("transformer_matching", len(texts), timing)
+        ruler = next(r for r in results if r["benchmark"] == "ruler_matching")
+        ruler["speedup"] = round(timing["wall_seconds"] / ruler["wall_seconds"], 1)
+        print(f"[*] Rules engine speedup over {transformer}: {ruler['speedup']}x")
+    return results
+
+
+def run_benchmarks(sizes:list, model:str="./patterns.json",
+                   output_dir:str="./benchmarks", seed:int=0, repeats:int=3,
+                   extract_max:int=2000, keep_files:bool=False,
+                   transformer:str="en_core_web_trf",
+                   **corpus_args)->(pd.DataFrame):
+    """Runs `bench_size` for each corpus size and saves the results.
+    Each run is saved to `bench_<time>.csv` in `output_dir`, and
+    appended to `results.jsonl` with the run's settings and library
+    versions, so runs can be compared with `compare_benchmarks`.
+
+    Args:
+    sizes (list): corpus sizes, e.g. `[1000, 10000, 100000]`
+    model (str): pattern file (or model) of the rules engine
+    output_dir (str): directory for benchmark results
+    seed (int): corpus seed
+    repeats (int): runs per benchmark; the best run is reported
+    extract_max (int): cap on narratives for ruler matching
+    keep_files (bool): keep the synthetic corpora and outputs
+    transformer (str): full pipeline the rules engine is compared
+                       with, or None to skip the comparison
+    corpus_args: passed to `synthetic_corpus`
+
+    Returns:
+    results (pd.DataFrame): one row per benchmark and size
+    """
+    run_time = datetime.now()
+    run_id = run_time.strftime("bench_%Y%m%d_%H%M%S")
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    work_dir = tempfile.mkdtemp(prefix=f"{run_id}_")
+    print(f"[*] Benchmarking sizes {sizes}; scratch files in: {work_dir}")
+
+    records = []
+    try:
+        for n in sizes:
+            records += bench_size(n, work_dir, model, seed=seed, repeats=repeats,
+                                  extract_max=extract_max,
+                                  transformer=transformer, **corpus_args)
+    finally:
+        if not keep_files:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = pd.DataFrame(records)
+    results.insert(0, "run", run_id)
+    results_path = os.path.join(output_dir, f"{run_id}.csv")
+    results.to_csv(results_path, index=False)
+    run = {"run": run_id, "time": run_time.isoformat(), "seed": seed,
+           "repeats": repeats, "model": model, "transformer": transformer,
+           "corpus": corpus_args,
+           "python": platform.python_version(), "pandas": pd.__version__,
+           "numpy": np.__version__, "spacy": spacy.__version__,
+           "cpus": os.cpu_count(), "results": records}
+    with open(os.path.join(output_dir, "results.jsonl"), "a") as f:
+        f.write(json.dumps(run, default=str) + "\n")
+    print(f"[!] Benchmark results saved to: {results_path}")
+    return results
+
+
+def compare_benchmarks(output_dir:str="./benchmarks",
+                       metric:str="wall_seconds")->(pd.DataFrame):
+    """Compares benchmark runs saved in `output_dir`.
+
+    Args:
+    output_dir (str): directory containing `results.jsonl`
+    metric (str): metric to compare, e.g. `rows_per_sec`
+
+    Returns:
+    runs (pd.DataFrame): one row per benchmark and size,
+                         one column per run
+    """
+    rows = []
+    with open(os.path.join(output_dir, "results.jsonl"), "r") as f:
+        for line in f:
+            run = json.loads(line)
+            rows += [{"run": run["run"], **record} for record in run["results"]]
+    return pd.DataFrame(rows).pivot_table(index=["benchmark", "rows"], columns="run",
+                                          values=metric, aggfunc="min")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JOB 1-3 on synthetic narratives.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--model", default="./patterns.json")
+    parser.add_argument("--transformer", default="en_core_web_trf")
+    parser.add_argument("--output", default="./benchmarks")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--extract-max", type=int, default=2000)
+    parser.add_argument("--dirty-rate", type=float, default=0.05)
+    parser.add_argument("--duplicate-rate", type=float, default=0.02)
+    parser.add_argument("--repeat-rate", type=float, default=0.1)
+    parser.add_argument("--entity-density", type=float, default=0.05)
+    parser.add_argument("--mean-words", type=int, default=80)
+    parser.add_argument("--keep-files", action="store_true")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.model, args.output, seed=args.seed,
+                             repeats=args.repeats, extract_max=args.extract_max,
+                             keep_files=args.keep_files,
+                             transformer=args.transformer, dirty_rate=args.dirty_rate,
+                             duplicate_rate=args.duplicate_rate,
+                             repeat_rate=args.repeat_rate,
+                             entity_density=args.entity_density,
+                             mean_words=args.mean_words)
+    print(results.to_string(index=False))
@@ -0,0 +1,56 @@
+import os
+import json
+
+
+def checkpoint_path(session_path:str)->(str):
+    """Path of the extraction checkpoint in a session directory."""
+    return os.path.join(session_path, "checkpoint", "extracts.jsonl")
+
+
+def save_checkpoint(path:str, records:list)->(int):
+    """Appends finished rows to the extraction checkpoint and
+    syncs it to disk. The file is append-only JSONL, so a run
+    that dies while writing loses at most the last line.
+
+    Args:
+    path (str): path from `checkpoint_path`
+    records (list): `{"id", "hash", "entities"}` for each finished row
+
+    Returns:
+    (int): number of rows written
+    """
+    checkpoint_dir = os.path.dirname(path)
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    with open(path, "a") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    return len(records)
+
+
+def load_checkpoint(path:str)->(dict):
+    """Reads the rows finished by an earlier run of a session.
+    A truncated last line, from a run that died while writing,
+    is skipped.
+
+    Args:
+    path (str): path from `checkpoint_path`
+
+    Returns:
+    done (dict): row id -> (narrative hash, list of entity tuples)
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            done[record["id"]] = (record["hash"],
+                                  [tuple(ent) for ent in record["entities"]])
+    print(f"[*] {len(done)} finished rows found in checkpoint: {path}")
+    return done
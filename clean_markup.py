@@ -0,0 +1,281 @@
+import warnings
+warnings.filterwarnings('ignore')
+import re
+import json
+import html
+from bisect import bisect_right
+import pandas as pd
+import numpy as np
+from edge_cases import DIRTY_SIGNATURES, DIRTY_BITS, dirty_flags
+from metrics import step, end_step
+from transform import is_compact, compact_frame, quant_bins
+
+# Markup removed by `clean_markup`, scanned together in one pass.
+# `IMG` captures the alt text of `<img alt=...>`, which is kept.
+MARKUP_PATTERN = re.compile("|".join([
+    r"(?P<IMG><img alt=(?:\"(?P<alt1>[^\"]*)\"|'(?P<alt2>[^']*)'|(?P<alt3>[^\s>]*))[^>]*>)",
+    f"(?P<TAG>{DIRTY_SIGNATURES['HTML']})",
+    r"(?P<ENTITY>&(?:[a-z][a-z0-9]*|#[0-9]+|#x[0-9a-f]+);)",
+    f"(?P<FORM>{DIRTY_SIGNATURES['FORM_1']})",
+]))
+# Tags that end a line of text; other tags separate words
+BLOCK_TAG = re.compile(r"</?(?:br|p|div|tr|li|ul|ol|table|h[1-6]|hr)\b")
+
+
+def clean_markup(text:str)->(str, list):
+    """Converts a narrative with markup to plain text.
+    [1] Tags are removed. Block tags (`<br>`, `<p>`, `<div>`, ...)
+        become a line break, other tags a space, unless there is
+        already whitespace on either side.
+    [2] `<img alt=...>` tags are replaced by their alt text.
+    [3] HTML entities (`&amp;`, `&#39;`, ...) are decoded.
+    [4] Runs of `*` from web-form layouts become a space.
+    Returns an offset map with one `[clean_start, clean_end,
+    raw_start, raw_end]` segment per piece of cleaned text, so
+    spans in the cleaned text can be mapped back, see `map_span`.
+
+    Args:
+    text (str): narrative text with markup
+
+    Returns:
+    clean (str): plain text narrative
+    offset_map (list): segments of cleaned and raw offsets
+    """
+    text = str(text)
+    pieces, offset_map, pos, size = [], [], 0, 0
+
+    def emit(piece, raw_start, raw_end):
+        nonlocal size
+        if piece:
+            pieces.append(piece)
+            offset_map.append([size, size + len(piece), raw_start, raw_end])
+            size += len(piece)
+
+    def ends_in_space():
+        return size == 0 or pieces[-1][-1].isspace()
+
+    for match in MARKUP_PATTERN.finditer(text):
+        emit(text[pos:match.start()], pos, match.start())
+        kind = match.lastgroup
+        if kind == "IMG":
+            alt = match.group("alt1") or match.group("alt2") or match.group("alt3") or ""
+            group = [name for name in ("alt1", "alt2", "alt3") if match.group(name)]
+            if alt and group:
+                if not ends_in_space():
+                    emit(" ", match.start(), match.start())
+                emit(alt, match.start(group[0]), match.end(group[0]))
+                emit(" ", match.end(), match.end())
+        elif kind == "ENTITY":
+            emit(html.unescape(match.group()), match.start(), match.end())
+        elif not ends_in_space() and not text[match.end():match.end()+1].isspace():
+            sep = "\n" if kind == "TAG" and BLOCK_TAG.match(match.group()) else " "
+            emit(sep, match.start(), match.end())
+        pos = match.end()
+    emit(text[pos:], pos, len(text))
+    return "".join(pieces), offset_map
+
+
+def map_span(offset_map:list, start:int, end:int)->(int, int):
+    """Maps a `(start, end)` span in cleaned text back to the raw
+    narrative. Inside copied text, offsets shift by the segment;
+    a span that starts or ends in replaced text (e.g. a decoded
+    entity) is widened to the whole replaced markup.
+
+    Args:
+    offset_map (list): segments from `clean_markup`
+    start (int): start character in the cleaned text
+    end (int): end character in the cleaned text
+
+    Returns:
+    raw_start (int): start character in the raw narrative
+    raw_end (int): end character in the raw narrative
+    """
+    if not offset_map:
+        return start, end
+    clean_starts = [segment[0] for segment in offset_map]
+    def locate(pos):
+        return offset_map[max(bisect_right(clean_starts, pos) - 1, 0)]
+    c0, c1, r0, r1 = locate(start)
+    raw_start = r0 + (start - c0) if c1 - c0 == r1 - r0 else r0
+    c0, c1, r0, r1 = locate(max(end - 1, start))
+    raw_end = r0 + (end - c0) if c1 - c0 == r1 - r0 else r1
+    return raw_start, raw_end
+
+
+def normalize_map(raw:str)->(str, list):
+    """Repeats the normalization of `detect_dirty_data` on a raw
+    narrative (lower case, runs of three spaces to one, strip),
+    with an offset map of the normalized text back to the raw
+    text, in the format of `clean_markup`. If lower casing changes
+    the length of the text (rare Unicode), the whole narrative
+    is one segment.
+
+    Args:
+    raw (str): narrative as exported
+
+    Returns:
+    text (str): normalized narrative
+    offset_map (list): segments of normalized and raw offsets
+    """
+    raw = str(raw)
+    lowered = raw.lower()
+    if len(lowered) != len(raw):
+        text = lowered.replace("   ", " ").strip()
+        return text, [[0, len(text), 0, len(raw)]]
+    pieces, offset_map, pos, size = [], [], 0, 0
+    for match in re.finditer("   ", lowered):
+        for piece, raw_start, raw_end in [(lowered[pos:match.start()], pos, match.start()),
+                                          (" ", match.start(), match.end())]:
+            if piece:
+                pieces.append(piece)
+                offset_map.append([size, size + len(piece), raw_start, raw_end])
+                size += len(piece)
+        pos = match.end()
+    if pos < len(lowered):
+        pieces.append(lowered[pos:])
+        offset_map.append([size, size + len(lowered) - pos, pos, len(lowered)])
+    text = "".join(pieces)
+    lead = len(text) - len(text.lstrip())
+    stripped = text.strip()
+    return stripped, compose_maps([[0, len(stripped), lead, lead + len(stripped)]],
+                                  offset_map)
+
+
+def compose_maps(outer:list, inner:list)->(list):
+    """Chains two offset maps: `outer` maps text to an intermediate
+    text, and `inner` maps that text to the raw text. Copied text
+    is split along the segments of `inner`; replaced text maps to
+    the raw span of what it replaced, see `map_span`.
+
+    Args:
+    outer (list): segments of final and intermediate offsets
+    inner (list): segments of intermediate and raw offsets
+
+    Returns:
+    offset_map (list): segments of final and raw offsets
+    """
+    if not inner:
+        return outer
+    composed, starts = [], [segment[0] for segment in inner]
+    for c0, c1, m0, m1 in outer:
+        if c1 - c0 != m1 - m0:
+            composed.append([c0, c1, *map_span(inner, m0, max(m1, m0))])
+            continue
+        k = max(bisect_right(starts, m0) - 1, 0)
+        while k < len(inner) and inner[k][0] < m1:
+            i0, i1, r0, r1 = inner[k]
+            a, b = max(m0, i0), min(m1, i1)
+            if b > a and i1 - i0 == r1 - r0:
+                composed.append([c0 + a - m0, c0 + b - m0, r0 + a - i0, r0 + b - i0])
+            elif b > a:
+                composed.append([c0 + a - m0, c0 + b - m0, r0, r1])
+            k += 1
+    return composed
+
+
+def raw_offsets(offset_maps:pd.Series, starts:pd.Series,
+                ends:pd.Series)->(np.ndarray, np.ndarray):
+    """Maps entity spans in cleaned narratives back to the raw
+    narratives, with one JSON offset map (or an empty value, for
+    narratives that were not cleaned) per span, see `map_span`."""
+    raw_starts, raw_ends = starts.to_numpy(copy=True), ends.to_numpy(copy=True)
+    parsed = {}
+    for n, offset_map in enumerate(offset_maps):
+        if not isinstance(offset_map, str) or not offset_map:
+            continue
+        if offset_map not in parsed:
+            parsed[offset_map] = json.loads(offset_map)
+        raw_starts[n], raw_ends[n] = map_span(parsed[offset_map],
+                                              raw_starts[n], raw_ends[n])
+    return raw_starts, raw_ends
+
+
+def clean_dirty_data(data:pd.DataFrame, log:pd.DataFrame,
+    narr_col:str=None)->(pd.DataFrame, pd.DataFrame):
+    """    [JOB 2.4 Clean Dirty Data]
+    Runs after `EdgeCaseDetector`, before the entity recognizer.
+    [1] Narratives marked `DIRTY` are converted to plain text with
+        `clean_markup`. For those rows only, the narrative as
+        exported (`narr_col`) is kept in `raw_narratives`, and the
+        offset map back to it in `offset_map` (JSON); the map also
+        undoes the normalization of `detect_dirty_data`, see
+        `normalize_map`.
+    [2] Cleaned narratives are scanned again; `DIRTY_FLAGS`, the
+        dirty indicators, `DIRTY` and `EDGE_CASE` are updated, so
+        rows that are clean now are no longer edge cases.
+    [3] `narr_length` is measured again and `qCut` is updated with
+        the cut points `define_quants` routed with (`Quantile Cut
+        Points` in the log), so cleaned rows can be accepted for
+        auto-extraction by `save_transformation`.
+
+    Args
+    data (pd.DataFrame): dataframe of narratives,
+                         from `EdgeCaseDetector`
+    log (pd.DataFrame): session log
+    narr_col (str): column of the narrative as exported; defaults to
+                    the `Narrative Column` in the log, if any
+
+    Returns
+    data (pd.DataFrame): dataframe with cleaned narratives
+    log (pd.DataFrame): session log
+    """
+    print("-"*72)
+    print(f"[JOB 2.4] Clean Dirty Data")
+    step("2.4", len(data))
+    compact = is_compact(data)
+    mask = data["DIRTY"] > 0
+    if narr_col is None and log is not None and "Narrative Column" in log.index:
+        narr_col = log.loc["Narrative Column"].iloc[0]
+    if narr_col not in data.columns:
+        narr_col = "narratives"
+    # the raw text is only kept for the rows that are cleaned
+    data["raw_narratives"] = data[narr_col].where(mask)
+    data["offset_map"] = ""
+    if mask.sum() == 0:
+        print("0 narratives cleaned.")
+        log.loc["CleanedNarratives"] = 0
+        if compact:
+            data = compact_frame(data)
+        end_step(len(data))
+        return data, log
+
+    # [1] Convert markup to plain text, mapped back to the raw text
+    offset_maps = []
+    texts = data.loc[mask, "narratives"]
+    cleaned = [clean_markup(text) for text in texts]
+    for (clean, offset_map), text, raw in zip(cleaned, texts, data.loc[mask, narr_col]):
+        normalized, raw_map = normalize_map(raw)
+        if normalized != text:
+            raw_map = [[0, len(text), 0, len(str(raw))]]
+        offset_maps.append(json.dumps(compose_maps(offset_map, raw_map)))
+    data.loc[mask, "narratives"] = [clean for clean, offset_map in cleaned]
+    data.loc[mask, "offset_map"] = offset_maps
+
+    # [2] Scan cleaned narratives again
+    flags = dirty_flags(data.loc[mask, "narratives"])
+    data.loc[mask, "DIRTY_FLAGS"] = flags
+    for indicator in ["HTML", "IMG", "FORM_1"]:
+        data.loc[mask, indicator] = (flags & DIRTY_BITS[indicator] > 0).astype(np.uint8)
+    data.loc[mask, "DIRTY"] = (flags > 0).astype(np.uint8)
+    data["EDGE_CASE"] = data[["SHORT", "DIRTY", "SAME_SRC"]].sum(axis=1)
+
+    # [3] Re-route cleaned narratives by their new length
+    if log is not None and "Quantile Cut Points" in log.index:
+        cuts = json.loads(log.loc["Quantile Cut Points"].iloc[0])
+    else:
+        n = len(data["qCut"].cat.categories) if data["qCut"].dtype == "category" else 5
+        cuts = pd.qcut(data["narr_length"], n, retbins=True)[1]
+    labels = [f"Q{q}" for q in range(1, len(cuts))]
+    lengths = data.loc[mask, "narratives"].str.len().to_numpy(
+                                        dtype=data["narr_length"].dtype)
+    data.loc[mask, "narr_length"] = lengths
+    data.loc[mask, "qCut"] = pd.cut(lengths, quant_bins(cuts), labels=labels).astype(str)
+
+    still_dirty = int((flags > 0).sum())
+    print(f"{int(mask.sum())} narratives cleaned; {still_dirty} still marked as dirty.")
+    log.loc["CleanedNarratives"] = int(mask.sum())
+    log.loc["TotalEdgeCases"] = data["EDGE_CASE"].sum(axis=0)
+    if compact:
+        data = compact_frame(data)
+    end_step(len(data), cleaned=int(mask.sum()))
+    return data, log
@@ -0,0 +1,319 @@
+import os
+import time
+import shutil
+import sqlite3
+import numpy as np
+import pandas as pd
+from extract_cache import narrative_hash
+from entity_index import drop_docs
+from spacy_nlp import write_entities
+from metrics import step, end_step
+
+
+def open_manifest(manifest_path:str="./manifest.sqlite")->(sqlite3.Connection):
+    """Opens (or creates) the manifest of processed narratives,
+    kept alongside the session directories. It holds:
+    - `narratives`: the hash of the narrative each ID was last
+      processed with, and the session that processed it.
+    - `runs`: every finished session, with its quantile cut points,
+      so a delta run can route rows like the session before it.
+    - `compactions`: entity tables merged by `compact_entities`,
+      with the finish time of the last session merged into each.
+
+    Args:
+    manifest_path (str): path to the SQLite manifest file
+
+    Returns:
+    conn (sqlite3.Connection): connection to the manifest
+    """
+    manifest_dir = os.path.dirname(manifest_path)
+    if manifest_dir and not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    conn = sqlite3.connect(manifest_path)
+    conn.execute("""CREATE TABLE IF NOT EXISTS narratives (
+                        id TEXT PRIMARY KEY,
+                        hash TEXT NOT NULL,
+                        session TEXT NOT NULL)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS runs (
+                        session TEXT PRIMARY KEY,
+                        path TEXT NOT NULL,
+                        quants TEXT,
+                        new INTEGER NOT NULL,
+                        changed INTEGER NOT NULL,
+                        entities INTEGER NOT NULL,
+                        finished REAL NOT NULL)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS compactions (
+                        path TEXT PRIMARY KEY,
+                        upto REAL NOT NULL)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS hash_idx ON narratives (hash)")
+    conn.commit()
+    return conn
+
+
+def previous_run(manifest_path:str="./manifest.sqlite")->(dict):
+    """The last finished session in the manifest, or None if no
+    session has finished yet.
+
+    Args:
+    manifest_path (str): path to the SQLite manifest file
+
+    Returns:
+    run (dict): `session`, `path`, `quants`, `new`, `changed`,
+                `entities` and `finished` of the session
+    """
+    conn = open_manifest(manifest_path)
+    runs = pd.read_sql_query("SELECT * FROM runs ORDER BY finished DESC LIMIT 1", conn)
+    conn.close()
+    if len(runs) == 0:
+        return None
+    return runs.iloc[0].to_dict()
+
+
+def select_delta(data:pd.DataFrame, narr_col:str, log:pd.DataFrame,
+                 manifest_path:str="./manifest.sqlite",
+                 id_col:str="ID")->(pd.DataFrame, pd.DataFrame):
+    """
+    Selects the rows of an export that were not processed before.
+    [1] Hashes each narrative (`narrative_hash`); missing narratives
+        are hashed as `0`, as they are imputed by `transform_data`.
+    [2] Looks up only the IDs and hashes of this export in the
+        manifest, so the lookup grows with the export, not with
+        the history of the manifest.
+    [3] Gives each row a `DELTA` status:
+        - `new`: the ID was never processed.
+        - `changed`: the ID was processed with another narrative.
+        - `duplicate`: new or changed, but the narrative was already
+          processed under another ID; a full run would drop it as a
+          narrative duplicate, so it is recorded but not extracted.
+        - `unchanged`: processed before with the same narrative.
+    [4] Flags `DELTA_REPLACED` rows: IDs processed before with another
+        narrative, whether `changed` or `duplicate`. Their earlier
+        entities are stale, even if the new narrative is not extracted.
+    IDs in the manifest that are missing from the export are kept,
+    since nightly exports may only hold the day's complaints.
+
+    Args:
+    data (pd.DataFrame): export, as read by `read_export`
+    narr_col (str): column containing narrative text
+    log (pd.DataFrame): session log
+    manifest_path (str): path to the SQLite manifest file
+    id_col (str): column containing the narrative ID
+
+    Returns:
+    data (pd.DataFrame): export with `DELTA_HASH`, `DELTA` and
+                         `DELTA_REPLACED` columns
+    log (pd.DataFrame): session log
+    """
+    print("[JOB D.1] Select New and Changed Narratives")
+    step("D.1", len(data))
+    # [1] Hash narratives
+    ids = data[id_col].astype(str)
+    hashes = data[narr_col].fillna("0").map(narrative_hash)
+
+    # [2] Look up this export in the manifest
+    conn = open_manifest(manifest_path)
+    conn.execute("CREATE TEMP TABLE export (id TEXT, hash TEXT)")
+    conn.executemany("INSERT INTO export VALUES (?, ?)", zip(ids, hashes))
+    known = dict(conn.execute("""SELECT n.id, n.hash FROM narratives n
+                                 JOIN (SELECT DISTINCT id FROM export) e
+                                 ON n.id = e.id"""))
+    seen = {row[0] for row in conn.execute("""SELECT DISTINCT e.hash FROM export e
+                                              JOIN narratives n ON n.hash = e.hash""")}
+    conn.close()
+
+    # [3] Classify rows
+    previous = ids.map(known)
+    status = np.select([previous.isna(), previous == hashes],
+                       ["new", "unchanged"], "changed").astype(object)
+    status[(status != "unchanged") & hashes.isin(seen).to_numpy()] = "duplicate"
+    data["DELTA_HASH"] = hashes.to_numpy()
+    data["DELTA"] = status
+    # [4] Flag IDs whose earlier entities are stale
+    data["DELTA_REPLACED"] = (previous.notna() & (previous != hashes)).to_numpy()
+
+    counts = data["DELTA"].value_counts()
+    for key in ["new", "changed", "duplicate", "unchanged"]:
+        print(f"[*] {counts.get(key, 0)} {key.capitalize()} Narratives.")
+        log.loc[f"Delta {key.capitalize()}"] = int(counts.get(key, 0))
+    log.loc["Manifest"] = manifest_path
+    end_step(int((data["DELTA"] != "unchanged").sum()))
+    return data, log
+
+
+def retire_entities(replaced:list, session_path:str,
+                    index_path:str="./index/entities.sqlite")->(int):
+    """
+    Retires the entities of `replaced` IDs, i.e. narratives that
+    were edited since they were extracted. Their entity tables are
+    not rewritten: each session keeps only the entities it extracted,
+    and the manifest records the session that last processed each
+    ID, which `current_entities` reads to skip stale rows. Only the
+    entity index, which lookups read directly, is updated.
+
+    Args:
+    replaced (list): IDs processed before with another narrative,
+                     see `DELTA_REPLACED` in `select_delta`
+    session_path (str): session directory of the delta run
+    index_path (str): path to the entity index, or None to skip it
+
+    Returns:
+    (int): number of mentions removed from the index
+    """
+    print("[JOB D.2] Retire Entities of Edited Narratives")
+    step("D.2", len(replaced))
+    removed = 0
+    if index_path is not None and len(replaced) > 0:
+        removed = drop_docs(replaced, session_path, index_path)
+    end_step(removed)
+    return removed
+
+
+def last_compaction(conn:sqlite3.Connection)->(tuple):
+    """The path of the latest compacted entity table and the finish
+    time of the last session merged into it, or `(None, 0.0)`."""
+    row = conn.execute("""SELECT path, upto FROM compactions
+                          ORDER BY upto DESC LIMIT 1""").fetchone()
+    return (None, 0.0) if row is None else row
+
+
+def current_entities(manifest_path:str="./manifest.sqlite")->(pd.DataFrame):
+    """
+    Builds the entity table of every narrative processed so far.
+    A delta session only saves the entities of its own rows, so
+    nightly runs do not rewrite the tables of earlier sessions; the
+    cost of combining them is paid here, when the full table is
+    needed. Only the sessions since the last `compact_entities` are
+    read, so the cost grows with the runs since then, not with the
+    whole history.
+    [1] Reads the session that last processed each ID.
+    [2] Reads the last compacted table, keeping the rows of IDs
+        no later session has processed again.
+    [3] Reads the entity table (`entities/`) of each later session,
+        keeping only the rows of IDs that session still owns.
+    [TIP] Save the table with `write_entities` (spacy_nlp.py).
+
+    Args:
+    manifest_path (str): path to the SQLite manifest file
+
+    Returns:
+    entities (pd.DataFrame): table of entity extracts
+    """
+    # [1] Owner session of each ID
+    conn = open_manifest(manifest_path)
+    compacted, upto = last_compaction(conn)
+    runs = pd.read_sql_query("""SELECT session, path FROM runs WHERE finished > ?
+                                ORDER BY finished""", conn, params=(upto,))
+    owners = dict(conn.execute("SELECT id, session FROM narratives"))
+    conn.close()
+
+    # [2] Entities of the last compaction, unless owned by a later session
+    tables, later = [], set(runs["session"])
+    if compacted is not None:
+        table = pd.read_parquet(f"{compacted}/entities")
+        table["label"] = table["label"].astype(str)
+        tables.append(table.loc[~table["ID"].astype(str).map(owners).isin(later)])
+
+    # [3] Entities each later session still owns
+    for session, path in zip(runs["session"], runs["path"]):
+        table_path = f"{path}/entities"
+        if not os.path.exists(table_path):
+            continue
+        table = pd.read_parquet(table_path)
+        table["label"] = table["label"].astype(str)
+        tables.append(table.loc[table["ID"].astype(str).map(owners) == session])
+    tables = [table for table in tables if len(table) > 0] or tables[:1]
+    if not tables:
+        return pd.DataFrame(columns=["ID", "label", "ent_id", "text", "start", "end"])
+    return pd.concat(tables, ignore_index=True)
+
+
+def pending_runs(manifest_path:str="./manifest.sqlite")->(int):
+    """Number of sessions finished since the last compaction."""
+    conn = open_manifest(manifest_path)
+    upto = last_compaction(conn)[1]
+    pending = conn.execute("SELECT COUNT(*) FROM runs WHERE finished > ?",
+                           (upto,)).fetchone()[0]
+    conn.close()
+    return pending
+
+
+def compact_entities(manifest_path:str="./manifest.sqlite",
+                     compact_dir:str=None)->(str):
+    """
+    Saves the current entity table (`current_entities`) and records
+    it in the manifest, so later calls start from it instead of
+    reading every session again.
+    [1] The table is written to a new directory, named after the
+        finish time of the last session merged into it; an
+        interrupted compaction leaves the last one in use.
+    [2] Once it is recorded, earlier compactions are removed.
+
+    Args:
+    manifest_path (str): path to the SQLite manifest file
+    compact_dir (str): directory for compacted tables; defaults to
+                       `current/` next to the manifest
+
+    Returns:
+    compact_path (str): directory of the compacted table
+    """
+    if compact_dir is None:
+        compact_dir = os.path.join(os.path.dirname(manifest_path) or ".", "current")
+    conn = open_manifest(manifest_path)
+    upto = conn.execute("SELECT MAX(finished) FROM runs").fetchone()[0]
+    conn.close()
+    if upto is None:
+        return None
+    entities = current_entities(manifest_path)
+    # [1] Write the compacted table
+    compact_path = os.path.abspath(os.path.join(compact_dir, f"upto_{upto:.6f}"))
+    write_entities(entities, [], compact_path, json_view=False)
+
+    # [2] Record it and remove earlier compactions
+    conn = open_manifest(manifest_path)
+    with conn:
+        earlier = [row[0] for row in conn.execute(
+                       "SELECT path FROM compactions WHERE path != ?", (compact_path,))]
+        conn.execute("DELETE FROM compactions")
+        conn.execute("INSERT INTO compactions VALUES (?, ?)", (compact_path, upto))
+    conn.close()
+    for path in earlier:
+        shutil.rmtree(path, ignore_errors=True)
+    print(f"[*] {len(entities)} current entities compacted to: {compact_path}")
+    return compact_path
+
+
+def record_run(data:pd.DataFrame, session_path:str, quants_path:str,
+               entities:int, manifest_path:str="./manifest.sqlite",
+               id_col:str="ID")->(int):
+    """Records a finished session in the manifest: the ID and hash
+    of every row it processed, and the session itself. Both are
+    written in one transaction, after the entity tables are saved,
+    so an interrupted run is simply processed again by the next one.
+
+    Args:
+    data (pd.DataFrame): export with `DELTA_HASH` and `DELTA` columns,
+                         see `select_delta`
+    session_path (str): session directory of the run
+    quants_path (str): path to the session's frozen cut points
+    entities (int): number of entities the session extracted
+    manifest_path (str): path to the SQLite manifest file
+    id_col (str): column containing the narrative ID
+
+    Returns:
+    (int): number of narratives recorded
+    """
+    session = os.path.normpath(session_path)
+    processed = data.loc[data["DELTA"] != "unchanged"]
+    counts = processed["DELTA"].value_counts()
+    rows = zip(processed[id_col].astype(str), processed["DELTA_HASH"],
+               [session] * len(processed))
+    conn = open_manifest(manifest_path)
+    with conn:
+        conn.executemany("INSERT OR REPLACE INTO narratives VALUES (?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     (session, os.path.abspath(session_path), quants_path,
+                      int(counts.get("new", 0)), int(counts.get("changed", 0)),
+                      int(entities), time.time()))
+    conn.close()
+    print(f"[*] {len(processed)} narratives of session {session} recorded: {manifest_path}")
+    return len(processed)
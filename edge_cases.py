@@ -6,6 +6,13 @@ import os
 import pandas as pd
 import numpy as np
 import re
+from metrics import step, end_step
+from transform import as_text, is_compact, compact_frame
+# `display` is only a builtin in notebooks; fall back to `print` headless
+try:
+    from IPython.display import display
+except ImportError:
+    display = print
 
 
 def detect_short_narrs(data:pd.DataFrame, thresh:int, 
@@ -27,6 +34,7 @@ def detect_short_narrs(data:pd.DataFrame, thresh:int,
     """
     print("-"*72)    
     print(f"[JOB 2.1] Detect Short Narratives")
+    step("2.1", len(data))
     data["SHORT"] = np.where(data["narr_length"] < thresh, 1, 0)
     mask = data["SHORT"] == 1
     print(f"{len(data[mask])} narratives with length < 100.")
@@ -34,6 +42,57 @@ def detect_short_narrs(data:pd.DataFrame, thresh:int,
     return data, log
 
 
+# Dirty data signatures, scanned column-wise by `dirty_flags`. The
+# patterns avoid lookarounds, which Arrow's regex engine (RE2) lacks.
+DIRTY_SIGNATURES = {
+    "IMG": r"<img alt=",
+    "HTML": r"<(?:\"[^\"]*\"['\"]*|'[^']*'['\"]*|[^'\">])+>",
+    "FORM_1": r"\*+",
+}
+# Every signature starts with one of these characters
+DIRTY_PREFIXES = "<*"
+DIRTY_BITS = {name: 1 << n for n, name in enumerate(DIRTY_SIGNATURES)}
+DIRTY_PREFIX_PATTERN = f"[{re.escape(DIRTY_PREFIXES)}]"
+
+
+def dirty_flags(texts:pd.Series)->(np.ndarray):
+    """
+    Scans a column of narratives for every dirty data signature
+    and returns a bitmask per row, with one bit per category
+    (`DIRTY_BITS`). Each scan is one vectorized `str.contains`
+    over the column; compact (Arrow) text is scanned by Arrow,
+    without a Python object per row.
+    [1] One pass finds the narratives with a `DIRTY_PREFIXES`
+        character; clean narratives never reach the signatures.
+    [2] One pass per signature over those narratives.
+    [TIP] A single combined pattern cannot report signatures that
+        overlap (a `*` inside a tag) without one lazy lookahead per
+        signature, and that scan is 2-3x slower than [2], also on
+        object (Python `re`) columns.
+    
+    Args
+    texts (pd.Series): narrative text
+    
+    Returns
+    flags (np.ndarray): uint8 bitmask of dirty data categories found
+    """
+    texts = as_text(texts)
+    flags = np.zeros(len(texts), dtype=np.uint8)
+    # [1] Narratives that may hold a signature
+    candidates = texts.str.contains(DIRTY_PREFIX_PATTERN, regex=True)
+    candidates = candidates.to_numpy(dtype=bool, na_value=False)
+    if not candidates.any():
+        return flags
+    # [2] Signatures, on the candidates only
+    texts, found = texts[candidates], np.zeros(int(candidates.sum()), dtype=np.uint8)
+    for name, pattern in DIRTY_SIGNATURES.items():
+        matched = texts.str.contains(pattern, regex=True)
+        found |= np.where(matched.to_numpy(dtype=bool, na_value=False),
+                          DIRTY_BITS[name], 0).astype(np.uint8)
+    flags[candidates] = found
+    return flags
+
+
 def detect_dirty_data(data:pd.DataFrame, 
     log:pd.DataFrame)->(pd.DataFrame, pd.DataFrame):
     """    [JOB 2.2 Detect Dirty Data]
@@ -42,12 +101,12 @@ def detect_dirty_data(data:pd.DataFrame,
     incompatible with the entity recognizer.
     
     [1] Convert text to lower case.
-    [2] Detect HTML; create `HTML` indicator.
-    [3] Detect image tags; create `IMG` indicator.
-    [4] Detect website form; create `FORM_1`.
-    [5] Creates an indicator for `HTML`, `IMG` and
+    [2] Scan the narratives for HTML, image tags and website
+        forms, one vectorized pass per signature (`dirty_flags`).
+        Creates `DIRTY_FLAGS`, a bitmask of the categories found.
+    [3] Creates an indicator for `HTML`, `IMG` and
         `FORM_1` to identify each edge case.
-    [6] Creates the column `DIRTY` to indicate any
+    [4] Creates the column `DIRTY` to indicate any
         row with any of those three indicators.
     
     Args
@@ -61,57 +120,188 @@ def detect_dirty_data(data:pd.DataFrame,
     """
     print("-"*72)    
     print(f"[JOB 2.2] Detect Dirty Data")  
-    data["narratives"] = data["narratives"].apply(
-                        lambda x: (str(x).lower()
-                        ).replace("   ", " ").strip())
-
-    html_pattern = r"<(?:\"[^\"]*\"['\"]*|'[^']*'['\"]*|[^'\">])+>"
-    data["DETECT_HTML"] = data["narratives"].apply(
-                        lambda x: [n for n in re.findall(html_pattern, 
-                                str(x)) if len(n) > 0] if x else False)
-    data["HTML"] = data["DETECT_HTML"].apply(
-                        lambda x: 1 if len(x) > 0 else 0)
-
-    img_pattern = r"<img alt="
-    data["DETECT_IMG"] = data["narratives"].apply(
-                        lambda x: [n for n in re.findall(img_pattern, 
-                                str(x)) if len(n) > 0] if x else False)
-    data["IMG"] = data["DETECT_IMG"].apply(
-                        lambda x: 1 if len(x) > 0 else 0)
-
-    form_pattern = r"\**"
-    data["DETECT_FORM_1"] = data["narratives"].apply(
-                        lambda x: [n for n in re.findall(form_pattern, 
-                                str(x)) if len(n) > 0] if x else False)
-    data["FORM_1"] = data["DETECT_FORM_1"].apply(
-                        lambda x: 1 if len(x) > 0 else 0)
-    
-    data["DIRTY"] = data[["HTML", "IMG", "FORM_1"]].sum(axis=1)
+    step("2.2", len(data))
+    data["narratives"] = (as_text(data["narratives"]).str.lower()
+                        .str.replace("   ", " ", regex=False).str.strip())
+
+    flags = dirty_flags(data["narratives"])
+    data["DIRTY_FLAGS"] = flags
+    dirty_indicators = ["HTML", "IMG", "FORM_1"]
+    for indicator in dirty_indicators:
+        data[indicator] = (flags & DIRTY_BITS[indicator] > 0).astype(np.uint8)
+    
+    data["DIRTY"] = (flags > 0).astype(np.uint8)
     mask = data["DIRTY"] > 0
     dirty_data = data[mask]
     print(f"{len(dirty_data)} narrative marked as dirty data.")
     
-    dirty_indicators = ["HTML", "IMG", "FORM_1"]
-    dirty_data.loc["TOTAL_DIRTY_BY_TYPE"] = data[["HTML", "IMG", "FORM_1"]].sum(axis=0)
     print("Total Rows Marked as `DIRTY` by Type:")
-    display(dirty_data.loc["TOTAL_DIRTY_BY_TYPE", 
-                           ["HTML", "IMG", "FORM_1"]].astype(int))
+    display(data[dirty_indicators].sum(axis=0).astype(int))
     return data, log
 
 
+def shingle_hashes(texts:pd.Series, width:int, k:int)->(np.ndarray):
+    """
+    Hashes every `k` character shingle of each text into a uint64
+    array of shape (len(texts), width - k + 1). Texts are read as
+    fixed-width arrays of code points, so no Python loop runs per row.
+    Shingles that would fall past the end of a short text repeat the
+    first shingle, which leaves the minimum hash unchanged.
+    
+    Args
+    texts (pd.Series): texts of at most `width` characters
+    width (int): maximum number of characters per text
+    k (int): number of characters per shingle
+    
+    Returns
+    hashes (np.ndarray): shingle hashes, one row per text
+    """
+    codes = np.array(texts.tolist(), dtype=f"U{width}")
+    codes = codes.view(np.uint32).reshape(len(texts), width).astype(np.uint64)
+    n_shingles = width - k + 1
+    hashes = np.zeros((len(texts), n_shingles), dtype=np.uint64)
+    for j in range(k):
+        hashes = hashes * np.uint64(1000003) + codes[:, j:j+n_shingles]
+    valid = np.maximum(texts.str.len().to_numpy(dtype=np.int64) - k + 1, 1)
+    padding = np.arange(n_shingles)[None, :] >= valid[:, None]
+    return np.where(padding, hashes[:, :1], hashes)
+
+
+def minhash_signatures(texts:pd.Series, width:int=60, k:int=5, 
+    num_perm:int=64, block:int=50000, seed:int=0)->(np.ndarray):
+    """
+    Computes MinHash signatures of the character shingles of each text.
+    Texts are processed `block` rows at a time to bound memory.
+    
+    Args
+    texts (pd.Series): texts of at most `width` characters
+    width (int): maximum number of characters per text
+    k (int): number of characters per shingle
+    num_perm (int): number of hash permutations in each signature
+    block (int): number of texts hashed at a time
+    seed (int): seed for the hash permutations
+    
+    Returns
+    signatures (np.ndarray): uint64 array of shape (len(texts), num_perm)
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+    signatures = np.empty((len(texts), num_perm), dtype=np.uint64)
+    for start in range(0, len(texts), block):
+        hashes = shingle_hashes(texts.iloc[start:start+block], width, k)
+        for p in range(num_perm):
+            permuted = (hashes * a[p] + b[p]) >> np.uint64(16)
+            signatures[start:start+block, p] = permuted.min(axis=1)
+    return signatures
+
+
+def lsh_buckets(signatures:np.ndarray, bands:int)->(list):
+    """
+    Splits MinHash signatures into `bands` bands and hashes each band
+    to a bucket key. Texts that share a bucket in any band are
+    candidate near-duplicates.
+    
+    Args
+    signatures (np.ndarray): MinHash signatures, one row per text
+    bands (int): number of bands; must divide the signature length
+    
+    Returns
+    buckets (list): one array of uint64 bucket keys per band
+    """
+    rows = signatures.shape[1] // bands
+    buckets = []
+    for band in range(bands):
+        key = np.full(len(signatures), band, dtype=np.uint64)
+        for value in signatures[:, band*rows:(band+1)*rows].T:
+            key = key * np.uint64(1000003) ^ value
+        buckets.append(key)
+    return buckets
+
+
+def cluster_buckets(buckets:list, n:int)->(np.ndarray):
+    """
+    Assigns a cluster ID to each text so that texts sharing a
+    bucket in any band end up in the same cluster. The connected
+    components are found with union-find: each text is joined to
+    the first text of its bucket, in one pass per band, so long
+    chains of near-duplicates cost no extra passes.
+    
+    Args
+    buckets (list): arrays of bucket keys, one per band
+    n (int): number of texts
+    
+    Returns
+    clusters (np.ndarray): cluster IDs numbered from 0
+    """
+    parent = list(range(n))
+    def find(x):
+        root = x
+        while parent[root] != root:
+            root = parent[root]
+        while parent[x] != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    positions = np.arange(n)
+    for key in buckets:
+        first = pd.Series(positions).groupby(key).transform("min").to_numpy()
+        linked = np.flatnonzero(first != positions)
+        for a, b in zip(first[linked].tolist(), linked.tolist()):
+            a, b = find(a), find(b)
+            # the smallest position is the root, as clusters are numbered by it
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+    labels = positions.copy()
+    for x in np.flatnonzero(np.array(parent, dtype=np.int64) != positions).tolist():
+        labels[x] = find(x)
+    return pd.factorize(labels)[0]
+
+
+def cluster_texts(texts:pd.Series, width:int, k:int, num_perm:int,
+    bands:int)->(np.ndarray):
+    """
+    Clusters near-identical texts with MinHash and LSH. Exact copies
+    are collapsed first, so each distinct text is hashed only once.
+    
+    Args
+    texts (pd.Series): texts of at most `width` characters
+    width (int): maximum number of characters per text
+    k (int): number of characters per shingle
+    num_perm (int): number of hash permutations in each signature
+    bands (int): number of LSH bands
+    
+    Returns
+    clusters (np.ndarray): cluster ID of each text
+    """
+    codes, uniques = pd.factorize(texts)
+    signatures = minhash_signatures(pd.Series(uniques, dtype=object), 
+                                    width, k, num_perm)
+    buckets = lsh_buckets(signatures, bands)
+    return cluster_buckets(buckets, len(uniques))[codes]
+
+
 def detect_repeat_sources(data:pd.DataFrame, thresh:int, 
-    log:pd.DataFrame)->(pd.DataFrame, pd.DataFrame):
+    log:pd.DataFrame, width:int=60, k:int=5, num_perm:int=64,
+    bands:int=8)->(pd.DataFrame, pd.DataFrame):
     """       [JOB 2.3: Detect Repeat Sources]
     Uses the first 60 characters and the last 60 characters to
     identify "repeat sources" that have signatures, etc that can be 
     removed to improve processing performance and accuracy. 
+    Salutations and signatures are compared with MinHash and
+    locality sensitive hashing (LSH), so near-identical text is
+    matched as well as exact copies, in roughly linear time.
     
     [TIP] It can help you create a log of complaintants to exclude.
     
-    [1] Check the first sixty characters of each narrative for the
-        same salutation. Creates an an indicator.
-    [2] Check the last sixty characters of each narrative for the
-        same signature. Creates an an indicator.
+    [1] Shingle and MinHash the first sixty characters of each
+        narrative. Narratives sharing an LSH bucket have a similar
+        salutation and get the same `SRC_CLUSTER_1` cluster ID. 
+        Creates an an indicator for all but the first in a cluster.
+    [2] Shingle and MinHash the last sixty characters of each
+        narrative. Narratives sharing an LSH bucket have a similar
+        signature and get the same `SRC_CLUSTER_2` cluster ID. 
+        Creates an an indicator for all but the first in a cluster.
     [3] Creates an indicator, `SAME_SRC` that indicates if either 
         `SAME_SRC_1` or `SAME_SRC_2` is indicated.
         
@@ -119,6 +309,10 @@ def detect_repeat_sources(data:pd.DataFrame, thresh:int,
     data (pd.DataFrame): dataframe of narratives
     thresh (int): character threshold for `SHORT` narratives.
     log (pd.DataFrame): session log
+    width (int): number of characters compared at each end
+    k (int): number of characters per shingle
+    num_perm (int): number of hash permutations in each signature
+    bands (int): number of LSH bands; more bands match less similar text
     
     Returns
     data (pd.DataFrame): modified dataframe of narratives,
@@ -127,24 +321,33 @@ def detect_repeat_sources(data:pd.DataFrame, thresh:int,
     """
     print("-"*72)    
     print(f"[JOB 2.3] Detect Repeat Sources") 
+    step("2.3", len(data))
+    narratives = as_text(data["narratives"])
+    
     # check the first 60 characters
-    data["FIRST_60"] = data["narratives"].apply(
-                lambda x: str(x).lower()[:60])
-    data["SAME_SRC_1"] = data["FIRST_60"].duplicated()
+    data["SRC_CLUSTER_1"] = cluster_texts(narratives.str[:width].str.lower(), 
+                                          width, k, num_perm, bands)
+    data["SAME_SRC_1"] = data["SRC_CLUSTER_1"].duplicated()
     
     # check the last 60 characters
-    data["LAST_60"] = data["narratives"].apply(
-                lambda x: str(x).lower()[-60:])
-    data["SAME_SRC_2"] = data["LAST_60"].duplicated()
+    data["SRC_CLUSTER_2"] = cluster_texts(narratives.str[-width:].str.lower(), 
+                                          width, k, num_perm, bands)
+    data["SAME_SRC_2"] = data["SRC_CLUSTER_2"].duplicated()
     
     same1, same2 = data["SAME_SRC_1"].sum(), data["SAME_SRC_2"].sum()
-    data["SAME_SRC"] = data["SAME_SRC_1"] + data["SAME_SRC_2"]
+    data["SAME_SRC"] = data["SAME_SRC_1"] | data["SAME_SRC_2"]
     mask = data["SAME_SRC"] == True
     same_source = data.copy()[mask]
+    n_clusters_1 = data.loc[data["SAME_SRC_1"], "SRC_CLUSTER_1"].nunique()
+    n_clusters_2 = data.loc[data["SAME_SRC_2"], "SRC_CLUSTER_2"].nunique()
     
     print(f"Same Source 1 (detected by salutation): {same1}")
     print(f"Same Source 2 (detected by signature): {same2}")
     print(f"{len(same_source)} total narratives marked as repeat sources.")
+    print(f"{n_clusters_1} salutation clusters and {n_clusters_2} "
+          "signature clusters with repeat sources.")
+    log.loc["SalutationClusters"] = n_clusters_1
+    log.loc["SignatureClusters"] = n_clusters_2
     return data, log
 
 
@@ -181,5 +384,31 @@ def EdgeCaseDetector(data:pd.DataFrame,
         
     print("")
     print(f"[!] {int(TOTAL_EDGE_CASES)} Total Edge Cases Detected.")
+    if is_compact(data):
+        data = compact_frame(data)
+    end_step(len(data))
+    return data, log
+
+
+def EdgeCaseDetectorChunked(chunks, log:pd.DataFrame):
+    """      [JOB 2 Identify Edge Cases, in chunks]
+    Applies `EdgeCaseDetector` to each chunk yielded by
+    `transform_data_chunked`, so edge cases are detected while
+    later chunks are still being read.
+
+    [TIP] Repeat sources are only compared within a chunk.
     
-    return data, log
\ No newline at end of file
+    Args
+    chunks (iterable): chunks of narratives, as pandas dataframes
+    log (pd.DataFrame): session log
+    
+    Yields
+    chunk (pd.DataFrame): modified chunk of narratives,
+                          with indicators for edge cases
+    """
+    TOTAL_EDGE_CASES = 0
+    for chunk in chunks:
+        chunk, log = EdgeCaseDetector(chunk, log)
+        TOTAL_EDGE_CASES += int(chunk["EDGE_CASE"].sum())
+        log.loc["TotalEdgeCases"] = TOTAL_EDGE_CASES
+        yield chunk
\ No newline at end of file
@@ -0,0 +1,252 @@
+import os
+import re
+import sys
+import time
+import sqlite3
+import argparse
+import pandas as pd
+
+# Characters trimmed from the ends of an entity before it is indexed
+PUNCTUATION = " .,;:!?'\"()[]{}<>"
+SEPARATORS = re.compile(r"[\s\-.()/+]+")
+
+
+def normalize_entity(text:str)->(str):
+    """Normalizes entity text for the index, so the same phone,
+    EIN or name is found however it was written.
+    [1] Lower case, with runs of whitespace collapsed.
+    [2] Numbers written with separators only (phones, EINs, SSNs,
+        account numbers) are reduced to their digits, e.g.
+        `(555) 123-4567` and `555.123.4567` -> `5551234567`.
+    [3] Otherwise, punctuation is trimmed from both ends.
+
+    Args:
+    text (str): entity text
+
+    Returns:
+    (str): normalized text
+    """
+    text = " ".join(str(text).lower().split())
+    digits = SEPARATORS.sub("", text)
+    if len(digits) >= 7 and digits.isdigit():
+        return digits
+    return text.strip(PUNCTUATION)
+
+
+def session_key(session_path:str)->(str):
+    """Key of a session in the index: its absolute path, so a
+    session is found under one key however its path was written,
+    e.g. `20211001_120000` from the pipeline or an absolute path
+    given to `index_sessions`."""
+    return os.path.abspath(session_path)
+
+
+def open_index(index_path:str="./index/entities.sqlite")->(sqlite3.Connection):
+    """Opens (or creates) the entity index, an inverted index from
+    normalized entity text and label to the narratives, sessions
+    and character offsets where the entity was extracted.
+    The index uses write-ahead logging, so it can be queried
+    while an extraction run is updating it.
+
+    Args:
+    index_path (str): path to the SQLite index file
+
+    Returns:
+    conn (sqlite3.Connection): connection to the index
+    """
+    index_dir = os.path.dirname(index_path)
+    if index_dir and not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    conn = sqlite3.connect(index_path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS mentions (
+                        norm TEXT NOT NULL,
+                        label TEXT NOT NULL,
+                        doc_id TEXT NOT NULL,
+                        session TEXT NOT NULL,
+                        text TEXT NOT NULL,
+                        start INTEGER NOT NULL,
+                        end INTEGER NOT NULL,
+                        raw_start INTEGER,
+                        raw_end INTEGER)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS sessions (
+                        session TEXT PRIMARY KEY,
+                        path TEXT NOT NULL,
+                        mentions INTEGER NOT NULL,
+                        indexed REAL NOT NULL)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS norm_idx ON mentions (norm, label)")
+    conn.execute("CREATE INDEX IF NOT EXISTS doc_idx ON mentions (doc_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS session_idx ON mentions (session)")
+    conn.commit()
+    return conn
+
+
+def index_entities(entities:pd.DataFrame, session_path:str,
+                   index_path:str="./index/entities.sqlite")->(int):
+    """Adds the entity table of a session to the entity index.
+    Entries of the session from an earlier run (e.g. before a
+    resume) are replaced, so indexing a session twice is safe;
+    other sessions are not touched.
+
+    Args:
+    entities (pd.DataFrame): entity table from `save_extracts`
+    session_path (str): session directory the entities belong to
+    index_path (str): path to the SQLite index file
+
+    Returns:
+    (int): number of mentions indexed
+    """
+    session = session_key(session_path)
+    raw = [[None if pd.isna(x) else int(x) for x in entities[col]]
+           if col in entities.columns else [None] * len(entities)
+           for col in ["raw_start", "raw_end"]]
+    rows = zip(entities["text"].map(normalize_entity), entities["label"],
+               entities["ID"].astype(str), [session] * len(entities), entities["text"],
+               entities["start"].tolist(), entities["end"].tolist(), *raw)
+    conn = open_index(index_path)
+    with conn:
+        conn.execute("DELETE FROM mentions WHERE session = ?", (session,))
+        conn.executemany("INSERT INTO mentions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        conn.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)",
+                     (session, session_path, len(entities), time.time()))
+    conn.close()
+    print(f"[*] {len(entities)} entities of session {session} indexed: {index_path}")
+    return len(entities)
+
+
+def drop_docs(doc_ids, session_path:str=None,
+              index_path:str="./index/entities.sqlite")->(int):
+    """Removes the mentions of narratives from the index, e.g. the
+    stale entities of narratives that were edited and extracted
+    again. Mentions indexed under `session_path` are kept.
+
+    Args:
+    doc_ids: narrative IDs
+    session_path (str): session whose mentions are kept, or None
+    index_path (str): path to the SQLite index file
+
+    Returns:
+    (int): number of mentions removed
+    """
+    keep = "" if session_path is None else session_key(session_path)
+    conn = open_index(index_path)
+    with conn:
+        conn.execute("CREATE TEMP TABLE dropped (doc_id TEXT PRIMARY KEY)")
+        conn.executemany("INSERT OR IGNORE INTO dropped VALUES (?)",
+                         ((str(doc_id),) for doc_id in doc_ids))
+        removed = conn.execute("""DELETE FROM mentions WHERE session != ?
+                                  AND doc_id IN (SELECT doc_id FROM dropped)""",
+                               (keep,)).rowcount
+    conn.close()
+    print(f"[*] {removed} stale mentions removed from the index: {index_path}")
+    return removed
+
+
+def index_sessions(session_paths:list,
+                   index_path:str="./index/entities.sqlite")->(int):
+    """Adds earlier sessions to the entity index from the
+    entity tables (`entities/`) saved in each session directory.
+
+    Args:
+    session_paths (list): session directories
+    index_path (str): path to the SQLite index file
+
+    Returns:
+    total (int): number of mentions indexed
+    """
+    total = 0
+    for session_path in session_paths:
+        table_path = os.path.join(session_path, "entities")
+        if not os.path.exists(table_path):
+            print(f"[!] No entity table in session: {session_path}")
+            continue
+        entities = pd.read_parquet(table_path)
+        entities["label"] = entities["label"].astype(str)
+        total += index_entities(entities, session_path, index_path)
+    return total
+
+
+def lookup(text:str, label:str=None, prefix:bool=False,
+           index_path:str="./index/entities.sqlite")->(pd.DataFrame):
+    """Finds the narratives that mention an entity, across all
+    indexed sessions. `text` is normalized the same way as the
+    indexed entities (see `normalize_entity`).
+
+    Args:
+    text (str): entity to look up, e.g. a phone number or lender
+    label (str): only entities with this label, or None for any
+    prefix (bool): match entities starting with `text`
+    index_path (str): path to the SQLite index file
+
+    Returns:
+    mentions (pd.DataFrame): `ID`, `session`, `label`, `text`,
+                             `start`, `end`, `raw_start`, `raw_end`
+    """
+    norm = normalize_entity(text)
+    if prefix:
+        # a range on the (norm, label) index, instead of LIKE
+        where, params = "norm >= ? AND norm < ?", [norm, norm + "\uffff"]
+    else:
+        where, params = "norm = ?", [norm]
+    if label is not None:
+        where += " AND label = ?"
+        params.append(label)
+    conn = open_index(index_path)
+    mentions = pd.read_sql_query(
+        f"""SELECT doc_id AS ID, session, label, text, start, end, raw_start, raw_end
+            FROM mentions WHERE {where} ORDER BY session, doc_id, start""",
+        conn, params=params)
+    conn.close()
+    return mentions
+
+
+def doc_entities(doc_id, session:str=None,
+                 index_path:str="./index/entities.sqlite")->(pd.DataFrame):
+    """Lists the indexed entities of one narrative.
+
+    Args:
+    doc_id: narrative ID
+    session (str): only this session (its directory), or None for every session
+    index_path (str): path to the SQLite index file
+
+    Returns:
+    mentions (pd.DataFrame): `session`, `label`, `text`, `start`, `end`
+    """
+    where, params = "doc_id = ?", [str(doc_id)]
+    if session is not None:
+        where += " AND session = ?"
+        params.append(session_key(session))
+    conn = open_index(index_path)
+    mentions = pd.read_sql_query(
+        f"""SELECT session, label, text, start, end, raw_start, raw_end
+            FROM mentions WHERE {where} ORDER BY session, start""",
+        conn, params=params)
+    conn.close()
+    return mentions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Entity index across sessions.")
+    parser.add_argument("--index", default="./index/entities.sqlite",
+                        help="path to the SQLite index file")
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", help="index the entity tables of sessions")
+    add.add_argument("sessions", nargs="+", help="session directories")
+    query = commands.add_parser("query", help="find narratives mentioning an entity")
+    query.add_argument("text")
+    query.add_argument("--label")
+    query.add_argument("--prefix", action="store_true")
+    doc = commands.add_parser("doc", help="list the entities of a narrative")
+    doc.add_argument("doc_id")
+    doc.add_argument("--session")
+    args = parser.parse_args()
+
+    if args.command == "add":
+        index_sessions(args.sessions, args.index)
+        sys.exit()
+    if args.command == "query":
+        mentions = lookup(args.text, args.label, args.prefix, args.index)
+    else:
+        mentions = doc_entities(args.doc_id, args.session, args.index)
+    print(mentions.to_string(index=False))
+    print(f"[*] {len(mentions)} mentions found.")
@@ -0,0 +1,195 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import spacy
+
+
+def narrative_hash(text:str)->(str):
+    """Hashes a narrative for the extraction cache.
+    Entity offsets are relative to the exact text passed
+    to `nlp.pipe`, so the text is only normalized to a
+    string, not rewritten.
+
+    Args:
+    text (str): narrative text, as passed to the recognizer
+
+    Returns:
+    (str): hex digest of the narrative
+    """
+    return hashlib.sha1(str(text).encode("utf-8")).hexdigest()
+
+
+def model_fingerprint(model:str)->(str):
+    """Fingerprints a spaCy model and its patterns.
+    Small files (configs, meta, ruler patterns) are hashed by
+    content; large weight files by name, size and modified time.
+    Any change to the model or `patterns.jsonl` changes the
+    fingerprint, so extracts of the old model are no longer read.
+
+    Args:
+    model (str): path to custom spaCy model, package name,
+                 or a single pattern file
+
+    Returns:
+    (str): hex digest of the model
+    """
+    fingerprint = hashlib.sha1(spacy.about.__version__.encode("utf-8"))
+    if os.path.isfile(model):
+        with open(model, "rb") as f:
+            fingerprint.update(f.read())
+        return fingerprint.hexdigest()
+    model_dir = model
+    if not os.path.isdir(model_dir):
+        model_dir = str(spacy.util.get_package_path(model))
+    for root, dirs, files in sorted(os.walk(model_dir)):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            fingerprint.update(os.path.relpath(path, model_dir).encode("utf-8"))
+            if stat.st_size < 2**20:
+                with open(path, "rb") as f:
+                    fingerprint.update(f.read())
+            else:
+                fingerprint.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+def extract_fingerprint(model:str, mode:str="transformer",
+                        max_chars:int=None, overlap_chars:int=None)->(str):
+    """Fingerprints the extraction settings a cached extract
+    depends on: the model (`model_fingerprint`), the engine
+    `mode`, since the rules-only engine extracts fewer entities
+    than the full model, and the window settings of long
+    narratives, since windowed extracts can differ from whole
+    narrative extracts at the window edges. Extracts of each
+    setting are cached side by side, so switching does not
+    drop the cache.
+
+    Args:
+    model (str): path to custom spaCy model, package name,
+                 or a single pattern file
+    mode (str): "transformer" or "rules"
+    max_chars (int): window size of long narratives, or None
+    overlap_chars (int): overlap between consecutive windows
+
+    Returns:
+    (str): fingerprint for `cache_get` and `cache_put`
+    """
+    fingerprint = f"{model_fingerprint(model)}:{mode}"
+    if max_chars is not None:
+        fingerprint += f":windows={max_chars},{overlap_chars}"
+    return fingerprint
+
+
+def open_cache(cache_path:str)->(sqlite3.Connection):
+    """Opens (or creates) the on-disk extraction cache.
+    Extracts are keyed by narrative hash and fingerprint, so
+    models and modes can share one cache without invalidating
+    each other; entries of a fingerprint that is no longer used
+    are evicted as least recently used (see `evict_cache`).
+
+    Args:
+    cache_path (str): path to the SQLite cache file
+
+    Returns:
+    conn (sqlite3.Connection): connection to the cache
+    """
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    conn = sqlite3.connect(cache_path)
+    conn.execute("""CREATE TABLE IF NOT EXISTS extracts (
+                        hash TEXT NOT NULL,
+                        fingerprint TEXT NOT NULL,
+                        entities TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        accessed REAL NOT NULL,
+                        PRIMARY KEY (hash, fingerprint))""")
+    conn.execute("CREATE INDEX IF NOT EXISTS accessed_idx ON extracts (accessed)")
+    conn.commit()
+    return conn
+
+
+def cache_get(conn:sqlite3.Connection, fingerprint:str, hashes:list)->(dict):
+    """Looks up cached extracts and marks them as recently used.
+
+    Args:
+    conn (sqlite3.Connection): connection to the cache
+    fingerprint (str): fingerprint from `extract_fingerprint`
+    hashes (list): narrative hashes from `narrative_hash`
+
+    Returns:
+    cached (dict): narrative hash -> list of entity tuples
+    """
+    cached = {}
+    unique = list(set(hashes))
+    for start in range(0, len(unique), 500):
+        batch = unique[start:start+500]
+        rows = conn.execute(
+            f"""SELECT hash, entities FROM extracts
+                WHERE fingerprint = ? AND hash IN ({','.join('?'*len(batch))})""",
+            [fingerprint, *batch])
+        for key, entities in rows:
+            cached[key] = [tuple(ent) for ent in json.loads(entities)]
+    now = time.time()
+    conn.executemany("UPDATE extracts SET accessed = ? WHERE hash = ? AND fingerprint = ?",
+                     [(now, key, fingerprint) for key in cached])
+    conn.commit()
+    return cached
+
+
+def cache_put(conn:sqlite3.Connection, fingerprint:str, hashes:list,
+              extracts:list, max_mb:float=1024)->(None):
+    """Stores extracts in the cache, then evicts the least
+    recently used entries while the cache is over `max_mb`.
+
+    Args:
+    conn (sqlite3.Connection): connection to the cache
+    fingerprint (str): fingerprint from `extract_fingerprint`
+    hashes (list): narrative hashes from `narrative_hash`
+    extracts (list): list of entity tuples for each narrative
+    max_mb (float): maximum size of the cached extracts, in MB
+
+    Returns:
+    (None)
+    """
+    now = time.time()
+    rows = []
+    for key, ents in zip(hashes, extracts):
+        entities = json.dumps(ents)
+        rows.append((key, fingerprint, entities, len(entities), now))
+    conn.executemany("INSERT OR REPLACE INTO extracts VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    evict_cache(conn, max_mb)
+    return
+
+
+def evict_cache(conn:sqlite3.Connection, max_mb:float)->(int):
+    """Evicts least recently used extracts, of any fingerprint,
+    until the cached extracts take up at most `max_mb`.
+
+    Args:
+    conn (sqlite3.Connection): connection to the cache
+    max_mb (float): maximum size of the cached extracts, in MB
+
+    Returns:
+    evicted (int): number of evicted extracts
+    """
+    max_bytes = max_mb * 2**20
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM extracts").fetchone()[0]
+    if total <= max_bytes:
+        return 0
+    evict, freed = [], 0
+    for key, fingerprint, size in conn.execute(
+            "SELECT hash, fingerprint, size FROM extracts ORDER BY accessed"):
+        if total - freed <= max_bytes:
+            break
+        evict.append((key, fingerprint))
+        freed += size
+    conn.executemany("DELETE FROM extracts WHERE hash = ? AND fingerprint = ?", evict)
+    conn.commit()
+    print(f"[*] {len(evict)} extracts evicted from cache ({freed/2**20:.1f} MB).")
+    return len(evict)
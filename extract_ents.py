@@ -6,6 +6,8 @@ import os
 import sys
 from fileMgmt import *
 from spacyNLP import *
+from spacy_nlp import entity_recognizer, entity_table, extract_table
+from model_registry import model_labels
 
 if __name__ == "__main__":
     _time = datetime.now()
@@ -15,52 +17,36 @@ if __name__ == "__main__":
     print("[*] Collecting session meta data")
     inputPath, sessionPath, sessionLog = session_data(fileParams)
     
-    print("[*] Initializing document serialization...")
+    print("[*] Initializing document extraction...")
     data, sessionLog = unpack_data(fileParams, dataParams, sessionLog)
     data_ = data[dataRange[0]:dataRange[1]]
     _docs = [row for row in data_[smryCols[1]].fillna("0")]
  
-    docBinFile = serialize_nlp(_docs, sessionPath, option="2")
+    # entities are extracted inline; Docs are saved as a side output
+    docBinFile, extracts = entity_recognizer(_docs, sessionPath, 
+                                             model)
 
     endTime = datetime.now()
-    sessionLog["SerializationEndTime"] = endTime
+    sessionLog["ExtractionEndTime"] = endTime
     logFile = write_to_log(sessionPath, sessionLog)
     
     print(f"[*] End Time: {endTime}")
     time = pd.DataFrame()
     duration = (endTime -_time)
-    print(f"[*] Total Serialization Runtime: {duration}")
+    print(f"[*] Total Extraction Runtime: {duration}")
     
     
 if __name__ == "__main__":
     banner_("spaCy NLP - Entity Extraction")
-    print("[*] Reloading spaCy Model")
-    nlp = spacy.load(model)
-    doc_bin = DocBin().from_disk(docBinFile)
-    Docs = list(doc_bin.get_docs(nlp.vocab))
-
     print("[*] Collecting Entity Labels...")
-    cols = nlp.get_pipe("ner").labels
-    cols += nlp.get_pipe("entity_ruler").labels
-
-    def deserialize_nlp(docBinFile:str)->(list):
-        """Unpacks spaCy binaries."""
-        doc_bin = DocBin().from_disk(docBinFile)
-        print(f"[*] Deserializing {len(doc_bin)} docs..")
-        return list(doc_bin.get_docs(nlp.vocab))
-
-    # documents are unpacked
-    Docs = deserialize_nlp(docBinFile)
-
-    print("[*] Extracting Entities...")
-    extracts = extract_nlp(Docs)
+    labels = model_labels(model)
+    cols = labels["ner"] + labels["entity_ruler"]
 
-    # Extract table is created
+    # Extract table is created, with all entities of each label;
+    # extracts are keyed by the row index of `data_`
     print("[*] Creating Extract Table")
-    extractTable = pd.DataFrame()
-    for col in cols:
-        extractTable[col] = [[e for e in extract if e[0]==col] 
-                        for extract in extracts]
+    entities = entity_table(pd.DataFrame({"ID": data_.index, "entities": extracts}), cols)
+    extractTable = extract_table(entities, cols, data_.index, mode="all")
 
     print("[*] Linking extracts back to narratives...")
     summaries = data_[smryCols]
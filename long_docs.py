@@ -0,0 +1,128 @@
+import re
+import numpy as np
+
+# Sentence breaks: whitespace after end punctuation, or a line break
+SENT_BREAK = re.compile(r"(?<=[.!?])\s+|\s*\n\s*")
+
+
+def sentence_spans(text:str, max_chars:int)->(list):
+    """Splits a narrative into sentence `(start, end)` character spans.
+    Sentences longer than `max_chars` (e.g. run-on text with no
+    punctuation) are split again at the last space before the limit,
+    or at the limit if there is none.
+
+    Args:
+    text (str): narrative text
+    max_chars (int): maximum characters per span
+
+    Returns:
+    spans (list): `(start, end)` spans, in order
+    """
+    spans, start = [], 0
+    breaks = [(m.start(), m.end()) for m in SENT_BREAK.finditer(text)]
+    for end, next_start in breaks + [(len(text), len(text))]:
+        while end - start > max_chars:
+            cut = text.rfind(" ", start + 1, start + max_chars)
+            cut = cut if cut > start else start + max_chars
+            spans.append((start, cut))
+            start = cut + 1 if text[cut:cut+1] == " " else cut
+        if end > start:
+            spans.append((start, end))
+        start = next_start
+    return spans
+
+
+def make_windows(text:str, max_chars:int=2000,
+                 overlap_chars:int=300)->(list):
+    """Splits a long narrative into sentence-aligned windows of
+    at most `max_chars`. Each window starts with the trailing
+    sentences of the previous one, up to `overlap_chars`, and at
+    least its last sentence, so entities near a window edge are
+    also seen with context in the next window.
+    Narratives up to `max_chars` are a single window.
+
+    Args:
+    text (str): narrative text
+    max_chars (int): maximum characters per window
+    overlap_chars (int): characters shared by consecutive windows
+
+    Returns:
+    windows (list): `(start, end)` character spans of the windows
+    """
+    if len(text) <= max_chars:
+        return [(0, len(text))]
+    sents = sentence_spans(text, max_chars)
+    windows, i = [], 0
+    while i < len(sents):
+        j = i
+        while j + 1 < len(sents) and sents[j+1][1] - sents[i][0] <= max_chars:
+            j += 1
+        windows.append((sents[i][0], sents[j][1]))
+        if j == len(sents) - 1:
+            break
+        k = j
+        while k - 1 > i and sents[j][1] - sents[k-1][0] <= overlap_chars:
+            k -= 1
+        i = k if k > i else j + 1
+    return windows
+
+
+def window_corpus(texts:list, max_chars:int=2000,
+                  overlap_chars:int=300)->(list, np.ndarray, np.ndarray):
+    """Splits every narrative in a corpus into windows, see
+    `make_windows`, and flattens them so all windows can be
+    processed together in `nlp.pipe` batches.
+
+    Args:
+    texts (list): corpus of narratives
+    max_chars (int): maximum characters per window
+    overlap_chars (int): characters shared by consecutive windows
+
+    Returns:
+    windows (list): window texts
+    doc_index (np.ndarray): narrative index of each window
+    offsets (np.ndarray): character offset of each window
+                          in its narrative
+    """
+    windows, doc_index, offsets = [], [], []
+    for n, text in enumerate(texts):
+        text = str(text)
+        for start, end in make_windows(text, max_chars, overlap_chars):
+            windows.append(text[start:end])
+            doc_index.append(n)
+            offsets.append(start)
+    return windows, np.array(doc_index, dtype=np.int64), np.array(offsets, dtype=np.int64)
+
+
+def merge_windows(window_extracts:list, doc_index:np.ndarray,
+                  offsets:np.ndarray, n_docs:int)->(list):
+    """Maps window entity extracts back to their narratives.
+    [1] Character offsets are shifted by the window offset.
+    [2] The same entity found in two overlapping windows is kept once.
+    [3] If windows disagree on an entity's span in the overlap,
+        the longest span is kept, as in `spacy.util.filter_spans`.
+
+    Args:
+    window_extracts (list): entity tuples `(label, id, text, start, end)`
+                            for each window
+    doc_index (np.ndarray): narrative index of each window
+    offsets (np.ndarray): character offset of each window
+    n_docs (int): number of narratives
+
+    Returns:
+    extracts (list): entity tuples for each narrative
+    """
+    found = [dict() for n in range(n_docs)]
+    for ents, n, offset in zip(window_extracts, doc_index, offsets):
+        for label, ent_id, text, start, end in ents:
+            key = (label, int(start + offset), int(end + offset))
+            found[n].setdefault(key, (label, ent_id, text, *key[1:]))
+    extracts = []
+    for ents in found:
+        kept, taken = [], set()
+        for ent in sorted(ents.values(), key=lambda ent: (ent[3] - ent[4], ent[3])):
+            if not taken.intersection(range(ent[3], ent[4])):
+                kept.append(ent)
+                taken.update(range(ent[3], ent[4]))
+        extracts.append(sorted(kept, key=lambda ent: ent[3]))
+    return extracts
@@ -8,6 +8,8 @@ root_dir = "../../NarrativeExtraction/enhanced/"
 sys.path.append(root_dir)
 from fileMgmt import *
 from spacyNLP import *
+from spacy_nlp import entity_recognizer, entity_table, extract_table
+from model_registry import model_labels
 
 configFile = f"{root_dir}configs/extractConfig.json"
 smryCols = ["ID", "C_CASE_SUMMARY"]
@@ -20,66 +22,40 @@ if __name__ == "__main__":
     print("[*] Collecting session meta data")
     inputPath, sessionPath, sessionLog = session_data(fileParams)
     
-    print("[*] Initializing document serialization...")
+    print("[*] Initializing document extraction...")
     data, sessionLog = unpack_data(fileParams, dataParams, sessionLog)
     data_ = data[0:100]
     _docs = [row for row in data_[smryCols[1]].fillna("0")]
  
-    docBinFile = serialize_nlp(_docs, sessionPath, 
-                               option=f"{root_dir}/bootstrapModel/")
+    # entities are extracted inline; Docs are saved as a side output
+    docBinFile, extracts = entity_recognizer(_docs, sessionPath, 
+                                             f"{root_dir}/bootstrapModel/")
 
     endTime = datetime.now()
-    sessionLog["SerializationEndTime"] = endTime
+    sessionLog["ExtractionEndTime"] = endTime
     logFile = write_to_log(sessionPath, sessionLog)
     
     print(f"[*] End Time: {endTime}")
     time = pd.DataFrame()
     duration = (endTime -_time)
-    print(f"[*] Total Serialization Runtime: {duration}")
+    print(f"[*] Total Extraction Runtime: {duration}")
     
     
 if __name__ == "__main__":
     banner_("spaCy NLP - Entity Extraction")
-    print("[*] Reloading spaCy Model")
-    nlp = spacy.load(f"{root_dir}/bootstrapModel/")
-    doc_bin = DocBin().from_disk(docBinFile)
-    Docs = list(doc_bin.get_docs(nlp.vocab))
-
     print("[*] Collecting Entity Labels...")
-    cols = nlp.get_pipe("ner").labels
-    cols += nlp.get_pipe("entity_ruler").labels
-
-    def deserialize_nlp(docBinFile:str)->(list):
-        """Unpack spaCy binaries."""
-        doc_bin = DocBin().from_disk(docBinFile)
-        print(f"[*] Deserializing {len(doc_bin)} docs..")
-        return list(doc_bin.get_docs(nlp.vocab))
-
-    # documents are unpacked
-    Docs = deserialize_nlp(docBinFile)
+    labels = model_labels(f"{root_dir}/bootstrapModel/")
+    cols = labels["ner"] + labels["entity_ruler"]
 
-    print("[*] Extracting Entities...")
-    extracts = extract_nlp(Docs)
-
-    # Extract table is created
+    # Extract table is created, with the first entity of each label;
+    # extracts are keyed by the row index of `data_`
     print("[*] Creating Extract Table")
-    extractTable = pd.DataFrame()
-    extractTableClean = pd.DataFrame
-    for col in cols:
-        extractTable[col] = [[e for e in extract[1] 
-                              if e[0]==col] 
-                            for extract in extracts]
+    entities = entity_table(pd.DataFrame({"ID": data_.index, "entities": extracts}), cols)
+    extractTable = extract_table(entities, cols, data_.index, mode="first")
 
     print("[*] Linking extracts back to narratives...")
     summaries = data_[smryCols]
     extractSummaries = pd.concat([extractTable, summaries], axis=1)
-    
-    cols = list(extractSummaries.columns[:-2])
-    for col in cols:
-        extractSummaries[col] = extractSummaries[col].fillna("0").apply(
-                                lambda x: x[0] if len(x)>0 else 0)
-        extractSummaries[col] = extractSummaries[col].fillna("0").apply(
-                                lambda x: x[3] if type(x)==list else x)
         
     outputFile = "extractSummaries.json"
     extractSummaries.to_json(outputFile)
@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import resource
+import threading
+from datetime import datetime
+import pandas as pd
+
+# The metrics log of the current run, shared by every module, and the
+# open step of each thread (stages of `run_stages` run on their own threads)
+_RUN = None
+_OPEN = {}
+_LOCK = threading.Lock()
+PAGE_MB = os.sysconf("SC_PAGE_SIZE") / 2**20 if hasattr(os, "sysconf") else None
+
+
+class MetricsLog:
+    """Append-only JSONL log of metric events. Events are buffered
+    and appended `buffer_size` at a time, so logging a step never
+    rewrites the file and costs no I/O in the pipeline's hot path.
+    """
+    def __init__(self, path:str, buffer_size:int=50):
+        self.path, self.buffer_size, self.buffer = path, buffer_size, []
+
+    def event(self, record:dict)->(None):
+        with _LOCK:
+            self.buffer.append(record)
+            if len(self.buffer) >= self.buffer_size:
+                self.flush()
+
+    def flush(self)->(None):
+        if not self.buffer:
+            return
+        with open(self.path, "a") as f:
+            f.write("".join(json.dumps(record, default=str) + "\n"
+                            for record in self.buffer))
+        self.buffer = []
+
+
+def peak_rss_mb()->(float):
+    """Peak resident memory of the process so far, in MB
+    (`ru_maxrss` is in KB on Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_rss_mb()->(float):
+    """Resident memory of the process now, in MB, from
+    `/proc/self/statm`; the peak so far where it is missing."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * PAGE_MB
+    except (OSError, ValueError, IndexError, TypeError):
+        return peak_rss_mb()
+
+
+class RssSampler(threading.Thread):
+    """Samples the current RSS every `interval` seconds and raises the
+    peak of every open step, and its own `peak` since it started.
+    `ru_maxrss` is the peak of the whole process, so it cannot tell
+    how much memory a step used once an earlier step has set a
+    higher peak.
+    """
+    def __init__(self, interval:float=0.05):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.interval, self.stopped = interval, threading.Event()
+        self.start_rss = self.peak = current_rss_mb()
+
+    def run(self)->(None):
+        while not self.stopped.wait(self.interval):
+            rss = current_rss_mb()
+            self.peak = max(self.peak, rss)
+            with _LOCK:
+                for current in _OPEN.values():
+                    current["peak"] = max(current["peak"], rss)
+
+    def stop(self)->(None):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss_mb())
+
+
+def cpu_seconds()->(float):
+    """CPU time of the calling thread, plus finished child
+    processes, e.g. `nlp.pipe` workers with `n_process` > 1."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.thread_time() + children.ru_utime + children.ru_stime
+
+
+def start_run(session_path:str, buffer_size:int=50,
+              sample_interval:float=0.05)->(MetricsLog):
+    """Starts the metrics log of a session, `metrics.jsonl`, and
+    the RSS sampler of its steps (`RssSampler`).
+    Until a run is started, `step` and `end_step` do nothing."""
+    global _RUN
+    if _RUN is not None:
+        _RUN.sampler.stop()
+    _RUN = MetricsLog(os.path.join(session_path, "metrics.jsonl"), buffer_size)
+    _RUN.session_path = session_path
+    _RUN.sampler = RssSampler(sample_interval)
+    _RUN.sampler.start()
+    _RUN.event({"event": "run_start", "session": session_path,
+                "time": datetime.now().isoformat()})
+    return _RUN
+
+
+def step(job:str, rows_in:int=None)->(None):
+    """Starts timing a JOB step, e.g. `step("1.2", len(data))`, next to
+    the step's `[JOB 1.2]` banner. The step open on this thread is
+    ended first, with `rows_in` as its `rows_out`."""
+    if _RUN is None:
+        return
+    end_step(rows_in)
+    rss = current_rss_mb()
+    with _LOCK:
+        _OPEN[threading.get_ident()] = {"job": job, "rows_in": rows_in,
+                                        "wall": time.perf_counter(),
+                                        "cpu": cpu_seconds(), "rss": rss, "peak": rss}
+
+
+def end_step(rows_out:int=None, **fields)->(None):
+    """Ends the step open on this thread and logs its wall time,
+    CPU time, RSS, rows in and out and rows (docs) per second.
+    `peak_rss_mb` is the highest RSS sampled during the step, and
+    `rss_delta_mb` how far it rose above the RSS the step started at.
+    Extra `fields`, e.g. `n_process` or `chunk`, are logged with the step."""
+    with _LOCK:
+        current = _OPEN.pop(threading.get_ident(), None)
+    if _RUN is None or current is None:
+        return
+    wall = time.perf_counter() - current["wall"]
+    rows = rows_out if rows_out is not None else current["rows_in"]
+    rss = current_rss_mb()
+    peak = max(current["peak"], rss)
+    _RUN.event({"event": "step", "job": current["job"],
+                "thread": threading.current_thread().name,
+                "wall_seconds": round(wall, 4),
+                "cpu_seconds": round(cpu_seconds() - current["cpu"], 4),
+                "rss_mb": round(rss, 1), "peak_rss_mb": round(peak, 1),
+                "rss_delta_mb": round(peak - current["rss"], 1),
+                "rows_in": current["rows_in"], "rows_out": rows_out,
+                "docs_per_sec": round(rows / wall, 2) if rows and wall > 0 else None,
+                **fields})
+
+
+def event(**fields)->(None):
+    """Logs a free-form event, e.g. the busy time of a stage."""
+    if _RUN is not None:
+        _RUN.event(fields)
+
+
+def summarize_metrics(metrics_path:str)->(pd.DataFrame):
+    """Summarizes a metrics log by JOB step: total wall and CPU
+    time, peak RSS and largest RSS rise, rows in and out and
+    docs/sec. Steps that ran more than once (e.g. per chunk) are
+    added up.
+
+    Args:
+    metrics_path (str): path to a session's `metrics.jsonl`
+
+    Returns:
+    summary (pd.DataFrame): one row per JOB step; empty if the
+                            log has no steps (e.g. a failed run)
+    """
+    # job names stay text, e.g. "1.10" is not 1.1
+    events = pd.read_json(metrics_path, lines=True, dtype={"job": str})
+    if "job" not in events.columns:
+        columns = ["runs", "wall_seconds", "cpu_seconds", "peak_rss_mb",
+                   "rss_delta_mb", "rows_in", "rows_out", "docs_per_sec"]
+        return pd.DataFrame(columns=columns, index=pd.Index([], name="job"))
+    steps = events.loc[events["event"] == "step"]
+    summary = steps.groupby("job").agg(
+        runs=("job", "size"), wall_seconds=("wall_seconds", "sum"),
+        cpu_seconds=("cpu_seconds", "sum"), peak_rss_mb=("peak_rss_mb", "max"),
+        rss_delta_mb=("rss_delta_mb", "max"),
+        rows_in=("rows_in", "sum"), rows_out=("rows_out", "sum")).round(4)
+    summary["docs_per_sec"] = (summary["rows_out"] / summary["wall_seconds"]).round(2)
+    return summary
+
+
+def end_run(runs_path:str="./logs/metrics_runs.jsonl")->(pd.DataFrame):
+    """Ends the run: flushes the metrics log, saves the run summary
+    as `metrics_summary.csv` in the session, and appends it to
+    `runs_path`, which collects the summaries of every session.
+
+    Args:
+    runs_path (str): JSONL file of run summaries, see `compare_runs`,
+                     or None to only save the session summary
+
+    Returns:
+    summary (pd.DataFrame): one row per JOB step
+    """
+    global _RUN
+    if _RUN is None:
+        return None
+    end_step()
+    _RUN.sampler.stop()
+    _RUN.event({"event": "run_end", "time": datetime.now().isoformat(),
+                "peak_rss_mb": round(peak_rss_mb(), 1)})
+    _RUN.flush()
+    summary = summarize_metrics(_RUN.path)
+    summary.to_csv(os.path.join(_RUN.session_path, "metrics_summary.csv"))
+    if runs_path is None:
+        _RUN = None
+        return summary
+    runs_dir = os.path.dirname(runs_path)
+    if runs_dir and not os.path.exists(runs_dir):
+        os.makedirs(runs_dir)
+    with open(runs_path, "a") as f:
+        f.write(json.dumps({"session": _RUN.session_path,
+                            "time": datetime.now().isoformat(),
+                            "steps": summary.reset_index().to_dict("records")},
+                           default=str) + "\n")
+    print(f"[!] Run metrics saved to: {_RUN.path}")
+    _RUN = None
+    return summary
+
+
+def compare_runs(runs_path:str="./logs/metrics_runs.jsonl",
+                 metric:str="wall_seconds")->(pd.DataFrame):
+    """Compares run summaries across sessions, to find regressions.
+
+    Args:
+    runs_path (str): JSONL file of run summaries written by `end_run`
+    metric (str): step metric to compare, e.g. `docs_per_sec`
+
+    Returns:
+    runs (pd.DataFrame): one row per session, one column per JOB step
+    """
+    rows = []
+    with open(runs_path, "r") as f:
+        for line in f:
+            run = json.loads(line)
+            for record in run["steps"]:
+                rows.append({"session": run["session"], "job": record["job"],
+                             metric: record[metric]})
+    return pd.DataFrame(rows, columns=["session", "job", metric]).pivot_table(
+                                          index="session", columns="job",
+                                          values=metric, aggfunc="sum")
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import spacy
+
+# Pipelines and label metadata loaded in this process,
+# keyed by model path (or package name) and loader
+_PIPELINES = {}
+_LOAD_SECONDS = {}
+_LABELS = {}
+
+
+def model_key(model:str)->(str):
+    """Normalizes a model path so the same model directory is
+    only loaded once, however it is spelled. Package names
+    are returned unchanged."""
+    if os.path.exists(model):
+        return os.path.realpath(model)
+    return model
+
+
+def get_model(model:str, loader=spacy.load):
+    """Returns the shared pipeline for `model`, loading it on
+    first use. Every later call in the process gets the same
+    pipeline, so a transformer is only loaded once.
+    Shared pipelines must not be modified; callers that add
+    pipes load their own copy (see `config_patterns`).
+
+    Args:
+    model (str): path to custom spaCy model or package name
+    loader (callable): builds the pipeline from `model`, e.g.
+                       `spacy.load` or `rules_engine`
+
+    Returns:
+    nlp (Language): shared spaCy pipeline
+    """
+    key = (model_key(model), loader.__name__)
+    if key not in _PIPELINES:
+        start = time.perf_counter()
+        _PIPELINES[key] = loader(model)
+        _LOAD_SECONDS[key] = time.perf_counter() - start
+        print(f"[*] Loaded spaCy model: {model} ({_LOAD_SECONDS[key]:.1f}s)")
+    return _PIPELINES[key]
+
+
+def load_seconds(model:str, loader=spacy.load)->(float):
+    """Time it took to load `model` with `loader` the first time,
+    i.e. what each new worker process pays to load it again."""
+    return _LOAD_SECONDS.get((model_key(model), loader.__name__), 0.0)
+
+
+def forget_model(model:str)->(None):
+    """Drops the pipelines and labels cached for `model`, e.g.
+    after the model directory is rewritten on disk."""
+    key = model_key(model)
+    for cached in [cached for cached in _PIPELINES if cached[0] == key]:
+        del _PIPELINES[cached]
+        del _LOAD_SECONDS[cached]
+    _LABELS.pop(key, None)
+    return
+
+
+def read_pattern_labels(pattern_path:str)->(list):
+    """Reads the sorted entity labels of a JSONL pattern file."""
+    with open(pattern_path, "r") as f:
+        labels = {json.loads(line)["label"] for line in f if line.strip()}
+    return sorted(labels)
+
+
+def model_labels(model:str)->(dict):
+    """Returns the entity ruler and NER labels of a model without
+    building the pipeline. Labels are read from, in order:
+    [1] a JSONL pattern file, if `model` is one (rules-only engine).
+    [2] the ruler's `patterns.jsonl` in the model directory.
+    [3] the `labels` saved in the model's `meta.json`.
+    Only if a model has no label metadata on disk is the
+    shared pipeline loaded with `get_model`.
+
+    Args:
+    model (str): path to custom spaCy model, package name,
+                 or a single pattern file
+
+    Returns:
+    labels (dict): "entity_ruler" and "ner" lists of labels
+    """
+    key = model_key(model)
+    if key in _LABELS:
+        return _LABELS[key]
+    labels = {"entity_ruler": [], "ner": []}
+    # [1] A single pattern file
+    if os.path.isfile(model):
+        labels["entity_ruler"] = read_pattern_labels(model)
+        _LABELS[key] = labels
+        return labels
+
+    model_dir = model
+    if not os.path.isdir(model_dir):
+        model_dir = str(spacy.util.get_package_path(model))
+    meta_path = f"{model_dir}/meta.json"
+    ruler_path = f"{model_dir}/entity_ruler/patterns.jsonl"
+    if not os.path.exists(ruler_path):
+        ruler_path = f"{model_dir}/patterns.jsonl"
+    meta_labels = None
+    if os.path.exists(meta_path):
+        with open(meta_path, "r") as f:
+            meta_labels = json.load(f).get("labels")
+
+    # [2] Ruler patterns, [3] saved metadata
+    if meta_labels is not None:
+        labels["ner"] = list(meta_labels.get("ner", []))
+        labels["entity_ruler"] = list(meta_labels.get("entity_ruler", []))
+    if os.path.exists(ruler_path):
+        labels["entity_ruler"] = read_pattern_labels(ruler_path)
+    elif meta_labels is None:
+        pipe_labels = get_model(model).pipe_labels
+        labels["ner"] = list(pipe_labels.get("ner", []))
+        labels["entity_ruler"] = list(pipe_labels.get("entity_ruler", []))
+    _LABELS[key] = labels
+    return labels
@@ -3,10 +3,18 @@ warnings.filterwarnings('ignore')
 from datetime import datetime
 
 import os
+import sys
+import argparse
 import pandas as pd
 import numpy as np
 from transform import *
 from spacy_nlp import *
+from edge_cases import EdgeCaseDetector, EdgeCaseDetectorChunked
+from clean_markup import clean_dirty_data
+from staged_pipeline import run_stages, stage_log, merge_logs
+from metrics import start_run, end_run
+from delta_runs import (previous_run, select_delta, retire_entities, record_run,
+                        pending_runs, compact_entities)
 
 
 def begin_session()->(str):
@@ -32,6 +40,7 @@ def begin_session()->(str):
         log["SessionPath"] = session_path
         log.to_json(f"{session_path}/log.json")
         log.to_json(f"./logs/{session_path}.json")
+        start_run(session_path)
 
     else:
         print("Session Path Already Exists. Run `begin_session()` again to generate new session path.")
@@ -39,7 +48,8 @@ def begin_session()->(str):
     return session_time, session_path, log
 
 
-def extraction_pipeline(input_path, model)->(None):
+def extraction_pipeline(input_path, model, compact:bool=False,
+                        usecols:list=None)->(None):
     """
     1. Accepts an input path and a spaCy model.
     2. Data is loaded and prepped with transform.py.
@@ -52,6 +62,10 @@ def extraction_pipeline(input_path, model)->(None):
         about how each job works.
     7. Check the time outputs to measure runtime performance.
     8. See log.txt for meta-data for your session.
+    9. Set `compact` to hold the narratives in compact dtypes
+        through JOB 2, see `compact_frame` in transform.py.
+    10. Set `usecols` to read only those columns of the export,
+        see `read_export` in transform.py.
     
     [JOB 1] Data Preparation (transform.py)
         [1.1] Load Data
@@ -63,6 +77,7 @@ def extraction_pipeline(input_path, model)->(None):
         [2.1] Detect Short Narratives
         [2.2] Detect Dirty Data
         [2.3] Detect Repeat Sources
+        [2.4] Clean Dirty Data (clean_markup.py)
         
     [JOB 3] spaCy Extraction Pipeline (spacy_nlp.py)
         [3.1] Transform to spaCy Docs
@@ -76,12 +91,14 @@ def extraction_pipeline(input_path, model)->(None):
     print("")
     
     print("______________________[JOB 1 - Data Preparation]_____________________")
-    data, log = transform_data(input_path, "C_CASE_SUMMARY", log)
+    data, log = transform_data(input_path, "C_CASE_SUMMARY", log, compact=compact,
+                               usecols=usecols)
     print("<======================[   JOB 1 - COMPLETE   ]======================>")
     print("")
     
     print("______________________[JOB 2 - Detect Edge Cases]_____________________")
     data, log = EdgeCaseDetector(data, log)
+    data, log = clean_dirty_data(data, log)
     input_path, log = save_transformation(data, log, session_path)
     print("<======================[   JOB 2 - COMPLETE   ]======================>")
     print("")
@@ -89,7 +106,7 @@ def extraction_pipeline(input_path, model)->(None):
     print("____________________[JOB 3 - Auto-Extract Entities]___________________")
     choice = input("Press [1] to start auto-extraction. Press [ENTER] to end pipeline.")
     if str(choice) == '1':
-        extraction_engine(input_path, model)
+        extraction_engine(input_path, model, session_path, log)
     else:
         pass
     print("<======================[   JOB 3 - COMPLETE   ]======================>")
@@ -103,13 +120,271 @@ def extraction_pipeline(input_path, model)->(None):
     log.loc["Duration"] = duration
     log.to_json(f"{session_path}/log.json")
     log.to_json(f"./logs/{session_path}.json")
+    end_run()
     return log
 
+def staged_extraction_pipeline(input_path, model, chunksize:int=100000,
+                               cuts:list=None, long_docs:bool=False,
+                               maxsize:int=2, compact:bool=False, 
+                               usecols:list=None,
+                               index_path:str="./index/entities.sqlite",
+                               **extract_args)->(None):
+    """
+    Runs JOB 1-3 at the same time on a stream of chunks, instead of
+    one job after another on the whole dataset. Each stage runs on
+    its own thread, connected by queues of at most `maxsize` chunks
+    (see staged_pipeline.py), so the entity recognizer starts on the
+    first accepted chunk while later chunks are still being read:
+        [read]   `transform_data_chunked`
+        [route]  `route_chunks`
+        [detect] `EdgeCaseDetectorChunked`
+        [clean]  `clean_dirty_data`
+        [save]   `save_transformation_chunked`
+        [JOB 3]  `entity_recognizer`, on this thread, which reads the
+                 accepted chunks as it needs them, so one `nlp.pipe`
+                 (and one pool of processes) serves every chunk
+    Entity tables are saved once all chunks are extracted.
+    
+    [TIP] Freeze `cuts` from an earlier session (`load_quants`)
+    to route every chunk exactly on arrival.
+    
+    Args:
+    input_path (str): Path to input data CSV file
+    model (str): path to selected spaCy model
+    chunksize (int): Number of rows read from the CSV at a time
+    cuts (list): Optional frozen quantile cut points
+    long_docs (bool): Accept Q5 for windowed extraction
+    maxsize (int): Number of chunks each queue holds
+    compact (bool): Use compact dtypes, see `compact_frame`
+    usecols (list): Columns of the export to read, or None for all
+    index_path (str): Path to the entity index, or None to skip it
+    extract_args: passed to `entity_recognizer`, e.g. `mode`,
+                  `cache_path`, `max_chars`
+    
+    Returns:
+    log (pd.DataFrame): session log
+    """
+    session_time, session_path, log = begin_session()
+    print("__________[SBA Hotline - spaCy Entity Extraction Engine]____________")
+    print("="*68)
+    print("")
+    
+    print("________________[JOB 1-3 - Staged Extraction Pipeline]________________")
+    logs = [stage_log() for n in range(6)]
+    stages = [("route", lambda chunks: route_chunks(chunks, 5, logs[1], cuts=cuts,
+                                                    session_path=session_path)),
+              ("detect", lambda chunks: EdgeCaseDetectorChunked(chunks, logs[2])),
+              ("clean", lambda chunks: (clean_dirty_data(chunk, logs[3], "C_CASE_SUMMARY")[0]
+                                        for chunk in chunks)),
+              ("save", lambda chunks: save_transformation_chunked(
+                                        chunks, logs[4], session_path, long_docs))]
+    source = transform_data_chunked(input_path, "C_CASE_SUMMARY", logs[0],
+                                    chunksize=chunksize, compact=compact,
+                                    usecols=usecols)
+    
+    extracted = []
+    def accepted_chunks():
+        for chunk in run_stages(source, stages, log=logs[5], maxsize=maxsize):
+            if len(chunk) == 0:
+                continue
+            keep = [col for col in ["ID", "offset_map"] if col in chunk.columns]
+            extracted.append(chunk[keep].copy())
+            yield chunk["narratives"], chunk["ID"] if "ID" in chunk.columns else None
+    
+    doc_bin_dir, extracts = entity_recognizer(accepted_chunks(), session_path, model,
+                                              log=logs[5], chunked=True,
+                                              **extract_args)
+    log = merge_logs(log, logs)
+    if extracted:
+        data = pd.concat(extracted, ignore_index=True)
+        data["entities"] = extracts
+        save_extracts(data, model, session_path, index_path=index_path)
+    print("<======================[  JOB 1-3 - COMPLETE  ]======================>")
+    print("")
+    
+    end_time = datetime.now()
+    print(f"[END TIME: {end_time}]\n")
+    duration = (str(end_time - session_time))[:19]
+    print(f"[TOTAL RUNTIME: {duration}]")
+    log.loc["EndTime"] = datetime.now()
+    log.loc["Duration"] = duration
+    log.to_json(f"{session_path}/log.json")
+    log.to_json(f"./logs/{session_path}.json")
+    end_run()
+    return log
+
+
+def delta_pipeline(input_path, model, manifest_path:str="./manifest.sqlite",
+                   compact:bool=False, usecols:list=None,
+                   long_docs:bool=False, index_path:str="./index/entities.sqlite",
+                   compact_every:int=7, **extract_args)->(None):
+    """
+    Runs JOB 1-3 on the new and changed narratives of an export
+    only, without prompts, e.g. as a nightly job. Processed IDs and
+    narrative hashes are kept in a manifest next to the session
+    directories (see delta_runs.py), so a run costs in proportion
+    to the day's new complaints rather than the whole history.
+    Only reading and hashing the export touches every row.
+    
+    [JOB D] Select Delta (delta_runs.py)
+        [D.1] Select New and Changed Narratives
+    [JOB 1-2] on the selected rows, saved to `delta.csv`. Rows are
+        routed with the cut points of the first run (`load_quants`),
+        so a small delta lands in the same quantiles as a full run.
+    [JOB 3] Extract every accepted row of the delta.
+    [JOB D] Record Delta (delta_runs.py)
+        [D.2] Retire Entities of Edited Narratives from the index
+        [D.3] Record the session in the manifest
+        [D.4] Compact the current entity table every `compact_every` runs
+    
+    The session's entity table holds the delta's entities only; use
+    `current_entities` for the table of every narrative so far. It
+    reads the last compacted table and the sessions since, so its
+    cost is bounded by `compact_every` sessions.
+    The first run, with an empty manifest, processes the whole
+    export and freezes its quantile cut points.
+    
+    Args:
+    input_path (str): Path to input data CSV file
+    model (str): path to selected spaCy model
+    manifest_path (str): path to the manifest of processed narratives
+    compact (bool): Use compact dtypes, see `compact_frame`
+    usecols (list): Columns of the export to read, or None for all
+    long_docs (bool): Accept Q5 for windowed extraction
+    index_path (str): Path to the entity index, or None to skip it
+    compact_every (int): Runs between compactions of the current
+                         entity table, or None to never compact
+    extract_args: passed to `extraction_engine`, e.g. `mode`,
+                  `cache_path`, `max_chars`
+    
+    Returns:
+    log (pd.DataFrame): session log
+    """
+    session_time, session_path, log = begin_session()
+    print("__________[SBA Hotline - spaCy Entity Extraction Engine]____________")
+    print("="*68)
+    print("")
+    
+    print("______________________[JOB D - Select Delta]__________________________")
+    narr_col = "C_CASE_SUMMARY"
+    previous = previous_run(manifest_path)
+    if usecols is not None and narr_col not in usecols:
+        usecols = [*usecols, narr_col]
+    export = read_export(input_path, usecols, {narr_col: "string"})
+    export, delta_log = select_delta(export, narr_col, stage_log(), manifest_path)
+    delta = export.loc[export["DELTA"].isin(["new", "changed"])]
+    print("")
+    
+    cuts = None if previous is None else load_quants(previous["quants"])
+    if len(delta) > 0:
+        delta_path = f"{session_path}/delta.csv"
+        delta.drop(columns=["DELTA_HASH", "DELTA", "DELTA_REPLACED"]
+                   ).to_csv(delta_path, index=False)
+        
+        print("______________________[JOB 1 - Data Preparation]_____________________")
+        data, log = transform_data(delta_path, narr_col, log, cuts=cuts,
+                                   compact=compact)
+        if cuts is None:
+            cuts = sketch_cuts(update_sketch(None, data["narr_length"]), 5)
+        print("<======================[   JOB 1 - COMPLETE   ]======================>")
+        print("")
+        
+        print("______________________[JOB 2 - Detect Edge Cases]_____________________")
+        data, log = EdgeCaseDetector(data, log)
+        data, log = clean_dirty_data(data, log)
+        accepted_path, log = save_transformation(data, log, session_path, long_docs)
+        print("<======================[   JOB 2 - COMPLETE   ]======================>")
+        print("")
+        
+        print("____________________[JOB 3 - Auto-Extract Entities]___________________")
+        log = extraction_engine(accepted_path, model, session_path, log,
+                                sample_size=None, index_path=index_path,
+                                **extract_args)
+        print("<======================[   JOB 3 - COMPLETE   ]======================>")
+        print("")
+    else:
+        print("[!] No new or changed narratives.")
+    log = merge_logs(log, [delta_log])
+    
+    print("______________________[JOB D - Record Delta]__________________________")
+    replaced = export.loc[export["DELTA_REPLACED"], "ID"]
+    retire_entities(replaced, session_path, index_path)
+    table_path = f"{session_path}/entities"
+    entities = (pd.read_parquet(table_path, columns=["ID"])
+                if os.path.exists(table_path) else [])
+    quants_path = None if cuts is None else os.path.abspath(
+                                                freeze_quants(cuts, session_path))
+    print("[JOB D.3] Record Session in Manifest")
+    record_run(export, session_path, quants_path, len(entities), manifest_path)
+    if compact_every is not None and pending_runs(manifest_path) >= compact_every:
+        print("[JOB D.4] Compact Current Entities")
+        compact_entities(manifest_path)
+    log.loc["Previous Session"] = None if previous is None else previous["path"]
+    log.loc["Entities"] = len(entities)
+    print("<======================[   JOB D - COMPLETE   ]======================>")
+    print("")
+    
+    end_time = datetime.now()
+    print(f"[END TIME: {end_time}]\n")
+    duration = (str(end_time - session_time))[:19]
+    print(f"[TOTAL RUNTIME: {duration}]")
+    log.loc["EndTime"] = datetime.now()
+    log.loc["Duration"] = duration
+    log.to_json(f"{session_path}/log.json")
+    log.to_json(f"./logs/{session_path}.json")
+    end_run()
+    return log
+
+
+def resume_session(session_path:str, model:str, **extract_args)->(None):
+    """Resumes JOB 3 of a session that was interrupted. Rows in
+    the session's checkpoint are not extracted again; the rest of
+    the accepted narratives are extracted, and the entity tables
+    are saved for all of them.
+    
+    Args:
+    session_path (str): path of the interrupted session
+    model (str): path to selected spaCy model, as in the first run
+    extract_args: passed to `extraction_engine`
+    
+    Returns:
+    log (pd.DataFrame): session log
+    """
+    session_path = session_path.rstrip("/")
+    print(f"[*] Resuming session: {session_path}")
+    log = pd.read_json(f"{session_path}/log.json")
+    start_run(session_path)
+    accepted_path = f"{session_path}/transformed/accepted.csv"
+    log = extraction_engine(accepted_path, model, session_path, log,
+                            resume=True, **extract_args)
+    log.loc["ResumedTime"] = datetime.now()
+    log.to_json(f"{session_path}/log.json")
+    log.to_json(f"./logs/{os.path.basename(session_path)}.json")
+    end_run()
+    return log
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="spaCy entity extraction.")
+    parser.add_argument("--resume", metavar="SESSION_PATH",
+                        help="resume JOB 3 of an interrupted session")
+    parser.add_argument("--delta", metavar="INPUT_PATH",
+                        help="process only new or changed narratives of an export")
+    parser.add_argument("--manifest", default="./manifest.sqlite",
+                        help="manifest of processed narratives, for --delta")
+    args = parser.parse_args()
+    model = "./nlp_model/bootstrapModel"
+    if args.resume:
+        resume_session(args.resume, model)
+        sys.exit()
+    if args.delta:
+        delta_pipeline(args.delta, model, args.manifest)
+        sys.exit()
+
     input_path = None
     model = None
     
     while input_path == None:
         input_path = input("INPUT_PATH:")
         model = "./nlp_model/bootstrapModel"
-        extraction_pipeline(input_path, model)
\ No newline at end of file
+        extraction_pipeline(input_path, model)
@@ -0,0 +1,279 @@
+import os
+import json
+from itertools import cycle
+import spacy
+from pattern_data import *
+
+# Token attributes whose literal values can be merged into `IN` sets
+LITERAL_ATTRS = ["LOWER", "ORTH", "TEXT"]
+
+# Sentences used to build the fixture corpus from the lexicons in
+# `pattern_data.py`; each lexicon term is written in lower and title case
+TEMPLATES = ["On 3/4/21 I spoke with {term} about my EIDL loan.",
+             "Please send it to 1234 North {Term}, Apt 5, they said.",
+             "The {Term} called me at (800) 555-1234 about the ppp.",
+             "I sent $1,500 via {term} to agent #2231 on Monday.",
+             "My SSN 123-45-6789 was used by {Term} without consent.",
+             "The {term} report shows a hard inquiry and an ACH transfer."]
+
+
+def pattern_key(pattern:dict)->(str):
+    """Serializes a pattern so identical patterns compare equal."""
+    return json.dumps(pattern, sort_keys=True)
+
+
+def literal_attr(token:dict)->(str):
+    """Returns the attribute of a token that only tests one literal
+    attribute (a string or an `IN` set), and optionally `OP`."""
+    attrs = [key for key in token if key != "OP"]
+    if len(attrs) != 1 or attrs[0] not in LITERAL_ATTRS:
+        return None
+    value = token[attrs[0]]
+    if isinstance(value, str):
+        return attrs[0]
+    if isinstance(value, dict) and list(value) == ["IN"]:
+        return attrs[0]
+    return None
+
+
+def literal_values(token:dict, attr:str)->(list):
+    """Returns the literal values a token accepts for `attr`."""
+    value = token[attr]
+    return [value] if isinstance(value, str) else list(value["IN"])
+
+
+def is_dead(pattern:dict)->(bool):
+    """A `LOWER` value with upper case letters or whitespace can
+    never equal a token's lower case text, so the pattern never
+    matches (e.g. `{"LOWER": "bank of america"}`)."""
+    if isinstance(pattern["pattern"], str):
+        return False
+    for token in pattern["pattern"]:
+        if literal_attr(token) != "LOWER" or token.get("OP") in ("?", "*"):
+            continue
+        values = literal_values(token, "LOWER")
+        if all(value != value.lower() or any(c.isspace() for c in value)
+               for value in values):
+            return True
+    return False
+
+
+def to_phrase(pattern:dict, nlp)->(dict):
+    """Converts a token pattern that is only a sequence of required
+    `LOWER` literals to a phrase pattern, if the tokenizer splits the
+    phrase into the same tokens. Returns None otherwise."""
+    tokens = pattern["pattern"]
+    if isinstance(tokens, str) or not tokens:
+        return None
+    if any(literal_attr(token) != "LOWER" or "OP" in token
+           or not isinstance(token["LOWER"], str) for token in tokens):
+        return None
+    words = [token["LOWER"] for token in tokens]
+    phrase = " ".join(words)
+    if [token.text for token in nlp.make_doc(phrase)] != words:
+        return None
+    return {**pattern, "pattern": phrase}
+
+
+def merge_alternatives(patterns:list)->(list):
+    """Merges token patterns with the same label and id that differ
+    only in the literal value of one token into a single pattern
+    with an `IN` set, e.g. one PERSON pattern for all suffixes.
+    Positions are merged one at a time until nothing changes."""
+    changed = True
+    while changed:
+        changed = False
+        max_len = max([len(p["pattern"]) for p in patterns
+                       if not isinstance(p["pattern"], str)], default=0)
+        for i in range(max_len):
+            groups, merged = {}, []
+            for pattern in patterns:
+                tokens = pattern["pattern"]
+                attr = None
+                if not isinstance(tokens, str) and i < len(tokens):
+                    attr = literal_attr(tokens[i])
+                if attr is None:
+                    merged.append(pattern)
+                    continue
+                rest = {key: value for key, value in tokens[i].items() if key != attr}
+                key = (pattern["label"], pattern.get("id"), attr,
+                       pattern_key(tokens[:i]), pattern_key(tokens[i+1:]),
+                       pattern_key(rest))
+                if key not in groups:
+                    groups[key] = (pattern, [])
+                    merged.append(key)
+                groups[key][1].extend(literal_values(tokens[i], attr))
+            new_patterns = []
+            for item in merged:
+                if isinstance(item, dict):
+                    new_patterns.append(item)
+                    continue
+                pattern, values = groups[item]
+                attr, values = item[2], sorted(set(values))
+                token = {**pattern["pattern"][i]}
+                token[attr] = values[0] if len(values) == 1 else {"IN": values}
+                tokens = [*pattern["pattern"][:i], token, *pattern["pattern"][i+1:]]
+                new_patterns.append({**pattern, "pattern": tokens})
+            changed = changed or len(new_patterns) < len(patterns)
+            patterns = new_patterns
+    return patterns
+
+
+def compile_patterns(patterns:list, nlp=None)->(list, dict):
+    """Compiles entity ruler patterns into an optimized ruler config.
+    [1] Drops exact duplicate patterns.
+    [2] Drops dead patterns that can never match.
+    [3] Moves sequences of `LOWER` literals to phrase patterns,
+        matched by the ruler's phrase matcher on `LOWER`.
+    [4] Merges token patterns that differ in one literal token into
+        `IN` sets, so the matcher runs fewer patterns per document.
+    Optional wildcard tokens (`{"OP": "?"}`) at the edges of a pattern
+    are kept: the ruler keeps the longest match, so they add a token of
+    context to the entity and dropping them would change the spans.
+
+    Args:
+    patterns (list): List of dictionaries containing
+                    patterns for spaCy entity ruler.
+    nlp (Language): pipeline whose tokenizer checks phrase patterns;
+                    defaults to `spacy.blank("en")`
+
+    Returns:
+    compiled (list): optimized patterns
+    report (dict): counts of patterns removed and merged
+    """
+    if nlp is None:
+        nlp = spacy.blank("en")
+    # [1] Drop exact duplicates, keeping the first
+    seen, unique = set(), []
+    for pattern in patterns:
+        if pattern_key(pattern) not in seen:
+            seen.add(pattern_key(pattern))
+            unique.append(pattern)
+
+    # [2] Drop dead patterns
+    dead = [pattern for pattern in unique if is_dead(pattern)]
+    live = [pattern for pattern in unique if not is_dead(pattern)]
+
+    # [3] Move literal sequences to phrase patterns
+    phrases, tokens = [], []
+    for pattern in live:
+        phrase = to_phrase(pattern, nlp)
+        if phrase is None:
+            tokens.append(pattern)
+        else:
+            phrases.append(phrase)
+
+    # [4] Merge alternatives into `IN` sets
+    tokens = merge_alternatives(tokens)
+    compiled = phrases + tokens
+    report = {"patterns_in": len(patterns),
+              "duplicates": len(patterns) - len(unique),
+              "dead": [pattern_key(pattern) for pattern in dead],
+              "phrase_patterns": len(phrases),
+              "token_patterns": len(tokens),
+              "patterns_out": len(compiled)}
+    print(f"[*] Compiled {len(patterns)} patterns into {len(compiled)}: "
+          f"{len(phrases)} phrase and {len(tokens)} token patterns.")
+    return compiled, report
+
+
+def fixture_corpus()->(list):
+    """Builds a fixture corpus from the lexicons in `pattern_data.py`,
+    writing each term into a hotline-style sentence."""
+    terms = [*prefixes, *suffixes, *addr1, *addr2, *finAPP, *finCRYPTO,
+             *finSVC, *finBANK, *finEVENTS_1A, *finEVENTS_1B, *finEVENTS_2A,
+             *finEVENTS_2B, *finACCTS, *finDETAILS, *finPRODUCT, *attrSocMed,
+             *govtORGS_1A, *govtORGS_1B, *govtPROGS_1A, *govtPROGS_1B,
+             *govtINVSTG_1A, *govtINVSTG_1B]
+    return [template.format(term=term, Term=term.title())
+            for term, template in zip(terms, cycle(TEMPLATES))]
+
+
+def ruler_spans(nlp, patterns:list, texts:list,
+                phrase_attr:str=None)->(list):
+    """Runs an entity ruler with `patterns` over `texts` and returns
+    the set of `(label, start_char, end_char)` entities per text.
+    Phrase patterns are matched on `phrase_attr` (default `ORTH`)."""
+    config = {"overwrite_ents": True, "validate": True,
+              "phrase_matcher_attr": phrase_attr}
+    ruler = nlp.add_pipe("entity_ruler", name="compiler_check", config=config)
+    ruler.add_patterns(patterns)
+    try:
+        return [{(ent.label_, ent.start_char, ent.end_char) for ent in doc.ents}
+                for doc in nlp.pipe(texts)]
+    finally:
+        nlp.remove_pipe("compiler_check")
+
+
+def check_equivalence(original:list, compiled:list, texts:list=None,
+                      nlp=None)->(dict):
+    """Reports whether compiled patterns find the same entities as
+    the original patterns on a fixture corpus.
+    Patterns that depend on `ENT_TYPE` can only be checked with an
+    `nlp` that has NER, e.g. `spacy.load("en_core_web_trf")`;
+    it must not already contain an entity ruler.
+
+    Args:
+    original (list): original patterns
+    compiled (list): patterns from `compile_patterns`
+    texts (list): fixture corpus; defaults to `fixture_corpus()`
+    nlp (Language): pipeline to run the rulers in;
+                    defaults to `spacy.blank("en")`
+
+    Returns:
+    report (dict): number of docs and entities compared, and
+                   the texts where the entities differ
+    """
+    if nlp is None:
+        nlp = spacy.blank("en")
+    if texts is None:
+        texts = fixture_corpus()
+    before = ruler_spans(nlp, original, texts)
+    after = ruler_spans(nlp, compiled, texts, phrase_attr="LOWER")
+    mismatches = [{"text": text,
+                   "original": sorted(a - b), "compiled": sorted(b - a)}
+                  for text, a, b in zip(texts, before, after) if a != b]
+    report = {"docs": len(texts),
+              "entities": sum(len(spans) for spans in before),
+              "mismatched_docs": len(mismatches),
+              "equivalent": len(mismatches) == 0,
+              "mismatches": mismatches}
+    print(f"[*] Equivalence on {len(texts)} fixture docs: "
+          f"{report['entities']} entities, {len(mismatches)} docs differ.")
+    return report
+
+
+def save_ruler_config(compiled:list, report:dict,
+                      output_dir:str)->(str):
+    """Saves compiled patterns as `patterns.jsonl`, the ruler
+    config the patterns need, and the compiler report.
+
+    Args:
+    compiled (list): patterns from `compile_patterns`
+    report (dict): compiler and equivalence report
+    output_dir (str): directory for the optimized ruler config
+
+    Returns:
+    pattern_path (str): path to the compiled pattern file
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    pattern_path = f"{output_dir}/patterns.jsonl"
+    with open(pattern_path, "w") as f:
+        for pattern in compiled:
+            f.write(json.dumps(pattern) + "\n")
+    with open(f"{output_dir}/cfg.json", "w") as f:
+        json.dump({"overwrite_ents": True, "validate": True,
+                   "phrase_matcher_attr": "LOWER"}, f, indent=2)
+    with open(f"{output_dir}/report.json", "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"[!] Optimized ruler config saved to: {output_dir}")
+    return pattern_path
+
+
+if __name__ == "__main__":
+    with open("patterns.json", "r") as f:
+        original = [json.loads(line) for line in f if line.strip()]
+    compiled, report = compile_patterns(original)
+    report["equivalence"] = check_equivalence(original, compiled)
+    save_ruler_config(compiled, report, "./optimized_ruler")
@@ -193,8 +193,8 @@ def review_extracts(data:pd.DataFrame, n:int)->(int):
     in a pandas dataframe. 
     """
     import pandas as pd
-    import spacy
-    nlp = spacy.load("demo")
+    from model_registry import get_model
+    nlp = get_model("demo")
     text = nlp(data[smryCol].iloc[n])
     
     print("="*54)
@@ -1,26 +1,51 @@
 import spacy
 from spacy.tokens import DocBin
+from spacy.matcher import Matcher, PhraseMatcher
 import os
+import json
+import time
+import shutil
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 from transform import *
+from extract_cache import *
+from pattern_compiler import compile_patterns
+from model_registry import *
+from long_docs import window_corpus, merge_windows
+from clean_markup import raw_offsets
+from checkpoint import checkpoint_path, save_checkpoint, load_checkpoint
+from metrics import step, end_step
+from entity_index import index_entities
 
 
-def config_patterns(patterns:list, model:str)->(str):
+def config_patterns(patterns:list, model:str, 
+                    optimize:bool=False)->(str):
     """Configures Entity Ruler by creating a pattern file
     from spaCy patterns defined in the list.
     See pattern_config.ipynb for more information.
+    If `optimize`, patterns are first compiled with 
+    `compile_patterns` (see pattern_compiler.py).
     
     Args:
     patterns (list): List of dictionaries containing
                     patterns for spaCy entity ruleer.
     model (str): Name of custom model for patterns.
+    optimize (bool): Compile patterns before adding them.
     
     Returns:
     pattern_path (str): path to JSON file containing
                         spaCy patterns.
     """
+    # A private copy of the base pipeline, not the shared one, so
+    # the ruler is saved under the standard `entity_ruler` name
     nlp = spacy.load("en_core_web_trf")
     config = {"overwrite_ents": True, "validate": True}
+    if optimize:
+        patterns, report = compile_patterns(patterns, nlp)
+        # Compiled phrase patterns are lower case
+        config["phrase_matcher_attr"] = "LOWER"
     ruler = nlp.add_pipe("entity_ruler", config=config)
     ruler.add_patterns(patterns)
     pattern_path = f"{model}/patterns.jsonl"
@@ -28,130 +53,799 @@ def config_patterns(patterns:list, model:str)->(str):
     nlp.to_disk(model)
     ruler.to_disk(pattern_path)
     ruler.to_disk(ruler_path)
+    forget_model(model)
     return pattern_path, ruler_path
 
 
-def save_extracts(data:pd.DataFrame, model:str, 
-                      output_path:str)->(None):
+def entity_table(data:pd.DataFrame, labels:list)->(pd.DataFrame):
+    """Flattens lists of entity extracts into one long-format
+    table with a row per entity, in a single pass over the data.
+    
+    Args:
+    data (pd.DataFrame): dataframe with `ID` and `entities` columns
+    labels (list): entity labels to keep
+    
+    If `data` has an `offset_map` column (see `clean_dirty_data`),
+    `raw_start` and `raw_end` give the span in the raw narrative.
+    
+    Returns:
+    entities (pd.DataFrame): table of `ID`, `label`, `ent_id`, 
+                             `text`, `start` and `end`
+    """
+    keep = set(labels)
+    records = [(doc_id, *ent) for doc_id, ents in zip(data["ID"], data["entities"])
+               for ent in ents if ent[0] in keep]
+    columns = ["ID", "label", "ent_id", "text", "start", "end"]
+    entities = pd.DataFrame.from_records(records, columns=columns)
+    entities["start"] = entities["start"].astype("int64")
+    entities["end"] = entities["end"].astype("int64")
+    if "offset_map" in data.columns:
+        # by row, not `ID`: IDs can repeat with different narratives
+        rows = [n for n, ents in enumerate(data["entities"])
+                for ent in ents if ent[0] in keep]
+        offset_maps = pd.Series(data["offset_map"].to_numpy()[rows])
+        entities["raw_start"], entities["raw_end"] = raw_offsets(
+            offset_maps, entities["start"], entities["end"])
+    return entities
+
+
+def extract_table(entities:pd.DataFrame, labels:list, ids,
+                  mode:str="first")->(pd.DataFrame):
+    """Pivots a long-format entity table (see `entity_table`)
+    into a wide table with a row per narrative and a column per
+    label. Entities are placed in their cells with one sort,
+    instead of a pass over every narrative for each label.
+
+    Args:
+    entities (pd.DataFrame): table of entities from `entity_table`
+    labels (list): entity labels, one column each
+    ids (list): unique narrative IDs, one row each, in this order
+    mode (str): "first" for the text of the first entity of each
+                label, or 0 if there is none; "all" for the list of
+                `(label, id, text, start_char, end_char)` tuples of
+                each label, as from `doc_extracts`, or [] if none
+
+    Returns:
+    table (pd.DataFrame): extract table indexed by `ids`
+    """
+    labels = list(dict.fromkeys(labels))
+    ids = pd.Index(ids)
+    # [1] Each entity's cell in the flattened table, in entity order
+    rows = ids.get_indexer(entities["ID"])
+    cols = pd.Index(labels).get_indexer(entities["label"])
+    found = np.flatnonzero((rows >= 0) & (cols >= 0))
+    cells = rows[found] * len(labels) + cols[found]
+    values = np.empty(len(ids) * len(labels), dtype=object)
+
+    # [2] Fill each cell from its entities; a stable sort keeps their order
+    if mode == "first":
+        values[:] = 0
+        cells, first = np.unique(cells, return_index=True)
+        values[cells] = entities["text"].to_numpy(dtype=object)[found[first]]
+    elif mode == "all":
+        ents = list(zip(*[entities[col].tolist() for col in 
+                          ["label", "ent_id", "text", "start", "end"]]))
+        order = np.argsort(cells, kind="stable")
+        cells, ents = cells[order], [ents[n] for n in found[order]]
+        starts = np.flatnonzero(np.diff(cells, prepend=-1) > 0)
+        ends = np.r_[starts[1:], len(cells)]
+        for cell, start, end in zip(cells[starts].tolist(), starts.tolist(), ends.tolist()):
+            values[cell] = ents[start:end]
+        empty = np.ones(len(values), dtype=bool)
+        empty[cells] = False
+        values[empty] = np.frompyfunc(lambda n: [], 1, 1)(np.empty(empty.sum()))
+    else:
+        raise ValueError(f"mode must be 'first' or 'all', not {mode!r}")
+    return pd.DataFrame(values.reshape(len(ids), len(labels)), 
+                        index=ids, columns=labels)
+
+
+def extract_labels(model:str)->(list):
+    """Entity labels of `model` that are saved to entity tables.
+    [1] Reads the entity labels of `model`, see `model_labels`.
+    [2] Exclude irrelevant entities.
+
+    Args:
+    model (str): Path to custom spaCy model.
+
+    Returns:
+    cols (list): entity labels to keep
+    """
+    # [1] Reads entity labels without loading the model
+    labels = model_labels(model)
+    cols = labels["entity_ruler"] + labels["ner"]
+    
+    # [2] Exclude irrelevent entity labels
+    drop = ["WORK_OF_ART", "ORDINAL", "CARDINAL", "LANGUAGE", 
+            "LAW", "PRODUCT", "PERCENT"]
+    return [col for col in cols if col not in drop]
+
+
+def write_entities(entities:pd.DataFrame, cols:list, output_path:str,
+                   json_view:bool=True)->(str):
+    """Saves an entity table as Parquet, partitioned by label, to
+    `entities/`, replacing any table already there, and optionally
+    derives a JSON file per label from it.
+
+    Args:
+    entities (pd.DataFrame): table of entity extracts
+    cols (list): entity labels, see `extract_labels`
+    output_path (str): Path to deposit outputs.
+    json_view (bool): Also save a JSON file for each label.
+
+    Returns:
+    table_path (str): path to the entity table
+    """
+    table_path = f"{output_path}/entities"
+    if os.path.isdir(table_path):
+        shutil.rmtree(table_path)
+    elif os.path.exists(table_path):
+        os.remove(table_path)
+    # An empty table has no partitions; it is saved as one file
+    # in the directory, so `entities/` is always a directory
+    if len(entities) > 0:
+        entities.to_parquet(table_path, partition_cols=["label"], index=False)
+    else:
+        os.makedirs(table_path)
+        entities.to_parquet(f"{table_path}/empty.parquet", index=False)
+    print(f"[*] {len(entities)} entities saved to: {table_path}")
+
+    groups = dict(tuple(entities.groupby("label", sort=False)))
+    for col in sorted(set(cols)):
+        extracts = groups.get(col, entities.iloc[:0])
+        if json_view:
+            extracts.to_json(f"{output_path}/{col}.json", orient="records")
+        print(f"----> {len(extracts)} {col} Found.")
+    return table_path
+
+
+def save_extracts(data:pd.DataFrame, model:str, output_path:str, 
+                  json_view:bool=True, index_path:str=None)->(pd.DataFrame):
     """Converts lists of entity extracts stored in 
-    a pandas dataframe to JSON files.
-    [1] Loads selected spaCy model with `model`.
-    [2] Exclude irrelevant entities. Use the remaining
-        entity labels to create columns.
-    [3] For each column, create a new column that contains a tuple
-        with the document ID, and any entities from the entity 
-        extracts where the label matches the column.
+    a pandas dataframe to an entity table.
+    [1] Reads the entity labels of `model`, see `extract_labels`.
+    [2] Build one long-format table of entities (`ID`, `label`,
+        `ent_id`, `text`, `start`, `end`) in a single pass, and
+        save it as Parquet, partitioned by label, to `entities/`.
+    [3] Optionally, derive a JSON file per label from the table,
+        see `write_entities`.
+    [4] Optionally, add the table to the entity index shared by
+        all sessions, see entity_index.py. Indexing is opt-in, so
+        scratch outputs (e.g. benchmarks) stay out of the index;
+        the pipelines pass the index path.
 
     Args:
     data (pd.DataFrame): dataframe of entity extracts
     model (str): Path to custom spaCy model.
     output_path (str): Path to deposit outputs.
+    json_view (bool): Also save a JSON file for each label.
+    index_path (str): Path to the entity index, or None (default) to skip it.
     
     Returns:
-    (None)
+    entities (pd.DataFrame): table of entity extracts
     """
     print("[JOB 3.3] Save Extracts to Entity Tables")
-    # [1] Loads selected spaCy model with `model`.
-    nlp = spacy.load(model)
-    cols = nlp.get_pipe('entity_ruler').labels
-    cols += nlp.get_pipe('ner').labels
+    step("3.3", len(data))
+    # [1] Entity labels to keep
+    cols = extract_labels(model)
+
+    # [2-3] Build and save the entity table, partitioned by label
+    entities = entity_table(data, cols)
+    write_entities(entities, cols, output_path, json_view)
+
+    # [4] Update the entity index with this session
+    if index_path is not None:
+        index_entities(entities, output_path, index_path)
+    end_step(len(entities))
+    return entities
+
+
+def flush_shard(doc_bin:DocBin, doc_bin_dir:str, 
+                manifest:dict)->(dict):
+    """Writes a DocBin to the next numbered shard and
+    rewrites the shard manifest, so every flushed shard
+    survives a crash later in the run.
     
-    # [2] Exclude irrelevent entity labels and make column names
-    drop = ["WORK_OF_ART", "ORDINAL", "CARDINAL", "LANGUAGE", 
-            "LAW", "PRODUCT", "PERCENT"]
-    cols = [col for col in cols if col not in drop]
-
-    # [3] For each column, create a new column that contains a tuple
-    # with the document ID, and any entities from the entity extracts
-    # where the label matches the column
-    for n, col in enumerate(list(set(cols))):
-        print(f"[*] {n}. Creating {col} DataFrame")
-        data[col] = list(zip(data["ID"], [[(ent) for ent in ents if ent[0]==col]
-            for ents in data["entities"]]))
-        data[col] = data[col].apply(lambda x: [[x[0], list(x[1][n])] 
-            for n in range(len(x[1]))] if len(x[1]) > 0 else "0")
-        extracts = pd.DataFrame([([items[0]] + items[1]) 
-            for row in data[col] for items in row if items != "0"])
-        extracts.to_json(f"{output_path}/{col}.json")
-        print(f"----> {len(extracts)} {col} Found.")
-    return
+    Args:
+    doc_bin (DocBin): Docs collected since the last flush
+    doc_bin_dir (str): Directory for DocBin shards
+    manifest (dict): Shard manifest, updated in place
+    
+    Returns:
+    manifest (dict): Shard manifest
+    """
+    shard = f"shard_{len(manifest['shards']):05d}.spacy"
+    doc_bin.to_disk(os.path.join(doc_bin_dir, shard))
+    manifest["shards"].append({"file": shard, "docs": len(doc_bin)})
+    manifest["docs"] += len(doc_bin)
+    with open(os.path.join(doc_bin_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=2)
+    print(f"[*] {shard}: {manifest['docs']} docs saved.")
+    return manifest
+
+
+def iter_docs(doc_bin_path:str, vocab)->(iter):
+    """Lazily streams Docs back from disk, one DocBin 
+    shard at a time, so only one shard is in memory.
+    
+    Args:
+    doc_bin_path (str): Shard directory written by 
+                        `entity_recognizer`, or a single
+                        `.spacy` DocBin file.
+    vocab (Vocab): Vocab of the spaCy model, `nlp.vocab`
+    
+    Yields:
+    doc (Doc): spaCy documents, in the order they were piped
+    """
+    if os.path.isfile(doc_bin_path):
+        yield from DocBin().from_disk(doc_bin_path).get_docs(vocab)
+        return
+    with open(os.path.join(doc_bin_path, "manifest.json"), "r") as f:
+        manifest = json.load(f)
+    for shard in manifest["shards"]:
+        doc_bin = DocBin().from_disk(os.path.join(doc_bin_path, shard["file"]))
+        yield from doc_bin.get_docs(vocab)
+
+
+def doc_extracts(doc)->(list):
+    """Extracts entities from a spaCy Doc as a list of
+    `(label, id, text, start_char, end_char)` tuples."""
+    return [(ent.label_, ent.id_, ent.text, 
+             ent.start_char, ent.end_char) 
+            for ent in doc.ents]
+
+
+def rules_patterns(patterns:list)->(list):
+    """Keeps the entity ruler patterns that can match without
+    the transformer. Patterns with a required `ENT_TYPE` token
+    depend on NER entities and are dropped; optional `ENT_TYPE`
+    tokens never match without NER, so those patterns are kept.
+    
+    Args:
+    patterns (list): List of dictionaries containing
+                    patterns for spaCy entity ruler.
+    
+    Returns:
+    patterns (list): patterns that do not depend on NER
+    """
+    def needs_ner(pattern):
+        if isinstance(pattern["pattern"], str):
+            return False
+        return any("ENT_TYPE" in token and token.get("OP") not in ("?", "*")
+                   for token in pattern["pattern"])
+    return [pattern for pattern in patterns if not needs_ner(pattern)]
+
+
+def rules_engine(pattern_path:str, optimize:bool=True):
+    """Builds a rules-only pipeline: the English tokenizer and an
+    entity ruler, with no transformer. Patterns are read from a
+    JSONL pattern file, e.g. `patterns.json` or the
+    `patterns.jsonl` written by `config_patterns`, and compiled
+    with `compile_patterns` (see pattern_compiler.py).
+    
+    Args:
+    pattern_path (str): path to a JSONL pattern file, or to a
+                        model directory containing `patterns.jsonl`
+    optimize (bool): Compile patterns before adding them.
+    
+    Returns:
+    nlp (Language): rules-only spaCy pipeline
+    """
+    if os.path.isdir(pattern_path):
+        pattern_path = f"{pattern_path}/patterns.jsonl"
+    with open(pattern_path, "r") as f:
+        patterns = [json.loads(line) for line in f if line.strip()]
+    kept = rules_patterns(patterns)
+    print(f"[*] Rules-only engine: {len(kept)} of {len(patterns)} patterns "
+          "do not depend on NER.")
+    nlp = spacy.blank("en")
+    config = {"overwrite_ents": True, "validate": True}
+    if optimize:
+        kept, report = compile_patterns(kept, nlp)
+        # Compiled phrase patterns are lower case
+        config["phrase_matcher_attr"] = "LOWER"
+    ruler = nlp.add_pipe("entity_ruler", config=config)
+    ruler.add_patterns(kept)
+    return nlp
+
+
+def model_size_mb(model:str)->(float):
+    """Size of a spaCy model directory on disk, in MB."""
+    if os.path.isfile(model):
+        return os.path.getsize(model) / 2**20
+    model_dir = model
+    if not os.path.isdir(model_dir):
+        model_dir = str(spacy.util.get_package_path(model))
+    size = sum(os.path.getsize(os.path.join(root, name)) 
+               for root, dirs, files in os.walk(model_dir) for name in files)
+    return size / 2**20
+
+
+def available_memory_mb()->(float):
+    """Available physical memory in MB, or None if unknown.
+    On Linux this is `MemAvailable` from `/proc/meminfo`, which
+    counts reclaimable page cache; free pages alone under-count
+    it on any machine that has been reading files."""
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        pages = os.sysconf("SC_AVPHYS_PAGES")
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+# Batches timed for each candidate batch size in `tune_pipe`
+TUNE_BATCHES = 2
+
+
+def tune_pipe(nlp, texts:list, disable:list, model:str,
+              load_seconds:float, sample_size:int=256,
+              seed:int=0)->(int, int, float):
+    """Picks `n_process` and `batch_size` for `nlp.pipe`.
+    [1] Candidate batch sizes are derived from the narrative
+        length distribution, so a batch holds a similar
+        number of characters however long the narratives are.
+    [2] Each candidate is timed on `TUNE_BATCHES` full batches from
+        one shared calibration sample of `sample_size` texts, in one
+        process, and the fastest is kept. Candidates are capped at
+        `sample_size // TUNE_BATCHES`, so tuning pipes a fixed,
+        small number of texts, however large the corpus or the model.
+        A corpus smaller than the sample is not tuned.
+    [3] `n_process` is limited by the core count and by the
+        available memory, assuming each process holds a copy 
+        of the model (twice its size on disk). Extra processes
+        are only used if the time they save is more than the
+        time it takes each of them to load the model.
+    
+    Args:
+    nlp (Language): loaded spaCy pipeline
+    texts (list): corpus of text documents
+    disable (list): pipes disabled while piping
+    model (str): Path to custom spaCy model.
+    load_seconds (float): Time taken to load the model.
+    sample_size (int): Number of texts in the calibration sample.
+    seed (int): Seed for the calibration sample.
+    
+    Returns:
+    n_process (int): number of processes for `nlp.pipe`
+    batch_size (int): batch size for `nlp.pipe`
+    docs_per_sec (float): measured single process throughput
+    or None, if the corpus is smaller than the calibration sample
+    """
+    if len(texts) < sample_size:
+        print(f"[*] Fewer than {sample_size} texts; pipe settings are not tuned.")
+        return None
+    print("[*] Tuning `n_process` and `batch_size` on a calibration sample")
+    rng = np.random.default_rng(seed)
+    lengths = np.array([len(text) for text in texts])
+
+    # [1] Candidate batch sizes, about 500k characters per batch,
+    # capped so each is timed on `TUNE_BATCHES` batches of the sample
+    median = max(float(np.median(lengths)), 1.0)
+    base = int(np.clip(500000 // median, 16, 4096))
+    cap = max(sample_size // TUNE_BATCHES, 1)
+    candidates = sorted({int(np.clip(size, min(8, cap), cap)) 
+                         for size in (base // 4, base, base * 4)})
+    sample = rng.choice(len(texts), size=sample_size, replace=False)
+    sample = [texts[n] for n in sample]
+
+    # [2] Time each candidate after a warm up batch
+    list(nlp.pipe(sample[:8], disable=disable))
+    rates = {}
+    for batch_size in candidates:
+        batches = sample[:TUNE_BATCHES * batch_size]
+        start = time.perf_counter()
+        for doc in nlp.pipe(batches, batch_size=batch_size, disable=disable):
+            pass
+        rates[batch_size] = len(batches) / max(time.perf_counter() - start, 1e-9)
+        print(f"----> batch_size={batch_size}: {rates[batch_size]:.1f} docs/sec")
+    batch_size = max(rates, key=rates.get)
+    docs_per_sec = rates[batch_size]
+
+    # [3] Processes allowed by cores and memory, if worth starting
+    max_process = os.cpu_count() or 1
+    memory = available_memory_mb()
+    if memory is not None:
+        model_mb = max(model_size_mb(model), 1.0)
+        max_process = min(max_process, int(memory // (2 * model_mb)))
+    max_process = max(1, min(max_process, int(np.ceil(len(texts) / batch_size))))
+    serial_seconds = len(texts) / docs_per_sec
+    costs = {p: serial_seconds / p + (load_seconds if p > 1 else 0)
+             for p in range(1, max_process + 1)}
+    n_process = min(costs, key=costs.get)
+    print(f"[*] Tuned pipe: n_process={n_process}, batch_size={batch_size}")
+    return n_process, batch_size, docs_per_sec
+
+
+def profile_ruler(nlp, texts:list, output_path:str, disable:list=None,
+                  ruler_name:str="entity_ruler")->(pd.DataFrame):
+    """Profiles each entity ruler pattern on a corpus.
+    Each pattern gets its own matcher, so its matching time can be
+    measured on its own. For each pattern, records:
+    [1] `matches`: number of matches.
+    [2] `survivors`: matches that are still entities after the
+        ruler resolves overlaps and `overwrite_ents`.
+    [3] `seconds`: cumulative matching time.
+    The report is saved to `ruler_profile.csv` in `output_path`.
+    Patterns with no matches are dead weight; patterns with many
+    matches and few survivors cost time without adding entities.
+    [!] Profiling is a separate pass on a sample, with one matcher per
+        pattern. `seconds` includes each matcher's fixed overhead, and
+        their sum exceeds the time the real ruler, which matches all
+        patterns at once, takes on the same docs (also printed). Use
+        `seconds` to rank patterns against each other, not as each
+        pattern's share of the ruler's runtime.
+    
+    Args:
+    nlp (Language): pipeline containing the entity ruler
+    texts (list): corpus of text documents
+    output_path (str): Path to deposit the report.
+    disable (list): Pipes to disable, as in `nlp.pipe`, or None.
+    ruler_name (str): Name of the entity ruler pipe.
+    
+    Returns:
+    profile (pd.DataFrame): matches, survivors and seconds per pattern
+    """
+    print("[*] Profiling entity ruler patterns")
+    ruler = nlp.get_pipe(ruler_name)
+    patterns = ruler.patterns
+    attr = ruler.phrase_matcher_attr or "ORTH"
+    matchers = []
+    for pattern in patterns:
+        if isinstance(pattern["pattern"], str):
+            matcher = PhraseMatcher(nlp.vocab, attr=attr)
+            matcher.add(pattern["label"], [nlp.make_doc(pattern["pattern"])])
+        else:
+            matcher = Matcher(nlp.vocab)
+            matcher.add(pattern["label"], [pattern["pattern"]])
+        matchers.append(matcher)
+    matches = np.zeros(len(patterns), dtype=np.int64)
+    survivors = np.zeros(len(patterns), dtype=np.int64)
+    seconds = np.zeros(len(patterns))
+    ruler_seconds = 0.0
+    
+    # Upstream pipes run once, so `ENT_TYPE` patterns see NER entities
+    for doc in nlp.pipe(texts, disable=[*(disable or []), ruler_name]):
+        spans = []
+        for n, matcher in enumerate(matchers):
+            tic = time.perf_counter()
+            found = matcher(doc)
+            seconds[n] += time.perf_counter() - tic
+            matches[n] += len(found)
+            spans.append({(start, end) for match_id, start, end in found})
+        tic = time.perf_counter()
+        doc = ruler(doc)
+        ruler_seconds += time.perf_counter() - tic
+        ents = {(ent.label_, ent.start, ent.end) for ent in doc.ents}
+        for n, pattern in enumerate(patterns):
+            survivors[n] += sum((pattern["label"], start, end) in ents 
+                                for start, end in spans[n])
+
+    profile = pd.DataFrame({"label": [pattern["label"] for pattern in patterns],
+                            "pattern": [json.dumps(pattern["pattern"]) 
+                                        for pattern in patterns],
+                            "matches": matches, "survivors": survivors,
+                            "seconds": seconds})
+    profile = profile.sort_values("seconds", ascending=False)
+    profile_path = f"{output_path}/ruler_profile.csv"
+    profile.to_csv(profile_path, index_label="pattern_index")
+    print(f"[*] {(profile['matches'] == 0).sum()} of {len(profile)} patterns "
+          f"never matched in {len(texts)} docs.")
+    print(f"[*] Entity ruler: {ruler_seconds:.3f}s on these docs; per-pattern "
+          f"matchers: {seconds.sum():.3f}s in total.")
+    print(f"[!] Ruler profile saved to: {profile_path}")
+    return profile
 
 
 def entity_recognizer(docs:list, session_path:str, 
-                      model:str)->(list, list):
+                      model:str, cache_path:str=None,
+                      cache_max_mb:float=1024,
+                      shard_size:int=10000, save_docs:bool=True,
+                      n_process:int=4, batch_size:int=2000,
+                      autotune:bool=False, 
+                      log:pd.DataFrame=None,
+                      mode:str="transformer", profile:bool=False,
+                      profile_sample:int=1000, max_chars:int=None,
+                      overlap_chars:int=300, 
+                      doc_bin_dir:str=None, ids:list=None,
+                      checkpoint:bool=False, 
+                      resume:bool=False, chunked:bool=False)->(str, list):
     """[JOB 3: Entity Recognizer]
     Accepts a corpus of text data, converts
-    each document to a spaCy Doc object, and saves
-    as a spaCy object using the spaCy pipe.
-    Entities are extracted from each Doc and
-    passed as a list.
+    each document to a spaCy Doc object using the
+    spaCy pipe. Entities are extracted from each Doc
+    as it is piped and passed as a list.
+    If `save_docs`, Docs are also saved as a side output,
+    flushed in the background to numbered DocBin shards
+    every `shard_size` docs, listed in `manifest.json`.
+    If `cache_path` is given, texts with extracts cached by an
+    earlier session for the same model and patterns are skipped,
+    and are not saved to the DocBin shards.
+    If `autotune`, `n_process` and `batch_size` are picked by
+    `tune_pipe`, and the settings and docs/sec are logged.
+    With `mode="rules"`, the transformer is not loaded; only the
+    patterns that do not depend on NER run, see `rules_engine`.
+    If `profile`, the entity ruler patterns are profiled on up to
+    `profile_sample` texts, see `profile_ruler`.
+    If `max_chars` is set, narratives longer than `max_chars` are
+    split into overlapping sentence-aligned windows that are piped
+    in the same batches as short narratives; extracts are mapped
+    back to narrative offsets and merged, see long_docs.py. The
+    saved Docs are then windows, with `user_data["window"]` set to
+    the narrative index and character offset.
+    If `checkpoint`, the extracts of finished rows are appended to
+    `checkpoint/extracts.jsonl` in `session_path` with every shard
+    (or every `shard_size` rows, without Docs). With `resume`, rows
+    in the checkpoint whose narrative is unchanged are not processed
+    again, and new shards continue the existing manifest.
+    If `chunked`, `docs` is an iterable of `(texts, ids)` chunks, e.g.
+    the accepted chunks of the staged pipeline. Chunks are read as
+    `nlp.pipe` needs more texts, so one `nlp.pipe` call, and one pool
+    of `n_process` processes, serves every chunk; `autotune` tunes on
+    the first chunk.
     
     Args:
     docs (list): corpus of text documents, as a list
     session_path (str): Path to deposit outputs.
     model (str): Path to custom spaCy model.
+    cache_path (str): Path to the extraction cache, or None.
+    cache_max_mb (float): Size cap of the cache; least recently
+                          used extracts are evicted past it.
+    shard_size (int): Number of Docs per DocBin shard.
+    save_docs (bool): Save Docs to DocBin shards.
+    n_process (int): Number of processes for `nlp.pipe`.
+    batch_size (int): Batch size for `nlp.pipe`.
+    autotune (bool): Tune `n_process` and `batch_size`.
+    log (pd.DataFrame): Session log, or None.
+    mode (str): "transformer" for the full model, or "rules"
+                for the rules-only engine. In "rules" mode, 
+                `model` may also be a JSONL pattern file.
+    profile (bool): Profile the entity ruler patterns.
+    profile_sample (int): Number of texts to profile on.
+    max_chars (int): Window size for long narratives, or None.
+    overlap_chars (int): Overlap between consecutive windows.
+    doc_bin_dir (str): Directory for DocBin shards; defaults 
+                       to `doc_bins/` in `session_path`.
+    ids (list): Row IDs for the checkpoint; defaults to positions.
+    checkpoint (bool): Checkpoint finished rows.
+    resume (bool): Resume from the checkpoint in `session_path`.
+    chunked (bool): `docs` is an iterable of `(texts, ids)` chunks.
     
     Returns:
-    docs (list): spaCy documents
+    doc_bin_dir_path (str): directory of DocBin shards, 
+                            read back with `iter_docs`,
+                            or None if Docs are not saved
     extracts (list): spaCy entity extracts from docs
     """
-    print("[JOB 3.1] Converting SpaCy to Docs and DocBins")
+    print("[JOB 3.1] Converting Text to SpaCy Docs")
+    if chunked:
+        chunks = iter(docs)
+        step("3.1")
+    else:
+        docs = list(docs)
+        chunks = iter([(docs, ids)])
+        step("3.1", len(docs))
     
-    # [1] Load spaCy model
-    nlp = spacy.load(model)
-    print(f"[*] Using spaCy model: {model}")
+    # [1] Load spaCy model, or build the rules-only engine
+    loader = rules_engine if mode == "rules" else spacy.load
+    nlp = get_model(model, loader=loader)
+    print(f"[*] Using spaCy model: {model} ({mode})")
     
     # [2] Disabling unneeded pipes
     disable = ["tok2vec", "tagger", "parser", 
                "attribute_ruler", "lemmatizer"]
+    disable = [pipe for pipe in disable if pipe in nlp.pipe_names]
     print(f"[*] Disabling pipes: {disable}")
 
-    # [3] Creating container and directory for Doc Bins
-    doc_bin = DocBin()
-    doc_bin_dir_path = f"{session_path}/doc_bins/"
-    while not os.path.exists(doc_bin_dir_path):
-        os.mkdir(doc_bin_dir_path)
+    # [3] Skipping texts with cached or checkpointed extracts, chunk by
+    # chunk as `nlp.pipe` reads `source`; the lists below grow with it
+    texts, ids, hashes, todo = [], [], [], []
+    cached, done, checkpointed = {}, {}, {}
+    windowed = max_chars is not None
+    doc_index, offsets, window_counts, chunk_ends = [], [], [], []
+    hashed = cache_path is not None or checkpoint or resume
+    if cache_path is not None:
+        fingerprint = extract_fingerprint(model, mode, max_chars, overlap_chars)
+        conn = open_cache(cache_path)
+    if resume:
+        checkpointed = load_checkpoint(checkpoint_path(session_path))
+
+    def source():
+        for chunk_texts, chunk_ids in chunks:
+            first = len(texts)
+            texts.extend(chunk_texts)
+            ids.extend(range(first, len(texts)) if chunk_ids is None 
+                       else pd.Series(chunk_ids).tolist())
+            rows = range(first, len(texts))
+            if hashed:
+                hashes.extend(narrative_hash(texts[n]) for n in rows)
+            if cache_path is not None:
+                cached.update(cache_get(conn, fingerprint, hashes[first:]))
+            if resume:
+                done.update({n: checkpointed[ids[n]][1] for n in rows
+                             if ids[n] in checkpointed 
+                             and checkpointed[ids[n]][0] == hashes[n]})
+            chunk_todo = [n for n in rows if not hashed or 
+                          (hashes[n] not in cached and n not in done)]
+            pipe_texts = [texts[n] for n in chunk_todo]
+            if windowed:
+                pipe_texts, chunk_index, chunk_offsets = window_corpus(
+                                        pipe_texts, max_chars, overlap_chars)
+                doc_index.extend(chunk_index + len(todo))
+                offsets.extend(chunk_offsets)
+                window_counts.extend(np.bincount(chunk_index, 
+                                                 minlength=len(chunk_todo)))
+            todo.extend(chunk_todo)
+            chunk_ends.append(len(todo))
+            yield from pipe_texts
+
+    # Tuning needs texts up front, so it reads the first chunk
+    if autotune:
+        first_chunk = next(chunks, None)
+        if first_chunk is not None:
+            chunks = itertools.chain([first_chunk], chunks)
+            tuned = tune_pipe(nlp, list(first_chunk[0]), disable, model,
+                              load_seconds(model, loader))
+            if tuned is not None:
+                n_process, batch_size, tuned_rate = tuned
+                if log is not None:
+                    log.loc["PipeTunedDocsPerSec"] = round(tuned_rate, 2)
+
+    # [4] Creating container, directory, manifest and writer for Doc Bins
+    # and checkpoints; a resumed run continues the shard numbering
+    doc_bin_dir_path = None
+    writer, pending = ThreadPoolExecutor(max_workers=1), []
+    if save_docs:
+        doc_bin = DocBin(store_user_data=windowed)
+        doc_bin_dir_path = doc_bin_dir or f"{session_path}/doc_bins/"
+        while not os.path.exists(doc_bin_dir_path):
+            os.makedirs(doc_bin_dir_path)
+        manifest = {"model": model, "docs": 0, "shards": []}
+        manifest_path = os.path.join(doc_bin_dir_path, "manifest.json")
+        if resume and os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
      
-    # [4] Process text into spaCy Docs
+    # [5] Process text into spaCy Docs and extract entities inline
     # Toggle batch size for performance.
     # Depending on your CPU, you may want to
-    # change `n_process`.
-    for doc in nlp.pipe(docs, batch_size=2000, 
-                 n_process=4, disable=disable):
-        doc_bin.add(doc)
-        
-    # [5] Save as a spacy file, return the filepath
-    # This step protects your results and allows you to 
-    # retrieve your results without running the pipeline again
-    doc_bin_path = f"{doc_bin_dir_path}/doc_bin.spacy"
-    doc_bin.to_disk(doc_bin_path)
-
-    print("[JOB 3.2] Retrieving DocBins and Extracting Entities")
-    doc_bin = DocBin().from_disk(doc_bin_path)
-    docs = list(doc_bin.get_docs(nlp.vocab))
-    extracts = [[(ent.label_, ent.id_, ent.text, 
-                    ent.start_char, ent.end_char) 
-                    for ent in doc.ents] for doc in docs]
-    return docs, extracts
+    # change `n_process`, or set `autotune`.
+    # Each full DocBin is saved as a shard by a background writer
+    # and released, which protects your results if the run is 
+    # interrupted without holding up extraction.
+    # If `checkpoint`, the extracts of the rows in each shard are
+    # appended to the checkpoint by the same writer, after the shard.
+    # Docs come back from `nlp.pipe` in order, also with several
+    # processes, so the n-th finished narrative is always `todo[n]`.
+    if log is not None:
+        log.loc["PipeNProcess"] = n_process
+        log.loc["PipeBatchSize"] = batch_size
+
+    def flush(doc_bin, first, last):
+        if doc_bin is not None:
+            pending.append(writer.submit(flush_shard, doc_bin, 
+                                         doc_bin_dir_path, manifest))
+        if checkpoint or resume:
+            records = [{"id": ids[todo[n]], "hash": hashes[todo[n]],
+                        "entities": new_extracts[n]} for n in range(first, last)]
+            pending.append(writer.submit(save_checkpoint, 
+                                         checkpoint_path(session_path), records))
+        # at most two shards (and their checkpoints) wait for the writer
+        while len(pending) > 4:
+            pending.pop(0).result()
+
+    def end_chunks(finished):
+        # a chunked run logs a 3.2 step per chunk, once its narratives
+        # are finished; the last chunk is logged after the loop
+        nonlocal started, chunk_done
+        while chunked and len(chunk_ends) > 1 and finished >= chunk_ends[0]:
+            end_step(chunk_ends[0] - started, chunk=chunk_done)
+            step("3.2")
+            started, chunk_done = chunk_ends.pop(0), chunk_done + 1
+
+    print("[JOB 3.2] Extracting Entities")
+    step("3.2")
+    new_extracts, window_extracts, flushed = [], [], 0
+    started, chunk_done = 0, 0
+    start = time.perf_counter()
+    for i, doc in enumerate(nlp.pipe(source(), batch_size=batch_size, 
+                            n_process=n_process, disable=disable)):
+        if save_docs:
+            if windowed:
+                doc.user_data["window"] = (todo[doc_index[i]], int(offsets[i]))
+            doc_bin.add(doc)
+        # Narratives are only finished after their last window
+        if windowed:
+            window_extracts.append(doc_extracts(doc))
+            if len(window_extracts) < window_counts[doc_index[i]]:
+                continue
+            k = len(window_extracts)
+            ents = merge_windows(window_extracts, np.zeros(k, dtype=np.int64),
+                                 np.array(offsets[i+1-k:i+1], dtype=np.int64), 1)[0]
+            window_extracts = []
+        else:
+            ents = doc_extracts(doc)
+        new_extracts.append(ents)
+        end_chunks(len(new_extracts))
+        if (save_docs and len(doc_bin) >= shard_size) or (
+                not save_docs and len(new_extracts) - flushed >= shard_size):
+            flush(doc_bin if save_docs else None, flushed, len(new_extracts))
+            flushed = len(new_extracts)
+            if save_docs:
+                doc_bin = DocBin(store_user_data=windowed)
+    if save_docs and (len(doc_bin) > 0 or manifest["docs"] + len(pending) == 0):
+        flush(doc_bin, flushed, len(new_extracts))
+    elif len(new_extracts) > flushed:
+        flush(None, flushed, len(new_extracts))
+    for future in pending:
+        future.result()
+    writer.shutdown()
+    end_chunks(len(new_extracts))
+    docs_per_sec = len(todo) / max(time.perf_counter() - start, 1e-9)
+    end_step(len(todo) - started, n_process=n_process, batch_size=batch_size,
+             windows=len(doc_index) if windowed else len(todo),
+             **({"chunk": chunk_done} if chunked else {}))
+    if cache_path is not None:
+        print(f"[*] {sum(h in cached for h in hashes)} of {len(texts)} "
+              f"texts found in extraction cache: {cache_path}")
+    if resume:
+        print(f"[*] Resumed: {len(done)} of {len(texts)} rows already extracted.")
+    if windowed:
+        print(f"[*] {len(todo)} narratives split into {len(doc_index)} "
+              f"windows of up to {max_chars} characters.")
+        if log is not None:
+            log.loc["LongDocWindows"] = len(doc_index)
+    print(f"[*] {len(todo)} docs extracted at {docs_per_sec:.1f} docs/sec")
+    if log is not None:
+        log.loc["ExtractionDocsPerSec"] = round(docs_per_sec, 2)
+    if profile:
+        profile_ruler(nlp, texts[:profile_sample], session_path, disable)
+
+    # [6] Caching new extracts and merging with cached and checkpointed extracts
+    if cache_path is None and not done:
+        return doc_bin_dir_path, new_extracts
+    if cache_path is not None:
+        cache_put(conn, fingerprint, [hashes[n] for n in todo], new_extracts,
+                  max_mb=cache_max_mb)
+        conn.close()
+    extracts = [done[n] if n in done else cached.get(h) 
+                for n, h in enumerate(hashes)]
+    for n, ents in zip(todo, new_extracts):
+        extracts[n] = ents
+    return doc_bin_dir_path, extracts
 
 
 def extraction_engine(input_path:str, model:str, 
-        session_path:str, log:pd.DataFrame)->(None):
+        session_path:str, log:pd.DataFrame,
+        cache_path:str="./cache/extracts.sqlite", cache_max_mb:float=1024,
+        save_docs:bool=True, autotune:bool=False,
+        mode:str="transformer", profile:bool=False,
+        max_chars:int=None, sample_size:int=200,
+        checkpoint:bool=True, resume:bool=False,
+        index_path:str="./index/entities.sqlite")->(None):
     """ JOB 2A: Retrieves accepted narratives, performs 
     extraction, and saves Docs and extracts to disk.
     
     [1] Extraction pipeline retrieves narrative accepted for
-    auto-extraction as by `JOB 1: DATA PREPARATION` as JSON
-    files. Reads files in with `pd.read_json`.
+    auto-extraction as by `JOB 1: DATA PREPARATION` from
+    `accepted.csv`. Only the columns JOB 3 uses are read,
+    with `read_accepted`.
     
     [2] Narrative data is selected from the dataframe in
     the `narrative` column. 
     - This passed to the `entity_recognizer`. 
     - Narratives are returned as a tuple, containing the 
-    spaCy Doc and the extracts.
+    directory of spaCy DocBin shards and the extracts.
+    - Docs can be streamed back lazily with `iter_docs`.
     
-    [3] New columns are added to the dataframe that contain
-    the spaCy documents, and the extracts.
+    [3] A new column is added to the dataframe that contains
+    the extracts.
     
     [4] Updated is passed to `save_extracts`, and carries with
     it the session path and model.
@@ -161,20 +855,43 @@ def extraction_engine(input_path:str, model:str,
     model (str): path to selected spaCy model
     session_path (str): path generated for outputs
     log (pd.DataFrame): session log
+    cache_path (str): path to the extraction cache, or None to disable
+    cache_max_mb (float): size cap of the extraction cache, in MB
+    save_docs (bool): also save Docs to DocBin shards
+    autotune (bool): tune `n_process` and `batch_size` for `nlp.pipe`
+    mode (str): "transformer", or "rules" for the rules-only engine
+    profile (bool): profile the entity ruler patterns, see `profile_ruler`
+    max_chars (int): split longer narratives into windows, or None;
+                     use with `save_transformation(long_docs=True)`
+    sample_size (int): number of narratives to extract, or None for all;
+                       the sample is the same on every run, so a
+                       resumed run continues the same rows
+    checkpoint (bool): checkpoint finished rows, see `entity_recognizer`
+    resume (bool): resume from the checkpoint in `session_path`
+    index_path (str): path to the entity index, or None to skip it
     
     Returns:
     log (pd.DataFrame): session log
     """
     accepted_path = f"{session_path}/transformed/accepted.csv"
-    data = pd.read_csv(accepted_path)
-    data = data.sample(200)
+    data = read_accepted(accepted_path)
+    if sample_size is not None and sample_size < len(data):
+        data = data.sample(sample_size, random_state=0)
     docs = data["narratives"]
+    ids = data["ID"] if "ID" in data.columns else None
     
-    docs, extracts = entity_recognizer(docs, session_path, model)
+    doc_bin_dir, extracts = entity_recognizer(docs, session_path, model,
+                                              cache_path=cache_path,
+                                              cache_max_mb=cache_max_mb,
+                                              save_docs=save_docs,
+                                              autotune=autotune, log=log,
+                                              mode=mode, profile=profile,
+                                              max_chars=max_chars, ids=ids,
+                                              checkpoint=checkpoint,
+                                              resume=resume)
     
-    data["documents"] = docs
     data["entities"] = extracts
     
-    save_extracts(data, model, session_path)
+    save_extracts(data, model, session_path, index_path=index_path)
     
     return log
\ No newline at end of file
@@ -0,0 +1,136 @@
+import time
+import queue
+import threading
+import pandas as pd
+from metrics import event
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+class StageFailed:
+    """Passed downstream when a stage raises, so the error is
+    raised again in the thread consuming the pipeline."""
+    def __init__(self, name:str, error:BaseException):
+        self.name = name
+        self.error = error
+
+
+class Stage(threading.Thread):
+    """Runs one pipeline stage on its own thread. A stage is a
+    generator function, e.g. `EdgeCaseDetectorChunked`, that takes
+    the items of the previous stage and yields its own; the first
+    stage is any iterable. Items are passed through bounded queues,
+    so a slow stage holds back the stages before it instead of
+    letting their outputs pile up in memory.
+    `busy` is the time spent working, not waiting on a queue.
+    """
+    def __init__(self, name:str, work, inbox:queue.Queue,
+                 outbox:queue.Queue, stop:threading.Event):
+        super().__init__(name=name, daemon=True)
+        self.work, self.inbox, self.outbox = work, inbox, outbox
+        self.stop, self.busy, self.items = stop, 0.0, 0
+
+    def put(self, item)->(float):
+        start = time.perf_counter()
+        while not self.stop.is_set():
+            try:
+                self.outbox.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        return time.perf_counter() - start
+
+    def drain(self):
+        while not self.stop.is_set():
+            start = time.perf_counter()
+            try:
+                item = self.inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            finally:
+                self.waited += time.perf_counter() - start
+            if item is _DONE:
+                return
+            if isinstance(item, StageFailed):
+                self.failed = item
+                return
+            yield item
+
+    def run(self):
+        start, self.waited, self.failed = time.perf_counter(), 0.0, None
+        try:
+            items = self.work if self.inbox is None else self.work(self.drain())
+            for item in items:
+                self.waited += self.put(item)
+                self.items += 1
+        except BaseException as error:
+            self.failed = self.failed or StageFailed(self.name, error)
+        finally:
+            if self.failed is not None:
+                self.put(self.failed)
+            self.busy = time.perf_counter() - start - self.waited
+            self.put(_DONE)
+
+
+def run_stages(source, stages:list, log:pd.DataFrame=None, maxsize:int=2):
+    """Connects a source and a list of stages with bounded queues
+    and runs each on its own thread; the caller consumes the output
+    of the last stage, e.g. with the entity recognizer. All stages
+    work at the same time on different chunks, so the wall time
+    approaches the time of the slowest stage rather than the sum.
+    Pandas and regex stages share the GIL; stages that release it
+    (file reads, spaCy/torch) overlap best.
+
+    Args:
+    source (iterable): items for the first stage, e.g. a generator of chunks
+    stages (list): `(name, work)` pairs; `work` takes an iterator of
+                   items from the previous stage and yields its own
+    log (pd.DataFrame): Session log for the busy time of each stage, or None
+    maxsize (int): Number of items each queue holds
+
+    Yields:
+    item: outputs of the last stage
+    """
+    stop = threading.Event()
+    outbox = queue.Queue(maxsize=maxsize)
+    threads = [Stage("source", source, None, outbox, stop)]
+    for name, work in stages:
+        inbox, outbox = outbox, queue.Queue(maxsize=maxsize)
+        threads.append(Stage(name, work, inbox, outbox, stop))
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = outbox.get()
+            if item is _DONE:
+                break
+            if isinstance(item, StageFailed):
+                print(f"[!] Stage `{item.name}` failed.")
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+    for thread in threads:
+        print(f"[*] Stage `{thread.name}`: {thread.items} items, "
+              f"{thread.busy:.1f}s busy")
+        if log is not None:
+            log.loc[f"StageSeconds_{thread.name}"] = round(thread.busy, 2)
+        event(event="stage", stage=thread.name, items=thread.items,
+              busy_seconds=round(thread.busy, 4))
+
+
+def stage_log()->(pd.DataFrame):
+    """Creates a log for one stage. Stages run at the same time, so
+    each writes to its own log, merged with `merge_logs` at the end."""
+    return pd.DataFrame(columns=["Description"])
+
+
+def merge_logs(log:pd.DataFrame, stage_logs:list)->(pd.DataFrame):
+    """Copies the entries of each stage log into the session log."""
+    for stage in stage_logs:
+        for key in stage.index:
+            log.loc[key] = stage.loc[key, "Description"]
+    return log
@@ -0,0 +1,13 @@
+import os
+import sys
+import pytest
+import pandas as pd
+
+# The modules live at the top of the repository, next to `main.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def log():
+    """An empty session log, as started by `transform_data`."""
+    return pd.DataFrame(columns=["Description"], dtype=object)
@@ -0,0 +1,15 @@
+import numpy as np
+from benchmark import timed
+
+
+def allocate(mb):
+    block = np.ones(mb * 2**20 // 8)
+    return float(block.sum())
+
+
+def test_timed_samples_rss_of_the_call():
+    _, small = timed(allocate, 1, repeats=2)
+    _, large = timed(allocate, 200, repeats=2)
+    assert large["rss_delta_mb"] >= 150
+    assert small["rss_delta_mb"] < 50
+    assert large["wall_seconds"] <= large["median_seconds"]
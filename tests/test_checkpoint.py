@@ -0,0 +1,39 @@
+import pytest
+from checkpoint import checkpoint_path, save_checkpoint, load_checkpoint
+from spacy_nlp import entity_recognizer
+
+
+@pytest.fixture
+def model(tmp_path):
+    path = tmp_path / "patterns.json"
+    path.write_text('{"label": "PHONE", "pattern": [{"SHAPE": "ddd"}, {"ORTH": "-"}, '
+                    '{"SHAPE": "ddd"}, {"ORTH": "-"}, {"SHAPE": "dddd"}]}\n')
+    return str(path)
+
+
+def test_checkpoint_appends_and_skips_truncated_line(tmp_path):
+    path = checkpoint_path(str(tmp_path))
+    assert save_checkpoint(path, [{"id": 1, "hash": "a", "entities": []}]) == 1
+    save_checkpoint(path, [{"id": 2, "hash": "b",
+                            "entities": [["PHONE", "", "555", 0, 3]]}])
+    with open(path, "a") as f:
+        f.write('{"id": 3, "hash": "c", "ent')
+    assert load_checkpoint(path) == {1: ("a", []), 2: ("b", [("PHONE", "", "555", 0, 3)])}
+
+
+def test_resume_skips_unchanged_rows(tmp_path, model, capsys):
+    session = str(tmp_path / "session")
+    texts = [f"call me at 555-123-{n:04d} about my loan" for n in range(20)]
+    ids = [f"ID{n}" for n in range(20)]
+    args = dict(ids=ids, save_docs=False, n_process=1, batch_size=8, mode="rules")
+    _, first = entity_recognizer(texts, session, model, checkpoint=True, **args)
+    assert all(len(ents) == 1 for ents in first)
+    # a row edited since the checkpoint is extracted again
+    texts[5] = "call me at 555-999-0000 instead"
+    capsys.readouterr()
+    _, resumed = entity_recognizer(texts, session, model, resume=True, **args)
+    out = capsys.readouterr().out
+    assert "Resumed: 19 of 20 rows already extracted." in out
+    assert "[*] 1 docs extracted" in out
+    assert resumed[:5] == first[:5] and resumed[6:] == first[6:]
+    assert [ent[2] for ent in resumed[5]] == ["555-999-0000"]
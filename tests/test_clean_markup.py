@@ -0,0 +1,53 @@
+import json
+import pandas as pd
+from clean_markup import (clean_markup, map_span, normalize_map, compose_maps,
+                          clean_dirty_data)
+from spacy_nlp import entity_table
+
+RAW = '<p>Sent $500 to   <b>Chase&amp;Co</b></p><br/><img alt="scan.png"> today'
+
+
+def test_clean_markup_removes_tags_and_decodes():
+    clean, offset_map = clean_markup(RAW)
+    assert clean == "Sent $500 to   Chase&Co scan.png  today"
+    start = clean.index("Chase")
+    assert RAW[slice(*map_span(offset_map, start, start + 5))] == "Chase"
+    # a span ending in a decoded entity is widened to the whole entity
+    assert RAW[slice(*map_span(offset_map, start, start + 6))] == "Chase&amp;"
+    start = clean.index("scan.png")
+    assert RAW[slice(*map_span(offset_map, start, start + 8))] == "scan.png"
+
+
+def test_compose_maps_round_trip():
+    # normalized (as `detect_dirty_data` does), then cleaned
+    normalized, raw_map = normalize_map("  " + RAW.upper())
+    clean, offset_map = clean_markup(normalized)
+    composed = compose_maps(offset_map, raw_map)
+    raw = "  " + RAW.upper()
+    for word in ["sent", "$500", "chase", "today"]:
+        start = clean.index(word)
+        raw_start, raw_end = map_span(composed, start, start + len(word))
+        assert raw[raw_start:raw_end].lower() == word
+
+
+def test_clean_dirty_data_routes_with_cut_points(log):
+    data = pd.DataFrame({"ID": ["1", "2", "3"],
+                         "narratives": ["<b>" * 40 + "short", "a" * 30, "b" * 500],
+                         "DIRTY": [1, 0, 0], "SHORT": 0, "SAME_SRC": 0})
+    data["narr_length"] = data["narratives"].str.len()
+    data["qCut"] = pd.Categorical(["Q3", "Q3", "Q5"],
+                                  categories=[f"Q{q}" for q in range(1, 6)])
+    log.loc["Quantile Cut Points"] = str([1.0, 10.0, 20.0, 100.0, 200.0, 500.0])
+    data, log = clean_dirty_data(data, log)
+    assert data["narratives"].iloc[0] == "short"
+    assert data["qCut"].tolist() == ["Q1", "Q3", "Q5"]
+
+
+def test_entity_table_maps_duplicate_ids_by_row():
+    maps = [json.dumps([[0, 5, 3, 8]]), ""]
+    data = pd.DataFrame({"ID": ["1", "1"], "offset_map": maps,
+                         "entities": [[("ORG", "", "Chase", 0, 5)],
+                                      [("ORG", "", "Chase", 0, 5)]]})
+    entities = entity_table(data, ["ORG"])
+    assert entities["raw_start"].tolist() == [3, 0]
+    assert entities["raw_end"].tolist() == [8, 5]
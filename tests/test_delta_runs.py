@@ -0,0 +1,113 @@
+import os
+import shutil
+import pytest
+import pandas as pd
+from delta_runs import (select_delta, record_run, retire_entities, current_entities,
+                        compact_entities, pending_runs)
+from entity_index import index_entities, doc_entities
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    return str(tmp_path / "manifest.sqlite")
+
+
+def save_session(tmp_path, name, export, entities, manifest):
+    """Records a finished session with its entity table, as
+    `delta_pipeline` does."""
+    session_path = str(tmp_path / name)
+    os.makedirs(f"{session_path}/entities")
+    entities.to_parquet(f"{session_path}/entities/part-0.parquet")
+    record_run(export, session_path, None, len(entities), manifest)
+    return session_path
+
+
+def test_select_delta_statuses(manifest, log):
+    first = pd.DataFrame({"ID": [1, 2, 3],
+                          "C_CASE_SUMMARY": ["alpha", "beta", "gamma"]})
+    first, log = select_delta(first, "C_CASE_SUMMARY", log, manifest)
+    assert first["DELTA"].tolist() == ["new", "new", "new"]
+    record_run(first, "session_1", None, 0, manifest)
+
+    export = pd.DataFrame({"ID": [1, 2, 3, 4, 5, 6],
+                           "C_CASE_SUMMARY": ["alpha", "beta edited", "alpha",
+                                              "delta", "beta", None]})
+    export, log = select_delta(export, "C_CASE_SUMMARY", log, manifest)
+    assert export["DELTA"].tolist() == ["unchanged", "changed", "duplicate",
+                                        "new", "duplicate", "new"]
+    # ID 3 now repeats ID 1, so its earlier entities are stale too
+    assert export["DELTA_REPLACED"].tolist() == [False, True, True,
+                                                 False, False, False]
+    assert log.loc["Delta Duplicate"].iloc[0] == 2
+
+
+def test_current_entities_keeps_rows_of_owner_session(tmp_path, manifest, log):
+    first = pd.DataFrame({"ID": [1, 2], "C_CASE_SUMMARY": ["alpha", "beta"]})
+    first, log = select_delta(first, "C_CASE_SUMMARY", log, manifest)
+    save_session(tmp_path, "session_1", first, pd.DataFrame(
+        {"ID": [1, 2], "label": ["PHONE", "PHONE"], "ent_id": ["", ""],
+         "text": ["555-123-4567", "555-987-6543"], "start": [0, 0], "end": [12, 12]}),
+        manifest)
+
+    second = pd.DataFrame({"ID": [1, 2], "C_CASE_SUMMARY": ["alpha edited", "beta"]})
+    second, log = select_delta(second, "C_CASE_SUMMARY", log, manifest)
+    save_session(tmp_path, "session_2", second.loc[second["DELTA"] != "unchanged"],
+                 pd.DataFrame({"ID": [1], "label": ["LENDER"], "ent_id": [""],
+                               "text": ["acme bank"], "start": [0], "end": [9]}),
+                 manifest)
+
+    entities = current_entities(manifest).sort_values("ID")
+    assert entities["ID"].tolist() == [1, 2]
+    assert entities["text"].tolist() == ["acme bank", "555-987-6543"]
+
+
+def test_retire_entities_drops_stale_mentions(tmp_path):
+    index_path = str(tmp_path / "entities.sqlite")
+    old, new = str(tmp_path / "session_1"), str(tmp_path / "session_2")
+    index_entities(pd.DataFrame(
+        {"ID": [1, 2], "label": ["PHONE", "PHONE"], "text": ["555-123-4567", "555-987-6543"],
+         "start": [0, 0], "end": [12, 12]}), old, index_path)
+    index_entities(pd.DataFrame(
+        {"ID": [1], "label": ["LENDER"], "text": ["acme bank"],
+         "start": [0], "end": [9]}), new, index_path)
+
+    assert retire_entities([1], new, index_path) == 1
+    assert doc_entities(1, index_path=index_path)["text"].tolist() == ["acme bank"]
+    assert len(doc_entities(2, old, index_path)) == 1
+
+
+def run_delta(tmp_path, name, narratives, found, manifest, log):
+    """Selects the delta of an export and saves a session with an
+    entity per processed row, its text given by `found`."""
+    export = pd.DataFrame({"ID": list(narratives),
+                           "C_CASE_SUMMARY": list(narratives.values())})
+    export, log = select_delta(export, "C_CASE_SUMMARY", log, manifest)
+    delta = export.loc[export["DELTA"] != "unchanged"]
+    entities = pd.DataFrame({"ID": delta["ID"].tolist(), "label": "LENDER",
+                             "ent_id": "", "text": [found[n] for n in delta["ID"]],
+                             "start": 0, "end": 9})
+    return save_session(tmp_path, name, delta, entities, manifest)
+
+
+def test_edited_ids_move_between_sessions_across_compaction(tmp_path, manifest, log):
+    first = run_delta(tmp_path, "session_1", {1: "a", 2: "b", 3: "c"},
+                      {1: "bank one", 2: "bank two", 3: "bank three"}, manifest, log)
+    run_delta(tmp_path, "session_2", {1: "a edited"}, {1: "bank 1b"}, manifest, log)
+    compacted = compact_entities(manifest)
+    assert pending_runs(manifest) == 0
+    # later reads start from the compaction, not from session_1
+    shutil.rmtree(f"{first}/entities")
+    run_delta(tmp_path, "session_3", {1: "a again", 2: "b edited"},
+              {1: "bank 1c", 2: "bank 2b"}, manifest, log)
+    assert pending_runs(manifest) == 1
+
+    entities = current_entities(manifest).sort_values("ID")
+    assert entities["ID"].tolist() == [1, 2, 3]
+    assert entities["text"].tolist() == ["bank 1c", "bank 2b", "bank three"]
+
+    # a new compaction replaces the last one
+    latest = compact_entities(manifest)
+    assert not os.path.exists(compacted)
+    entities = current_entities(manifest).sort_values("ID")
+    assert entities["text"].tolist() == ["bank 1c", "bank 2b", "bank three"]
+    assert latest.startswith(str(tmp_path / "current"))
@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+import pytest
+from edge_cases import (dirty_flags, DIRTY_BITS, cluster_buckets, cluster_texts,
+                        detect_repeat_sources)
+
+
+@pytest.mark.parametrize("dtype", [object, "string[pyarrow]"])
+def test_dirty_flags(dtype):
+    texts = pd.Series(["plain text", "<p>hello</p>", "<img alt='logo'>",
+                       "name: ****", "<b>**</b>", None], dtype=dtype)
+    flags = dirty_flags(texts)
+    html, img, form = DIRTY_BITS["HTML"], DIRTY_BITS["IMG"], DIRTY_BITS["FORM_1"]
+    assert flags.tolist() == [0, html, html | img, form, html | form, 0]
+
+
+def test_cluster_buckets_joins_chains():
+    # 0-1 share a bucket in the first band, 1-2 in the second, and so on
+    n = 1000
+    first = (np.arange(n) // 2).astype(np.uint64)
+    second = ((np.arange(n) + 1) // 2).astype(np.uint64) + np.uint64(n)
+    assert set(cluster_buckets([first, second], n).tolist()) == {0}
+    lone = np.arange(n, dtype=np.uint64)
+    assert cluster_buckets([lone, lone], n).tolist() == list(range(n))
+
+
+def test_cluster_texts_near_duplicates():
+    texts = pd.Series(["good morning, this is a referral from the call center re",
+                       "good morning, this is a referral from the call centre re",
+                       "complainant called to report identity theft involving",
+                       "good morning, this is a referral from the call center re"])
+    clusters = cluster_texts(texts, 60, 5, 64, 8)
+    assert clusters[0] == clusters[1] == clusters[3]
+    assert clusters[2] != clusters[0]
+
+
+def test_detect_repeat_sources(log):
+    body = "someone applied for a loan in my name and i never submitted it"
+    data = pd.DataFrame({"narratives": [
+        f"hello, i am writing on behalf of my client regarding {body} sent from my iphone",
+        f"hello, i am writing on behalf of my client regarding a fee {body} thank you.",
+        f"i received a letter about an application {body} sent from my iphone",
+        f"the caller said they were contacted by phone {body} regards, the team"]})
+    data, log = detect_repeat_sources(data, 100, log)
+    assert data["SAME_SRC_1"].tolist() == [False, True, False, False]
+    assert data["SAME_SRC_2"].tolist() == [False, False, True, False]
+    assert data["SAME_SRC"].tolist() == [False, True, True, False]
@@ -0,0 +1,51 @@
+import os
+import pytest
+import pandas as pd
+from entity_index import normalize_entity, index_entities, lookup, doc_entities
+
+
+@pytest.mark.parametrize("text, norm", [
+    ("(555) 123-4567", "5551234567"),
+    ("555.123.4567", "5551234567"),
+    ("12-3456789", "123456789"),
+    ("Acme  Bank, N.A.", "acme bank, n.a"),
+    ('"John Smith"', "john smith"),
+    ("12-34", "12-34"),
+])
+def test_normalize_entity(text, norm):
+    assert normalize_entity(text) == norm
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / "entities.sqlite")
+    index_entities(pd.DataFrame(
+        {"ID": [1, 2, 2], "label": ["PHONE", "PHONE", "LENDER"],
+         "text": ["555-123-4567", "(555) 123 4567", "Acme Bank"],
+         "start": [0, 10, 30], "end": [12, 24, 39]}),
+        str(tmp_path / "session_1"), path)
+    index_entities(pd.DataFrame(
+        {"ID": [3], "label": ["LENDER"], "text": ["Acme Lending"],
+         "start": [5], "end": [17]}),
+        str(tmp_path / "session_2"), path)
+    return path
+
+
+def test_lookup_matches_however_written(index_path):
+    mentions = lookup("555.123.4567", index_path=index_path)
+    assert mentions["ID"].tolist() == ["1", "2"]
+    assert mentions["text"].tolist() == ["555-123-4567", "(555) 123 4567"]
+
+
+def test_lookup_by_label_and_prefix(index_path):
+    assert lookup("acme", prefix=True, index_path=index_path)["ID"].tolist() == ["2", "3"]
+    assert lookup("acme bank", "LENDER", index_path=index_path)["ID"].tolist() == ["2"]
+    assert len(lookup("acme bank", "PHONE", index_path=index_path)) == 0
+
+
+def test_sessions_are_found_however_written(tmp_path, monkeypatch, index_path):
+    monkeypatch.chdir(tmp_path)
+    assert len(doc_entities(2, "session_1", index_path)) == 2
+    assert len(doc_entities(2, os.path.join(str(tmp_path), "session_1"),
+                            index_path)) == 2
+    assert len(doc_entities(2, "session_2", index_path)) == 0
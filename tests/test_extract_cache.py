@@ -0,0 +1,53 @@
+import pytest
+from extract_cache import (narrative_hash, extract_fingerprint, open_cache,
+                           cache_get, cache_put, evict_cache)
+
+
+@pytest.fixture
+def model(tmp_path):
+    path = tmp_path / "patterns.json"
+    path.write_text('{"label": "PHONE", "pattern": [{"SHAPE": "ddd-ddd-dddd"}]}\n')
+    return str(path)
+
+
+def test_fingerprint_depends_on_mode_and_windows(model):
+    fingerprints = {extract_fingerprint(model, "transformer"),
+                    extract_fingerprint(model, "rules"),
+                    extract_fingerprint(model, "rules", 1000, 100),
+                    extract_fingerprint(model, "rules", 1000, 200)}
+    assert len(fingerprints) == 4
+    assert extract_fingerprint(model, "rules") == extract_fingerprint(model, "rules")
+
+
+def test_extracts_are_keyed_by_hash_and_fingerprint(tmp_path):
+    conn = open_cache(str(tmp_path / "cache.sqlite"))
+    key = narrative_hash("call me at 555-123-4567")
+    cache_put(conn, "model:rules", [key], [[["PHONE", "", "555-123-4567", 11, 23]]])
+    cache_put(conn, "model:transformer", [key], [[]])
+    assert cache_get(conn, "model:rules", [key]) == {
+        key: [("PHONE", "", "555-123-4567", 11, 23)]}
+    assert cache_get(conn, "model:transformer", [key]) == {key: []}
+    assert cache_get(conn, "other:rules", [key]) == {}
+
+
+def test_evict_cache_drops_least_recently_used(tmp_path):
+    conn = open_cache(str(tmp_path / "cache.sqlite"))
+    cache_put(conn, "a", ["h1"], [[]])
+    cache_put(conn, "b", ["h2"], [[]])
+    conn.execute("UPDATE extracts SET accessed = 0")
+    cache_get(conn, "a", ["h1"])
+    assert evict_cache(conn, max_mb=2 / 2**20) == 1
+    assert cache_get(conn, "a", ["h1"]) == {"h1": []}
+    assert cache_get(conn, "b", ["h2"]) == {}
+
+
+def test_cache_cap_is_passed_through(tmp_path, model):
+    from spacy_nlp import entity_recognizer
+    cache_path = str(tmp_path / "cache.sqlite")
+    texts = [f"call me at 555-123-{n:04d} about my loan" for n in range(20)]
+    entity_recognizer(texts, str(tmp_path / "session"), model, cache_path=cache_path,
+                      cache_max_mb=200 / 2**20, save_docs=False, n_process=1,
+                      batch_size=8, mode="rules")
+    conn = open_cache(cache_path)
+    size = conn.execute("SELECT SUM(size) FROM extracts").fetchone()[0]
+    assert 0 < size <= 200
@@ -0,0 +1,41 @@
+import re
+from long_docs import make_windows, window_corpus, merge_windows
+
+
+def test_short_narrative_is_one_window():
+    assert make_windows("A short narrative.", max_chars=100) == [(0, 18)]
+
+
+def test_windows_overlap_and_cover_the_text():
+    text = " ".join(f"Sentence number {n} is here." for n in range(40))
+    windows = make_windows(text, max_chars=200, overlap_chars=60)
+    assert windows[0][0] == 0 and windows[-1][1] == len(text)
+    for (start, end), (next_start, next_end) in zip(windows, windows[1:]):
+        assert end - start <= 200
+        # each window starts inside the previous one, at a sentence
+        assert start < next_start < end
+        assert text[next_start - 2] == "."
+
+
+def test_run_on_text_is_split_at_spaces():
+    text = "word " * 100
+    windows = make_windows(text.strip(), max_chars=50, overlap_chars=10)
+    assert all(end - start <= 50 for start, end in windows)
+
+
+def test_merge_windows_dedupes_overlapping_entities():
+    text = " ".join(f"Call 555-{n:04d} today." for n in range(30))
+    windows, doc_index, offsets = window_corpus([text], max_chars=120,
+                                                overlap_chars=50)
+    extracts = [[("PHONE", "", m.group(), m.start(), m.end())
+                 for m in re.finditer(r"555-\d{4}", window)] for window in windows]
+    merged = merge_windows(extracts, doc_index, offsets, n_docs=1)[0]
+    expected = [m.span() for m in re.finditer(r"555-\d{4}", text)]
+    assert [(ent[3], ent[4]) for ent in merged] == expected
+    assert sum(len(ents) for ents in extracts) > len(merged)
+
+
+def test_merge_windows_keeps_longest_span():
+    extracts = [[("ORG", "", "Chase", 10, 15)], [("ORG", "", "Chase Bank", 0, 10)]]
+    merged = merge_windows(extracts, [0, 0], [0, 10], n_docs=2)
+    assert merged == [[("ORG", "", "Chase Bank", 10, 20)], []]
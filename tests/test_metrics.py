@@ -0,0 +1,34 @@
+import json
+from metrics import start_run, step, end_step, event, end_run, summarize_metrics, compare_runs
+
+
+def test_summary_adds_up_repeated_steps(tmp_path):
+    start_run(str(tmp_path))
+    for chunk in range(3):
+        step("1.4", 10)
+        end_step(8, chunk=chunk)
+    step("2.5", 24)
+    summary = end_run(runs_path=None)
+    assert summary.loc["1.4", "runs"] == 3
+    assert summary.loc["1.4", "rows_in"] == 30
+    assert summary.loc["1.4", "rows_out"] == 24
+    # the open step is ended by `end_run`
+    assert summary.loc["2.5", "runs"] == 1
+    assert (tmp_path / "metrics_summary.csv").exists()
+
+
+def test_summary_of_log_without_steps(tmp_path):
+    path = tmp_path / "metrics.jsonl"
+    path.write_text(json.dumps({"event": "run_start"}) + "\n"
+                    + json.dumps({"event": "run_end", "peak_rss_mb": 10.0}) + "\n")
+    summary = summarize_metrics(str(path))
+    assert summary.empty
+    assert "wall_seconds" in summary.columns
+
+
+def test_run_without_steps_is_saved(tmp_path):
+    runs_path = str(tmp_path / "runs.jsonl")
+    start_run(str(tmp_path))
+    event(event="stage", stage="source", items=0)
+    assert end_run(runs_path=runs_path).empty
+    assert compare_runs(runs_path).empty
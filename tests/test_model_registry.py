@@ -0,0 +1,50 @@
+import json
+import spacy
+import pytest
+import model_registry
+from model_registry import get_model, load_seconds, forget_model, model_labels
+
+
+@pytest.fixture
+def model_dir(tmp_path):
+    """A saved pipeline with an entity ruler, as written by `config_patterns`."""
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("entity_ruler")
+    ruler.add_patterns([{"label": "PHONE", "pattern": [{"SHAPE": "ddd-dddd"}]},
+                        {"label": "BANK", "pattern": [{"LOWER": "chase"}]}])
+    nlp.to_disk(tmp_path / "model")
+    yield str(tmp_path / "model")
+    forget_model(str(tmp_path / "model"))
+
+
+def test_get_model_loads_once_per_path(model_dir):
+    calls = []
+    def loader(model):
+        calls.append(model)
+        return spacy.load(model)
+    first = get_model(model_dir, loader=loader)
+    again = get_model(model_dir + "/", loader=loader)
+    assert first is again
+    assert len(calls) == 1
+    assert load_seconds(model_dir, loader=loader) > 0
+
+
+def test_forget_model_reloads(model_dir):
+    first = get_model(model_dir)
+    forget_model(model_dir)
+    assert get_model(model_dir) is not first
+
+
+def test_model_labels_without_loading(model_dir, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("the pipeline was loaded")
+    monkeypatch.setattr(model_registry, "get_model", fail)
+    labels = model_labels(model_dir)
+    assert labels == {"entity_ruler": ["BANK", "PHONE"], "ner": []}
+
+
+def test_model_labels_of_pattern_file(tmp_path):
+    path = tmp_path / "patterns.json"
+    path.write_text("".join(json.dumps({"label": label, "pattern": "x"}) + "\n"
+                            for label in ["SSN", "BANK", "SSN"]))
+    assert model_labels(str(path)) == {"entity_ruler": ["BANK", "SSN"], "ner": []}
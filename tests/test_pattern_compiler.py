@@ -0,0 +1,47 @@
+import spacy
+from pattern_compiler import compile_patterns, check_equivalence
+from spacy_nlp import rules_engine
+
+PATTERNS = [
+    {"label": "BANK", "pattern": [{"LOWER": "chase"}, {"LOWER": "bank"}]},
+    {"label": "BANK", "pattern": [{"LOWER": "chase"}, {"LOWER": "bank"}]},
+    {"label": "BANK", "pattern": [{"LOWER": "Wells Fargo"}]},
+    {"label": "APP", "pattern": [{"LOWER": "zelle"}, {"IS_PUNCT": True}]},
+    {"label": "APP", "pattern": [{"LOWER": "venmo"}, {"IS_PUNCT": True}]},
+    {"label": "PHONE", "pattern": [{"SHAPE": "ddd"}, {"ORTH": "-"}, {"SHAPE": "dddd"}]},
+]
+TEXTS = ["I paid Chase Bank and chase bank.", "Sent it on Zelle, then Venmo.",
+         "Call 555-1234 or WELLS FARGO."]
+
+
+def test_compile_patterns_dedupes_drops_and_merges():
+    compiled, report = compile_patterns(PATTERNS)
+    assert report["duplicates"] == 1
+    assert len(report["dead"]) == 1
+    assert {"label": "BANK", "pattern": "chase bank"} in compiled
+    # the APP patterns differ only in their first literal
+    assert {"label": "APP", "pattern": [{"LOWER": {"IN": ["venmo", "zelle"]}},
+                                        {"IS_PUNCT": True}]} in compiled
+    assert report["patterns_out"] == len(compiled) == 3
+
+
+def test_compiled_patterns_are_equivalent():
+    compiled, _ = compile_patterns(PATTERNS)
+    report = check_equivalence(PATTERNS, compiled, texts=TEXTS)
+    assert report["equivalent"], report["mismatches"]
+    assert report["entities"] > 0
+
+
+def test_check_equivalence_reports_mismatches():
+    compiled, _ = compile_patterns(PATTERNS)
+    report = check_equivalence(PATTERNS, compiled[1:], texts=TEXTS)
+    assert not report["equivalent"]
+    assert report["mismatched_docs"] == 1
+
+
+def test_phrase_attr_only_set_for_compiled_patterns(tmp_path):
+    path = tmp_path / "patterns.json"
+    path.write_text('{"label": "BANK", "pattern": [{"LOWER": "chase"}]}\n')
+    assert rules_engine(str(path)).get_pipe("entity_ruler").phrase_matcher_attr == "LOWER"
+    ruler = rules_engine(str(path), optimize=False).get_pipe("entity_ruler")
+    assert ruler.phrase_matcher_attr is None
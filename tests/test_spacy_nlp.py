@@ -0,0 +1,87 @@
+import json
+import pytest
+import spacy
+import pandas as pd
+from spacy.tokens import DocBin
+from spacy_nlp import flush_shard, iter_docs, tune_pipe, TUNE_BATCHES, extract_table
+
+
+def test_shards_stream_back_in_order(tmp_path):
+    nlp = spacy.blank("en")
+    texts = [f"narrative number {n}" for n in range(7)]
+    manifest = {"model": "blank", "docs": 0, "shards": []}
+    for start in range(0, len(texts), 3):
+        doc_bin = DocBin(docs=nlp.pipe(texts[start:start+3]))
+        flush_shard(doc_bin, str(tmp_path), manifest)
+    with open(tmp_path / "manifest.json") as f:
+        saved = json.load(f)
+    assert saved["docs"] == 7
+    assert [shard["docs"] for shard in saved["shards"]] == [3, 3, 1]
+    docs = iter_docs(str(tmp_path), nlp.vocab)
+    assert not isinstance(docs, list)
+    assert [doc.text for doc in docs] == texts
+    shard = tmp_path / saved["shards"][0]["file"]
+    assert [doc.text for doc in iter_docs(str(shard), nlp.vocab)] == texts[:3]
+
+
+class CountingPipe:
+    """Wraps a pipeline to count the texts it pipes."""
+    def __init__(self, nlp):
+        self.nlp, self.piped = nlp, 0
+
+    def pipe(self, texts, **kwargs):
+        texts = list(texts)
+        self.piped += len(texts)
+        return self.nlp.pipe(texts, batch_size=kwargs.get("batch_size", 8))
+
+
+def test_tune_pipe_has_a_fixed_budget(tmp_path):
+    nlp = CountingPipe(spacy.blank("en"))
+    texts = [f"narrative {n} " * 20 for n in range(20000)]
+    model = tmp_path / "patterns.json"
+    model.write_text("")
+    n_process, batch_size, rate = tune_pipe(nlp, texts, [], str(model), 0.0,
+                                            sample_size=256)
+    assert batch_size <= 256 // TUNE_BATCHES
+    assert nlp.piped <= 8 + 3 * 256
+    assert rate > 0
+
+
+def test_tune_pipe_skips_small_corpora():
+    nlp = CountingPipe(spacy.blank("en"))
+    assert tune_pipe(nlp, ["a short corpus"] * 100, [], "", 0.0, sample_size=256) is None
+    assert nlp.piped == 0
+
+@pytest.fixture
+def entities():
+    return pd.DataFrame.from_records(
+        [(2, "PHONE", "", "555-123-4567", 10, 22),
+         (1, "LENDER", "", "acme bank", 0, 9),
+         (2, "PHONE", "", "555-987-6543", 30, 42),
+         (9, "PHONE", "", "555-000-0000", 0, 12),
+         (1, "OTHER", "", "ignored", 12, 19)],
+        columns=["ID", "label", "ent_id", "text", "start", "end"])
+
+
+def test_extract_table_first(entities):
+    table = extract_table(entities, ["PHONE", "LENDER"], [1, 2, 3])
+    assert table.index.tolist() == [1, 2, 3]
+    assert table.columns.tolist() == ["PHONE", "LENDER"]
+    assert table.loc[2, "PHONE"] == "555-123-4567"
+    assert table.loc[1, "LENDER"] == "acme bank"
+    assert table.loc[1, "PHONE"] == 0
+    assert table.loc[3].tolist() == [0, 0]
+
+
+def test_extract_table_all(entities):
+    table = extract_table(entities, ["PHONE", "LENDER"], [1, 2, 3], mode="all")
+    assert table.loc[2, "PHONE"] == [("PHONE", "", "555-123-4567", 10, 22),
+                                     ("PHONE", "", "555-987-6543", 30, 42)]
+    assert table.loc[1, "LENDER"] == [("LENDER", "", "acme bank", 0, 9)]
+    assert table.loc[3, "PHONE"] == []
+    assert table.loc[1, "PHONE"] is not table.loc[3, "PHONE"]
+
+
+def test_extract_table_rejects_unknown_mode(entities):
+    with pytest.raises(ValueError):
+        extract_table(entities, ["PHONE"], [1], mode="last")
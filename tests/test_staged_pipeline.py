@@ -0,0 +1,61 @@
+import threading
+import pytest
+import pandas as pd
+from staged_pipeline import run_stages
+from transform import save_transformation, save_transformation_chunked
+
+
+def double(items):
+    for item in items:
+        yield item * 2
+
+
+def test_stages_run_in_order():
+    add_one = lambda items: (item + 1 for item in items)
+    out = run_stages(range(10), [("double", double), ("add", add_one)])
+    assert list(out) == [2 * n + 1 for n in range(10)]
+
+
+def test_stage_error_reaches_the_consumer():
+    def fail_on_three(items):
+        for item in items:
+            if item == 3:
+                raise ValueError("bad chunk")
+            yield item
+    out = []
+    with pytest.raises(ValueError, match="bad chunk"):
+        for item in run_stages(range(10), [("fail", fail_on_three), ("double", double)]):
+            out.append(item)
+    assert out == [0, 2, 4]
+
+
+def test_source_error_reaches_the_consumer():
+    def source():
+        yield 1
+        raise OSError("read failed")
+    with pytest.raises(OSError, match="read failed"):
+        list(run_stages(source(), [("double", double)]))
+
+
+def test_threads_stop_when_the_consumer_stops():
+    before = threading.active_count()
+    for item in run_stages(range(1000), [("double", double)], maxsize=1):
+        break
+    assert threading.active_count() == before
+
+
+def test_chunked_save_writes_the_same_files(tmp_path, log):
+    data = pd.DataFrame({"ID": [str(n) for n in range(10)],
+                         "narratives": [f"narrative {n}" for n in range(10)],
+                         "qCut": ["Q1", "Q2", "Q3", "Q4", "Q5"] * 2})
+    (tmp_path / "full").mkdir()
+    (tmp_path / "chunked").mkdir()
+    save_transformation(data, log, str(tmp_path / "full"))
+    chunks = [data.iloc[:4], data.iloc[4:]]
+    accepted = list(save_transformation_chunked(chunks, log, str(tmp_path / "chunked")))
+    assert sum(len(chunk) for chunk in accepted) == 6
+    for path in ["transformed/accepted.csv", "transformed/accepted/q2xq3xq4.csv",
+                 "transformed/diverted/q1xq5.csv"]:
+        full = pd.read_csv(tmp_path / "full" / path)
+        chunked = pd.read_csv(tmp_path / "chunked" / path)
+        pd.testing.assert_frame_equal(full, chunked)
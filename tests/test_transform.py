@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from transform import (mark_seen, transform_data_chunked, update_sketch, sketch_cuts,
+                       define_quants, SKETCH_MAX_LENGTH, export_header, read_export)
+
+
+def test_mark_seen_within_and_across_chunks():
+    seen = set()
+    first = mark_seen(np.array([1, 2, 2], dtype=np.uint64), seen)
+    second = mark_seen(np.array([3, 1], dtype=np.uint64), seen)
+    assert first.tolist() == [False, False, True]
+    assert second.tolist() == [False, True]
+    assert seen == {1, 2, 3}
+
+
+def test_chunked_true_duplicates_match_across_chunk_dtypes(tmp_path, log):
+    # the second chunk has a missing `AMT`, so it would be read as float
+    path = tmp_path / "export.csv"
+    path.write_text("ID,AMT,C_CASE_SUMMARY\n"
+                    "1,5,alpha text\n"
+                    "2,7,beta text\n"
+                    "1,5,alpha text\n"
+                    "3,,gamma text\n")
+    chunks = list(transform_data_chunked(str(path), "C_CASE_SUMMARY", log,
+                                         chunksize=2))
+    data = pd.concat(chunks)
+    assert log.loc["Number of True Duplicates"].iloc[0] == 1
+    assert log.loc["Number of Narrative Duplicates"].iloc[0] == 1
+    assert data["narratives"].tolist() == ["alpha text", "beta text", "gamma text"]
+
+
+def test_sketch_cuts_match_quantiles_of_full_column():
+    rng = np.random.default_rng(0)
+    lengths = pd.Series(rng.integers(1, 2000, 5000))
+    sketch = None
+    for start in range(0, len(lengths), 700):
+        sketch = update_sketch(sketch, lengths[start:start+700])
+    expected = np.quantile(lengths, np.linspace(0, 1, 6))
+    assert np.allclose(sketch_cuts(sketch, 5), expected)
+
+
+def test_sketch_caps_pathological_lengths():
+    sketch = update_sketch(None, pd.Series([10, 20, 30, 10 * SKETCH_MAX_LENGTH]))
+    assert len(sketch) == SKETCH_MAX_LENGTH + 1
+    assert sketch.sum() == 4
+    assert sketch_cuts(sketch, 2) == [10.0, 25.0, float(SKETCH_MAX_LENGTH)]
+
+
+def test_define_quants_routes_with_frozen_cuts(log):
+    data = pd.DataFrame({"narratives": ["a" * n for n in [1, 10, 30, 60, 500]]})
+    data, log = define_quants(data, "narratives", 5, log,
+                              cuts=[5.0, 20.0, 40.0, 80.0, 100.0, 200.0])
+    assert data["qCut"].tolist() == ["Q1", "Q1", "Q2", "Q3", "Q5"]
+
+
+def test_define_quants_with_repeated_cuts(log):
+    # a small first chunk can learn the same cut point more than once
+    data = pd.DataFrame({"narratives": ["a" * n for n in [3, 5, 5, 9]]})
+    data, log = define_quants(data, "narratives", 5, log,
+                              cuts=[1.0, 5.0, 5.0, 5.0, 8.0, 9.0])
+    assert data["qCut"].tolist() == ["Q1", "Q1", "Q1", "Q5"]
+
+
+def test_export_header_names_columns_like_read_csv(tmp_path):
+    path = tmp_path / "export.csv"
+    path.write_text("ID,X,,X,X.1,X\n1,a,b,c,d,e\n")
+    names = export_header(str(path))
+    assert names == pd.read_csv(path).columns.tolist()
+    assert names == ["ID", "X", "Unnamed: 2", "X.2", "X.1", "X.3"]
+
+
+def test_read_export_keeps_temporal_columns_as_text(tmp_path):
+    path = tmp_path / "export.csv"
+    path.write_text("ID,OPENED,AT,C_CASE_SUMMARY\n"
+                    "1,2021-03-04,09:15:00,\"first line\nsecond line\"\n"
+                    "2,2021-03-05,NULL,text\n")
+    data = read_export(str(path), dtype={"ID": "string"})
+    expected = pd.read_csv(path, dtype=str)
+    assert data["OPENED"].tolist() == ["2021-03-04", "2021-03-05"]
+    assert data["AT"].tolist()[0] == "09:15:00" and pd.isna(data["AT"].iloc[1])
+    assert data["C_CASE_SUMMARY"].tolist() == expected["C_CASE_SUMMARY"].tolist()
+    assert data["ID"].tolist() == ["1", "2"]
@@ -2,9 +2,18 @@ import warnings
 warnings.filterwarnings('ignore')
 from datetime import datetime
 import os
+import csv
 import pandas as pd
 import numpy as np
 import re
+import pyarrow as pa
+from pyarrow import csv as pa_csv
+from metrics import step, end_step
+# `display` is only a builtin in notebooks; fall back to `print` headless
+try:
+    from IPython.display import display
+except ImportError:
+    display = print
 
 
 def create_folder_struct(output_path:str)->(tuple):
@@ -39,25 +48,192 @@ def create_folder_struct(output_path:str)->(tuple):
         return accepted_dir, diverted_dir
 
 
+# Longest length the quantile sketch counts exactly; longer narratives
+# share one overflow cell, so the sketch stays under 8 MB
+SKETCH_MAX_LENGTH = 2**20
+
+
+def update_sketch(sketch:np.ndarray, lengths:pd.Series)->(np.ndarray):
+    """
+    Adds a chunk of narrative lengths to a streaming quantile sketch.
+    The sketch is a histogram of character lengths, so it is exact,
+    can be merged by adding, and its size depends on the longest
+    narrative rather than the number of narratives.
+    Lengths of `SKETCH_MAX_LENGTH` and above are counted in the last
+    cell, so one pathological narrative cannot blow up the sketch;
+    the counts stay exact, and a cut point in that cell is reported
+    as `SKETCH_MAX_LENGTH` (see `sketch_cuts`).
+
+    Args:
+    sketch (np.ndarray): counts of each narrative length, or None
+    lengths (pd.Series): character lengths of a chunk of narratives
+
+    Returns:
+    sketch (np.ndarray): updated counts of each narrative length
+    """
+    counts = np.bincount(np.minimum(lengths.to_numpy(dtype=np.int64), SKETCH_MAX_LENGTH))
+    if sketch is None:
+        return counts
+    if len(counts) > len(sketch):
+        counts[:len(sketch)] += sketch
+        return counts
+    sketch[:len(counts)] += counts
+    return sketch
+
+
+def sketch_cuts(sketch:np.ndarray, n:int)->(list):
+    """
+    Computes the `n` quantile cut points of a length sketch, with the
+    same linear interpolation `pd.qcut` uses on the full column.
+    Cut points among lengths past `SKETCH_MAX_LENGTH` are reported as
+    `SKETCH_MAX_LENGTH`; such narratives are routed to the last quantile.
+
+    Args:
+    sketch (np.ndarray): counts of each narrative length
+    n (int): number of quantiles for narrative character length
+
+    Returns:
+    cuts (list): n+1 cut points, from the shortest to the longest length
+    """
+    cumulative = np.cumsum(sketch)
+    position = (cumulative[-1] - 1) * np.linspace(0, 1, n+1)
+    lower = np.floor(position)
+    lower_value = np.searchsorted(cumulative, lower, side="right")
+    upper_value = np.searchsorted(cumulative, np.ceil(position), side="right")
+    cuts = lower_value + (position - lower) * (upper_value - lower_value)
+    return [float(cut) for cut in cuts]
+
+
+def freeze_quants(cuts:list, session_path:str)->(str):
+    """
+    Saves learned quantile cut points to the session directory,
+    so that later runs can route each row on arrival.
+
+    Args:
+    cuts (list): quantile cut points from `sketch_cuts`
+    session_path (str): path for session outputs
+
+    Returns:
+    quants_path (str): path to the frozen cut points
+    """
+    quants_path = f"{session_path}/quants.json"
+    pd.Series(cuts).to_json(quants_path)
+    print(f"[!] Quantile cut points frozen to: {quants_path}")
+    return quants_path
+
+
+def load_quants(quants_path:str)->(list):
+    """
+    Loads quantile cut points frozen by `freeze_quants`.
+
+    Args:
+    quants_path (str): path to the frozen cut points
+
+    Returns:
+    cuts (list): quantile cut points
+    """
+    return pd.read_json(quants_path, typ="series").tolist()
+
+
+# Text dtype of compact frames. The default string dtype of pandas
+# holds Python objects before pandas 3, so it is named explicitly.
+COMPACT_TEXT = "string[pyarrow]"
+# 0/1 indicators and bitmasks, and small integer columns of JOBs 1-2
+FLAG_COLUMNS = ["SHORT", "HTML", "IMG", "FORM_1", "DIRTY", "DIRTY_FLAGS", "EDGE_CASE"]
+INT32_COLUMNS = ["narr_length", "SRC_CLUSTER_1", "SRC_CLUSTER_2"]
+
+
+def is_compact(data:pd.DataFrame)->(bool):
+    """True if `data` is a compact frame, see `compact_frame`."""
+    return "narratives" in data.columns and data["narratives"].dtype == COMPACT_TEXT
+
+
+def as_text(texts:pd.Series)->(pd.Series):
+    """Returns narratives as strings. Compact (Arrow) text is
+    returned as is, instead of being copied to Python objects."""
+    return texts if texts.dtype == COMPACT_TEXT else texts.astype(str)
+
+
+def compact_frame(data:pd.DataFrame)->(pd.DataFrame):
+    """
+    Shrinks the dtypes of a DataFrame of narratives. Values, and the
+    CSV files saved from the frame, stay the same.
+    [1] Text columns are stored as Arrow strings (`COMPACT_TEXT`):
+        one contiguous buffer per column instead of a Python object
+        per row, and vectorized `.str` methods.
+    [2] Indicators and flag bitmasks (`FLAG_COLUMNS`) are uint8,
+        lengths and cluster IDs (`INT32_COLUMNS`) are int32.
+        `qCut` is already categorical.
+    Once `narratives` is compact, JOBs 1-2 keep the frame compact.
+
+    Args:
+    data (pd.DataFrame): dataframe of narratives
+
+    Returns:
+    data (pd.DataFrame): the same dataframe with compact dtypes
+    """
+    for col in data.columns:
+        dtype = data[col].dtype
+        if col in FLAG_COLUMNS:
+            data[col] = data[col].astype(np.uint8)
+        elif col in INT32_COLUMNS:
+            data[col] = data[col].astype(np.int32)
+        elif dtype == COMPACT_TEXT or isinstance(dtype, pd.CategoricalDtype):
+            continue
+        elif isinstance(dtype, pd.StringDtype) or (dtype == object and 
+                pd.api.types.infer_dtype(data[col], skipna=True) == "string"):
+            data[col] = data[col].astype(COMPACT_TEXT)
+    return data
+
+
+def quant_bins(cuts:list)->(list):
+    """
+    Converts n+1 quantile cut points to `pd.cut` bins. Lengths outside
+    the cut points fall into Q1 or the last quantile, and repeated
+    cut points are nudged apart, so the quantiles between them are
+    left empty.
+
+    Args:
+    cuts (list): n+1 quantile cut points
+
+    Returns:
+    bins (list): n+1 strictly increasing bin edges
+    """
+    bins = [-np.inf, *cuts[1:-1], np.inf]
+    for k in range(1, len(bins)):
+        if bins[k] <= bins[k-1]:
+            bins[k] = np.nextafter(bins[k-1], np.inf)
+    return bins
+
+
 def define_quants(data:pd.DataFrame, col:str, n:int,
-                log:pd.DataFrame)->(pd.DataFrame, pd.DataFrame):
+                log:pd.DataFrame, cuts:list=None)->(pd.DataFrame, pd.DataFrame):
     """
     Accepts narratives in a pandas dataframe, and returns a
     modified dataframe with `narr_length` (narrative character
     length) and `qCut` (quantiles for narrative length).
+    If `cuts` are given, e.g. frozen from an earlier session,
+    rows are routed with them instead of quantiles of `data`.
+    Lengths outside the cut points fall into Q1 or the last quantile,
+    see `quant_bins`. The cut points used are kept in the log, so
+    cleaned narratives can be routed again (see `clean_dirty_data`).
 
     Args:
     data (pd.DataFrame): pandas dataframe of narratives
     col (str): name of narrative column
     n (int): number of quantiles for narrative character length
     log (pd.Dataframe): session log
+    cuts (list): optional n+1 quantile cut points
 
     Returns:
     data (pd.DataFrame): modified data with `qCut` feature added
     log (pd.Dataframe): session log
     """
     # 1. Measure character length
-    data["narr_length"] = data[col].apply(
+    if data[col].dtype == COMPACT_TEXT:
+        data["narr_length"] = data[col].str.len().astype(np.int32)
+    else:
+        data["narr_length"] = data[col].apply(
                                 lambda x: len(str(x)))
     
     # 2. Create labels for each quantile
@@ -65,14 +241,55 @@ def define_quants(data:pd.DataFrame, col:str, n:int,
     labels = [f"Q{q}" for q in range(1, N)]
     
     # 3. Create `qCut` column and display distribution
-    data["qCut"] = pd.qcut(data["narr_length"], n, labels=labels)
+    if cuts is None:
+        data["qCut"], cuts = pd.qcut(data["narr_length"], n, labels=labels,
+                                     retbins=True)
+    else:
+        data["qCut"] = pd.cut(data["narr_length"], quant_bins(cuts), labels=labels)
+    if log is not None:
+        log.loc["Quantile Cut Points"] = str([float(cut) for cut in cuts])
     print("[*] Displaying distribution of quantiles...")
     display(data["qCut"].value_counts())
     return data, log
 
 
+def route_chunks(chunks, n:int, log:pd.DataFrame, cuts:list=None,
+                 session_path:str=None):
+    """
+    Assigns `qCut` to each chunk as it arrives, so accepted/diverted
+    routing can start before the whole dataset is loaded.
+    [1] With frozen `cuts`, every row is routed with them directly.
+    [2] Otherwise a length sketch is updated with each chunk, and the
+        chunk is routed with the cut points learned so far. Early
+        chunks are routed approximately; freeze the final cut points
+        with `session_path` to route later runs exactly on arrival.
+
+    Args:
+    chunks (iterable): chunks of narratives, as pandas dataframes
+    n (int): number of quantiles for narrative character length
+    log (pd.DataFrame): session log
+    cuts (list): optional frozen quantile cut points
+    session_path (str): optional path to freeze the learned cut points
+
+    Yields:
+    chunk (pd.DataFrame): chunk of narratives with `qCut` added
+    """
+    frozen, sketch = cuts is not None, None
+    for k, chunk in enumerate(chunks):
+        step("1.4", len(chunk))
+        if not frozen:
+            sketch = update_sketch(sketch, chunk["narr_length"])
+            cuts = sketch_cuts(sketch, n)
+        chunk, log = define_quants(chunk, "narratives", n, log, cuts=cuts)
+        end_step(len(chunk), chunk=k)
+        yield chunk
+
+    if not frozen and sketch is not None and session_path is not None:
+        freeze_quants(cuts, session_path)
+
+
 def save_transformation(data:pd.DataFrame, log:pd.DataFrame,
-                        output_path:str)->(None):
+                        output_path:str, long_docs:bool=False)->(None):
     """
     [1] Create directories for accepted and diverted data.
     [2] Save all data to `complete_datapath`.
@@ -80,10 +297,14 @@ def save_transformation(data:pd.DataFrame, log:pd.DataFrame,
         - Data is accepted if narrative length in characters (`narr_length`)
         is in the 2, 3, 4 of 5 quantiles (`qCut`).
         - Data is diverted if it is in quanitles 1 or 5.
+        - With `long_docs`, Q5 is also accepted; long narratives are
+        split into windows by `entity_recognizer` (`max_chars`).
     
     Args:
     data (pd.DataFrame): Dataframe of narratives
     log (pd.DataFrame): Session log
+    output_path (str): Path for session outputs
+    long_docs (bool): Accept Q5 for windowed extraction
     
     Return:
     data (pd.DataFrame): Dataframe of narratives prepped for extraction
@@ -92,6 +313,7 @@ def save_transformation(data:pd.DataFrame, log:pd.DataFrame,
     
     # 1. Call on `create_folder_struct` to create output folder
     print("[*] Creating directories, obtaining paths...")
+    step("2.5", len(data))
     accepted_path, diverted_path = create_folder_struct(output_path)
     accepted_filepath = f"{accepted_path}/q2xq3xq4.csv"
     
@@ -101,22 +323,169 @@ def save_transformation(data:pd.DataFrame, log:pd.DataFrame,
     # ---> Q2, Q3, Q4 are accepted for auto-extraction
     # For dataframes with more than 100k rows, check the 'accepted' data
     # for edge cases in human review before running the auto extraction.
-    accepted = data.loc[data["qCut"].isin(["Q2", "Q3", "Q4"])]
+    accepted_quants = ["Q2", "Q3", "Q4", "Q5"] if long_docs else ["Q2", "Q3", "Q4"]
+    accepted = data.loc[data["qCut"].isin(accepted_quants)]
     data.to_csv(accepted_filepath, index=False)
+    # ---> `extraction_engine` reads the accepted rows from here
+    accepted.to_csv(f"{output_path}/transformed/accepted.csv", index=False)
     print(f"[!] {len(accepted)} rows accepted for auto-extraction.")
+    log.loc["LongDocMode"] = long_docs
     print(f"[!] Accepted narratives saved to: {accepted_path}")
     
     # ---> Q1, Q5 are diverted for human review
     diverted_filepath = f"{diverted_path}/q1xq5.csv"
-    diverted = data.loc[data["qCut"].isin(["Q1", "Q5"])]
+    diverted = data.loc[~data["qCut"].isin(accepted_quants)]
     diverted.to_csv(diverted_filepath, index=False)
     print(f"[!] {len(diverted)} rows diverted to human review. {diverted_filepath}.")
     print(f"[!] Diverted narratives saved to: {diverted_filepath}.\n")
+    end_step(len(accepted))
     return accepted_path, log
 
 
-def transform_data(input_path:str, narr_col:str, 
-                   log:pd.DataFrame)->(pd.DataFrame, pd.DataFrame):
+def save_transformation_chunked(chunks, log:pd.DataFrame, output_path:str,
+                                long_docs:bool=False):
+    """
+    Streaming version of `save_transformation`, writing the same
+    files. Each chunk is appended as it arrives: all rows to
+    `q2xq3xq4.csv`, accepted rows to `transformed/accepted.csv`, and
+    diverted rows to `q1xq5.csv`. Accepted rows are also yielded
+    for auto-extraction.
+    
+    Args:
+    chunks (iterable): chunks of narratives with `qCut`
+    log (pd.DataFrame): Session log
+    output_path (str): Path for session outputs
+    long_docs (bool): Accept Q5 for windowed extraction
+    
+    Yields:
+    accepted (pd.DataFrame): rows of the chunk accepted for auto-extraction
+    """
+    accepted_path, diverted_path = create_folder_struct(output_path)
+    accepted_filepath = f"{accepted_path}/q2xq3xq4.csv"
+    extraction_filepath = f"{output_path}/transformed/accepted.csv"
+    diverted_filepath = f"{diverted_path}/q1xq5.csv"
+    accepted_quants = ["Q2", "Q3", "Q4", "Q5"] if long_docs else ["Q2", "Q3", "Q4"]
+    TOTAL_ACCEPTED, TOTAL_DIVERTED = 0, 0
+    log.loc["LongDocMode"] = long_docs
+    for n, chunk in enumerate(chunks):
+        step("2.5", len(chunk))
+        mask = chunk["qCut"].isin(accepted_quants)
+        accepted, diverted = chunk.loc[mask], chunk.loc[~mask]
+        # as in `save_transformation`, `q2xq3xq4.csv` holds all rows
+        for rows, filepath in [(chunk, accepted_filepath),
+                               (accepted, extraction_filepath),
+                               (diverted, diverted_filepath)]:
+            rows.to_csv(filepath, index=False,
+                        mode="w" if n == 0 else "a", header=n == 0)
+        TOTAL_ACCEPTED += len(accepted)
+        TOTAL_DIVERTED += len(diverted)
+        log.loc["Accepted"] = TOTAL_ACCEPTED
+        log.loc["Diverted"] = TOTAL_DIVERTED
+        end_step(len(accepted), chunk=n)
+        yield accepted
+    print(f"[!] {TOTAL_ACCEPTED} rows accepted for auto-extraction.")
+    print(f"[!] Accepted narratives saved to: {extraction_filepath}")
+    print(f"[!] {TOTAL_DIVERTED} rows diverted to human review.")
+    print(f"[!] Diverted narratives saved to: {diverted_filepath}.\n")
+
+
+# Declared column types for `read_export`, by name or as Arrow types
+ARROW_TYPES = {"string": pa.string(), "str": pa.string(), "int64": pa.int64(),
+               "float64": pa.float64(), "bool": pa.bool_()}
+# Cells read as missing, the same as the defaults of `pd.read_csv`
+NA_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+             "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None",
+             "n/a", "nan", "null"]
+# Columns of `accepted.csv` used by JOB 3, and their types; `ID` is
+# left to the reader, so IDs match earlier checkpoints and tables
+ACCEPTED_COLUMNS = ["ID", "narratives", "offset_map"]
+ACCEPTED_DTYPES = {"narratives": "string", "offset_map": "string"}
+
+
+def export_header(input_path:str)->(list):
+    """
+    Reads the column names of a CSV file the way `pd.read_csv`
+    names them: blank names become `Unnamed: <n>`, and repeated
+    names get a numbered suffix, e.g. `X, X` -> `X, X.1`.
+
+    Args:
+    input_path (str): Path to a CSV file
+
+    Returns:
+    names (list): column names
+    """
+    with open(input_path, "r", newline="", encoding="utf-8-sig") as f:
+        header = next(csv.reader(f), [])
+    header = [name or f"Unnamed: {n}" for n, name in enumerate(header)]
+    names, counts = [], {}
+    for name in header:
+        base, count = name, counts.get(name, 0)
+        while count > 0:
+            counts[base] = count + 1
+            name = f"{base}.{count}"
+            # skip suffixes taken by names later in the header
+            count = count + 1 if name in header else counts.get(name, 0)
+        counts[name] = count + 1
+        names.append(name)
+    return names
+
+
+def read_export(input_path:str, usecols:list=None, dtype:dict=None,
+                compact:bool=False)->(pd.DataFrame):
+    """
+    Reads a CSV file with the multithreaded Arrow CSV reader.
+    [1] Only the columns in `usecols` are converted; the rest of
+        each row is skipped, so unused columns of wide exports cost
+        little more than the time to scan past them.
+    [2] Columns in `dtype` are converted to the declared type
+        instead of being inferred.
+    [3] Missing cells are read as `NA_VALUES`, as in `pd.read_csv`;
+        quoted narratives may span several lines.
+    [4] As in `pd.read_csv`, repeated column names are numbered
+        (`export_header`), and dates and times are kept as text,
+        so saved CSVs repeat them as exported. Arrow infers types
+        from the first block, so that block is read for the schema
+        and temporal columns are declared as strings.
+    
+    Args:
+    input_path (str): Path to a CSV file
+    usecols (list): Columns to read, in this order, or None for all
+    dtype (dict): Column -> type name in `ARROW_TYPES`, or an Arrow type
+    compact (bool): Keep text as Arrow strings (`COMPACT_TEXT`)
+    
+    Returns:
+    data (pd.DataFrame): the selected columns
+    """
+    types = {col: ARROW_TYPES.get(kind, kind) for col, kind in (dtype or {}).items()
+             if usecols is None or col in usecols}
+    read_options = pa_csv.ReadOptions(use_threads=True, skip_rows=1,
+                                      column_names=export_header(input_path))
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+    convert_options = lambda types: pa_csv.ConvertOptions(
+                                        include_columns=usecols or [], column_types=types,
+                                        null_values=NA_VALUES, strings_can_be_null=True)
+    # [4] Keep dates and times as text
+    with pa_csv.open_csv(input_path, read_options, parse_options,
+                         convert_options(types)) as reader:
+        types.update({field.name: pa.string() for field in reader.schema
+                      if pa.types.is_temporal(field.type)})
+    table = pa_csv.read_csv(input_path, read_options, parse_options,
+                            convert_options(types))
+    mapper = {pa.string(): pd.StringDtype("pyarrow")}.get if compact else None
+    return table.to_pandas(types_mapper=mapper)
+
+
+def read_accepted(accepted_path:str, compact:bool=False)->(pd.DataFrame):
+    """Reads the columns of `accepted.csv` that JOB 3 uses
+    (`ACCEPTED_COLUMNS`) with `read_export`."""
+    header = pd.read_csv(accepted_path, nrows=0).columns
+    usecols = [col for col in ACCEPTED_COLUMNS if col in header]
+    return read_export(accepted_path, usecols, ACCEPTED_DTYPES, compact=compact)
+
+
+def transform_data(input_path:str, narr_col:str, log:pd.DataFrame, 
+                   cuts:list=None, compact:bool=False,
+                   usecols:list=None)->(pd.DataFrame, pd.DataFrame):
     """
         [JOB 1: Transforms data for spaCy extraction engine]
     [1] Creates log; loads data from input path; saves metadata to log.
@@ -134,10 +503,19 @@ def transform_data(input_path:str, narr_col:str,
     [5] Data that is accepted from Q2, Q3, and Q4 is passed along to the pipeline.
     [6] Data from Q1-Q5 is diverted to Phase 2 Preprocessing.
     
+    [TIP] With `compact`, narratives are read as Arrow strings and the
+    frame is kept compact through JOB 2 (see `compact_frame`).
+    [TIP] Declare `usecols`, e.g. `["ID", narr_col]`, to read only the
+    columns you need from wide exports (see `read_export`). True
+    duplicates are then found on those columns only.
+    
     Args:
     input_path (str): Path to input data CSV file
     narr_col (str): Column in the Pandas dataframe that contains narrative text
     log (pd.DataFrame): Session log
+    cuts (list): Optional quantile cut points frozen by `freeze_quants`
+    compact (bool): Use compact dtypes to reduce memory per row
+    usecols (list): Columns to read, or None for all columns
     
     Return:
     data (pd.DataFrame): Dataframe of narratives prepped for extraction
@@ -145,8 +523,11 @@ def transform_data(input_path:str, narr_col:str,
     """
     print("-"*72)    
     print(f"[JOB 1.1] Read Data; Initialize Log")
+    step("1.1")
     log = pd.DataFrame(columns=["Description"])
-    data = pd.read_csv(input_path)
+    if usecols is not None and narr_col not in usecols:
+        usecols = [*usecols, narr_col]
+    data = read_export(input_path, usecols, {narr_col: "string"}, compact=compact)
     
     # 1. Collecting meta-data
     data["TRUE_DUPLICATE"] = data.duplicated()
@@ -170,6 +551,7 @@ def transform_data(input_path:str, narr_col:str,
     
     # 3. Imputing missing values with `0`
     print(f"[JOB 1.2] Count and Resolve Missing Values")
+    step("1.2", len(data))
     data["narratives"] = data[narr_col].fillna("0")
     print(f"[!] {TOTAL_NULL} Missing Values Replaced with `0`.")
     print("--- Imputing with zero as a string:")
@@ -179,6 +561,7 @@ def transform_data(input_path:str, narr_col:str,
     print("-"*72)
 
     print(f"[JOB 1.3] Count and Resolve Duplicate Values")
+    step("1.3", len(data))
     print(f"[!] {TRUE_DUPLICATES} True Duplicates Dropped from Data.")
     data = data.drop_duplicates(keep="first")
     print(f"[!] {NARR_DUPLICATES} Narrative Duplicates Dropped from Data.")
@@ -187,11 +570,129 @@ def transform_data(input_path:str, narr_col:str,
     print("-"*72)
     
     print(f"[JOB 1.4] Identify Quantile Length")
+    step("1.4", len(data))
     print("--- [*] Identify Narrative Character Length Quantiles to Detect Edge Cases")
     print("--- [*] Character length of each narrative identifies extra long or extra short narratives.")
     print("-----  [1] Quantile 1 narratives will yeild few entities.")
     print("-----  [2] Quantile 5 narratives will often be dirty and contain:")
     print("------------> HTML Tags, unsupported character encodings, semi-tabular data.")
     print("------------> [!] These clog the auto-extractor because they are not natural language.")
-    data, log = define_quants(data, "narratives", 5, log)
-    return data, log
\ No newline at end of file
+    data, log = define_quants(data, "narratives", 5, log, cuts=cuts)
+    if compact:
+        data = compact_frame(data)
+    end_step(len(data))
+    return data, log
+
+
+def mark_seen(hashes:np.ndarray, seen:set)->(np.ndarray):
+    """
+    Marks hashes that were already seen, in an earlier chunk or
+    earlier in the same chunk, then adds the new hashes to `seen`.
+    Only the 64-bit hashes are kept between chunks, so the memory
+    used for deduplication does not depend on the width of the rows.
+
+    Args:
+    hashes (np.ndarray): uint64 hashes of rows in the current chunk
+    seen (set): hashes of rows from previous chunks (updated in place)
+
+    Returns:
+    duplicated (np.ndarray): boolean mask of rows already seen
+    """
+    duplicated = pd.Series(hashes).duplicated().to_numpy().copy()
+    duplicated |= np.fromiter((h in seen for h in hashes.tolist()),
+                              dtype=bool, count=len(hashes))
+    seen.update(hashes.tolist())
+    return duplicated
+
+
+def transform_data_chunked(input_path:str, narr_col:str, log:pd.DataFrame,
+                           chunksize:int=100000, compact:bool=False,
+                           usecols:list=None):
+    """
+        [JOB 1: Transforms data for spaCy extraction engine, in chunks]
+    Streaming version of `transform_data` for exports that do not fit
+    in memory. The CSV is read `chunksize` rows at a time, so peak
+    memory depends on the chunk size rather than the file size.
+    [1] Reads a chunk of the input CSV. Every column is read as text:
+        types inferred per chunk differ between chunks (e.g. int in
+        one, float in another with a missing value), and so would the
+        hashes of the same row.
+    [2] Replaces missing narratives with `0` (as a string).
+    [3] Drops true duplicates and narrative duplicates across chunks.
+        - Each row and each narrative is reduced to a 64-bit hash of
+        its text, and only the hashes are kept between chunks.
+    [4] Measures character length of narrative text (`narr_length`).
+        - `qCut` is not assigned here; route chunks with `route_chunks`.
+    [5] Yields each prepared chunk, e.g. to `EdgeCaseDetector`.
+    The session log is updated in place with running totals.
+
+    Args:
+    input_path (str): Path to input data CSV file
+    narr_col (str): Column in the Pandas dataframe that contains narrative text
+    log (pd.DataFrame): Session log
+    chunksize (int): Number of rows read from the CSV at a time
+    compact (bool): Use compact dtypes, see `compact_frame`
+    usecols (list): Columns to read, or None for all columns
+
+    Yields:
+    chunk (pd.DataFrame): Chunk of unique narratives prepped for extraction
+    """
+    print("-"*72)
+    print(f"[JOB 1.1] Read Data in Chunks of {chunksize} Rows")
+    seen_rows, seen_narrs = set(), set()
+    TOTAL_ROWS, TRUE_DUPLICATES, NARR_DUPLICATES = 0, 0, 0
+    TOTAL_NULL, UNIQUE_NARRS = 0, 0
+    log.loc["UUID Column"] = "ID"
+    log.loc["Narrative Column"] = narr_col
+    log.loc["New Narrative Column"] = "narratives"
+    log.loc["Chunk Size"] = chunksize
+
+    # the Arrow reader has no chunks; read text, so every chunk has the same types
+    if usecols is not None and narr_col not in usecols:
+        usecols = [*usecols, narr_col]
+    dtype = COMPACT_TEXT if compact else str
+    step("1.1")
+    for n, chunk in enumerate(pd.read_csv(input_path, chunksize=chunksize,
+                                          usecols=usecols, dtype=dtype)):
+        # 1. Collecting meta-data
+        row_hashes = pd.util.hash_pandas_object(chunk, index=False)
+        narr_hashes = pd.util.hash_pandas_object(chunk[narr_col], index=False)
+        true_dup = mark_seen(row_hashes.to_numpy(), seen_rows)
+        narr_dup = mark_seen(narr_hashes.to_numpy(), seen_narrs)
+        TOTAL_ROWS += len(chunk)
+        TRUE_DUPLICATES += int(true_dup.sum())
+        NARR_DUPLICATES += int(narr_dup.sum())
+        TOTAL_NULL += int(chunk[narr_col].isna().sum())
+
+        # 2. Dropping duplicates; a true duplicate is always a narrative
+        # duplicate, so keeping the first narrative drops both
+        chunk = chunk.loc[~narr_dup].copy()
+
+        # 3. Imputing missing values with `0`
+        chunk["narratives"] = chunk[narr_col].fillna("0")
+
+        # 4. Measure character length
+        chunk["narr_length"] = as_text(chunk["narratives"]).str.len()
+        if compact:
+            chunk = compact_frame(chunk)
+        UNIQUE_NARRS += len(chunk)
+        print(f"[*] Chunk {n}: {len(chunk)} unique narratives "
+              f"({TOTAL_ROWS} rows read).")
+
+        # 5. Populating log with running totals
+        log.loc["Number of Records"] = TOTAL_ROWS
+        log.loc["Number of True Duplicates"] = TRUE_DUPLICATES
+        log.loc["Number of Narrative Duplicates"] = NARR_DUPLICATES
+        log.loc["Total Missing Values"] = TOTAL_NULL
+        log.loc["NullValues"] = TOTAL_NULL
+        end_step(len(chunk), chunk=n)
+        yield chunk
+        step("1.1")
+    end_step(0)
+
+    print(f"[*] {TOTAL_ROWS} Total Rows in Data.")
+    print(f"[!] {TOTAL_NULL} Missing Values Replaced with `0`.")
+    print(f"[!] {TRUE_DUPLICATES} True Duplicates Dropped from Data.")
+    print(f"[!] {NARR_DUPLICATES} Narrative Duplicates Dropped from Data.")
+    print(f"[!] {UNIQUE_NARRS} Unique Narratives Remaining.")
+    print("-"*72)